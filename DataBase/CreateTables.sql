@@ -1,3 +1,15 @@
+--- BRANCHES (lending centers) ---
+-- Inventory, loans, donations and settings belong to a branch; every list query is scoped to one.
+
+CREATE TABLE branches (
+    id SERIAL PRIMARY KEY,
+    name VARCHAR(100) UNIQUE NOT NULL,
+    city VARCHAR(50),
+    catalog_version BIGINT NOT NULL DEFAULT 0 -- bumped by each change to the branch's catalog (see app.py)
+);
+
+INSERT INTO branches (name) VALUES ('סניף ראשי'); -- id 1, DEFAULT_BRANCH_ID in app.py
+
 --- LOGIN INFORMATIONS ---
 
 CREATE TABLE personnal_infos (
@@ -7,9 +19,26 @@ CREATE TABLE personnal_infos (
     phone_number VARCHAR(20),
 	email VARCHAR(100) UNIQUE NOT NULL,
     passwd TEXT NOT NULL,
-    role VARCHAR(20) CHECK (role IN ('admin', 'user','employee')) DEFAULT 'user'
+    role VARCHAR(20) CHECK (role IN ('admin', 'user','employee')) DEFAULT 'user',
+    token_version INT NOT NULL DEFAULT 0, -- bumped to invalidate the account's issued tokens
+    branch_id INT REFERENCES branches(id) -- where an employee works (NULL for families and admins)
+);
+
+-- Lowest token version still accepted per user, for the workers' in-memory check (app.py, Token Revocation)
+CREATE TABLE token_revocations (
+    user_id INT PRIMARY KEY, -- no FK: the row must outlive a deleted account
+    min_version INT NOT NULL,
+    revoked_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Admin user directory search (/api/admin/users?q=)
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX idx_users_full_name_trgm ON personnal_infos USING gin (full_name gin_trgm_ops);
+CREATE INDEX idx_users_username_trgm ON personnal_infos USING gin (username gin_trgm_ops);
+CREATE INDEX idx_users_email_trgm ON personnal_infos USING gin (email gin_trgm_ops);
+CREATE INDEX idx_users_phone_trgm ON personnal_infos USING gin (phone_number gin_trgm_ops);
+CREATE INDEX idx_users_role ON personnal_infos (role, id);
+
 ------- PRODUCTS INFORTMATIONS -------
 
 CREATE TABLE products (
@@ -19,11 +48,17 @@ CREATE TABLE products (
     publish_date DATE DEFAULT CURRENT_DATE,
     status VARCHAR(20) CHECK (status IN ('available', 'borrowed', 'unavailable', 'confirmation_pending')) DEFAULT 'available',
     donator_username VARCHAR(100),
-    description VARCHAR(200)
-
+    description VARCHAR(200),
+    photo_path VARCHAR(100), -- photos/<content hash>.<ext> under UPLOAD_DIR
+    branch_id INT NOT NULL DEFAULT 1 REFERENCES branches(id),
+    -- who holds it now (the approved loan that has started), kept up to date by the app so listings need no join
+    current_borrow_id INT,
+    current_borrower_username VARCHAR(50)
 );
 
 CREATE INDEX idx_product_name ON products (product_name);
+CREATE INDEX idx_products_branch_status ON products (branch_id, status); -- a branch's catalog
+CREATE INDEX idx_products_branch_id ON products (branch_id, id); -- a branch's inventory, newest first
 
 ----------------REQUESTS INFORMATIONS  ---------------------
 
@@ -33,11 +68,24 @@ CREATE TABLE borrow_requests (
     product_id INT NOT NULL REFERENCES products(id) ON DELETE CASCADE,
     request_date TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
 	returned_date DATE,
-    status VARCHAR(20) CHECK (status IN ('pending', 'approved', 'rejected', 'returned', 'confirmation_pending')) DEFAULT 'pending', 
+    status VARCHAR(20) CHECK (status IN ('pending', 'approved', 'rejected', 'returned', 'confirmation_pending')) DEFAULT 'pending',
+    approved_at TIMESTAMP WITH TIME ZONE,
+    start_date DATE NOT NULL DEFAULT CURRENT_DATE, -- later than today for a reservation
+    loan_period DATERANGE GENERATED ALWAYS AS (daterange(start_date, returned_date, '[]')) STORED,
+    branch_id INT NOT NULL REFERENCES branches(id) -- the product's branch, copied so queues are scoped without a join
 );
 
-CREATE INDEX idx_borrow_request_status ON borrow_requests (status);
+-- No two active bookings of the same product may overlap (also the index behind /api/products/availability)
+CREATE EXTENSION IF NOT EXISTS btree_gist;
+ALTER TABLE borrow_requests ADD CONSTRAINT borrow_requests_no_overlap
+    EXCLUDE USING gist (product_id WITH =, loan_period WITH &&) WHERE (status IN ('pending', 'approved', 'confirmation_pending'));
+
+ALTER TABLE products ADD FOREIGN KEY (current_borrow_id) REFERENCES borrow_requests(id) ON DELETE SET NULL;
+CREATE INDEX idx_products_current_borrow ON products (current_borrow_id) WHERE current_borrow_id IS NOT NULL; -- for the ON DELETE SET NULL check
+
+CREATE INDEX idx_borrow_request_branch_status ON borrow_requests (branch_id, status);
 CREATE INDEX idx_borrow_request_product ON borrow_requests (product_id);
+CREATE INDEX idx_borrow_request_user_date ON borrow_requests (user_id, request_date DESC, id DESC); -- keyset pages of /api/my-requests
 
 ---------------- DONATION INFORMATIONS  ---------------------
 
@@ -47,10 +95,14 @@ CREATE TABLE donation_requests (
     category VARCHAR(50) NOT NULL,
     description VARCHAR(200),
     donator_username VARCHAR(100) NOT NULL,
+    photo_path VARCHAR(100),
     status VARCHAR(20) DEFAULT 'donation_pending', -- 'donation_pending', 'donation_approved', 'donation_rejected'
-    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    branch_id INT NOT NULL DEFAULT 1 REFERENCES branches(id) -- where the item will be dropped off
 );
 
+CREATE INDEX idx_donation_requests_branch_status ON donation_requests (branch_id, status, created_at);
+
 ---------------- EXTENSION INFORMATIONS  ---------------------
 
 CREATE TABLE extension_requests (
@@ -64,8 +116,127 @@ CREATE TABLE extension_requests (
 
 ---------------- SYSTEM SETTING INFORMATIONS  ---------------------
 
+-- Per-branch limits (max_borrow_items, max_borrow_days)
 CREATE TABLE system_settings (
-    setting_key VARCHAR(50) PRIMARY KEY,
-    setting_value VARCHAR(50)
+    branch_id INT NOT NULL REFERENCES branches(id) ON DELETE CASCADE,
+    setting_key VARCHAR(50),
+    setting_value VARCHAR(50),
+    PRIMARY KEY (branch_id, setting_key)
+);
+
+
+---------------- IDEMPOTENCY KEYS  ---------------------
+
+CREATE TABLE idempotency_keys (
+    user_id INT NOT NULL REFERENCES personnal_infos(id) ON DELETE CASCADE,
+    idempotency_key VARCHAR(100) NOT NULL,
+    endpoint VARCHAR(100) NOT NULL,
+    status_code SMALLINT, -- NULL while the first request is still running
+    response_body TEXT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id, idempotency_key)
+);
+
+CREATE INDEX idx_idempotency_created ON idempotency_keys (created_at);
+
+---------------- ARCHIVED BORROW REQUESTS  ---------------------
+-- Returned/rejected loans are moved here by `flask --app app archive-borrow-requests`
+
+CREATE TABLE borrow_requests_archive (
+    id INT PRIMARY KEY, -- keeps the original borrow_requests id
+    user_id INT NOT NULL REFERENCES personnal_infos(id) ON DELETE CASCADE,
+    product_id INT NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+    request_date TIMESTAMP WITH TIME ZONE NOT NULL,
+    returned_date DATE,
+    status VARCHAR(20) NOT NULL,
+    approved_at TIMESTAMP WITH TIME ZONE,
+    start_date DATE,
+    branch_id INT,
+    archived_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX idx_borrow_archive_user_date ON borrow_requests_archive (user_id, request_date DESC, id DESC);
+
+-- Extension history of the archived loans, moved with them
+CREATE TABLE extension_requests_archive (
+    id INT PRIMARY KEY, -- keeps the original extension_requests id
+    borrow_id INT NOT NULL REFERENCES borrow_requests_archive(id) ON DELETE CASCADE,
+    new_returned_date DATE NOT NULL,
+    status VARCHAR(20) NOT NULL,
+    request_date TIMESTAMP WITH TIME ZONE,
+    archived_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX idx_extension_archive_borrow ON extension_requests_archive (borrow_id);
+CREATE INDEX idx_borrow_request_active_user ON borrow_requests (user_id) WHERE status IN ('pending', 'approved', 'confirmation_pending');
+
+---------------- STATISTICS ROLLUPS  ---------------------
+-- Maintained by the borrow status transitions in app.py, rebuilt by `flask --app app backfill-stats`
+
+CREATE TABLE stats_daily_loans (
+    day DATE NOT NULL,
+    category VARCHAR(50) NOT NULL,
+    requested INT NOT NULL DEFAULT 0,
+    approved INT NOT NULL DEFAULT 0,
+    rejected INT NOT NULL DEFAULT 0,
+    returned INT NOT NULL DEFAULT 0,
+    approval_latency_seconds BIGINT NOT NULL DEFAULT 0, -- sum over the day's approvals
+    approval_latency_samples INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, category)
+);
+
+CREATE TABLE stats_product_utilization (
+    product_id INT PRIMARY KEY REFERENCES products(id) ON DELETE CASCADE,
+    loans INT NOT NULL DEFAULT 0,
+    borrowed_days INT NOT NULL DEFAULT 0,
+    last_borrowed_at TIMESTAMP WITH TIME ZONE
+);
+
+---------------- WAITING LIST  ---------------------
+-- FIFO per product; the head of the queue gets a pending borrow request when the item comes back
+
+CREATE TABLE waitlist (
+    id SERIAL PRIMARY KEY,
+    product_id INT NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+    user_id INT NOT NULL REFERENCES personnal_infos(id) ON DELETE CASCADE,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (product_id, user_id)
+);
+
+CREATE INDEX idx_waitlist_queue ON waitlist (product_id, created_at, id);
+CREATE INDEX idx_waitlist_user ON waitlist (user_id);
+
+---------------- BACKGROUND JOBS  ---------------------
+-- Follow-up work queued by the routes in their own transaction and run by `flask --app app work-jobs`,
+-- which claims rows with FOR UPDATE SKIP LOCKED.
+
+CREATE TABLE jobs (
+    id BIGSERIAL PRIMARY KEY,
+    queue VARCHAR(50) NOT NULL,
+    kind VARCHAR(50) NOT NULL,
+    payload JSONB NOT NULL DEFAULT '{}',
+    status VARCHAR(20) NOT NULL DEFAULT 'queued' CHECK (status IN ('queued', 'running', 'done', 'failed')),
+    attempts INT NOT NULL DEFAULT 0,
+    max_attempts INT NOT NULL DEFAULT 5,
+    run_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP, -- not before (retries are pushed back)
+    locked_at TIMESTAMP WITH TIME ZONE,
+    locked_by VARCHAR(100),
+    last_error TEXT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP WITH TIME ZONE
+);
+
+CREATE INDEX idx_jobs_ready ON jobs (queue, run_at, id) WHERE status = 'queued';
+CREATE INDEX idx_jobs_running ON jobs (locked_at) WHERE status = 'running';
+CREATE INDEX idx_jobs_finished ON jobs (finished_at) WHERE status IN ('done', 'failed');
+
+---------------- SCHEMA VERSION  ---------------------
+-- One row per applied DataBase/Migrations file; /readyz compares the highest with EXPECTED_SCHEMA_VERSION (app.py).
+-- This file always matches the latest migration.
+
+CREATE TABLE schema_migrations (
+    version INT PRIMARY KEY,
+    applied_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
 
+INSERT INTO schema_migrations (version) SELECT generate_series(1, 16);
@@ -0,0 +1,13 @@
+-- Idempotency-Key support for POST /api/borrow, /api/donate, /api/extensions and /api/return.
+
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    user_id INT NOT NULL REFERENCES personnal_infos(id) ON DELETE CASCADE,
+    idempotency_key VARCHAR(100) NOT NULL,
+    endpoint VARCHAR(100) NOT NULL,
+    status_code SMALLINT, -- NULL while the first request is still running
+    response_body TEXT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id, idempotency_key)
+);
+
+CREATE INDEX IF NOT EXISTS idx_idempotency_created ON idempotency_keys (created_at);
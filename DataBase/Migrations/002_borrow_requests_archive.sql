@@ -0,0 +1,17 @@
+-- Archive table for closed loans, filled by `flask --app app archive-borrow-requests`.
+-- Note: extension_requests rows of an archived loan are removed with it (ON DELETE CASCADE).
+
+CREATE TABLE IF NOT EXISTS borrow_requests_archive (
+    id INT PRIMARY KEY, -- keeps the original borrow_requests id
+    user_id INT NOT NULL REFERENCES personnal_infos(id) ON DELETE CASCADE,
+    product_id INT NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+    request_date TIMESTAMP WITH TIME ZONE NOT NULL,
+    returned_date DATE,
+    status VARCHAR(20) NOT NULL,
+    archived_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_borrow_archive_user_date ON borrow_requests_archive (user_id, request_date DESC);
+
+-- Quota counts only ever look at active loans
+CREATE INDEX IF NOT EXISTS idx_borrow_request_active_user ON borrow_requests (user_id) WHERE status IN ('pending', 'approved', 'confirmation_pending');
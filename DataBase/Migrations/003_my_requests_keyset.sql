@@ -0,0 +1,6 @@
+-- Keyset pagination of /api/my-requests on (request_date, id), newest first.
+
+CREATE INDEX IF NOT EXISTS idx_borrow_request_user_date ON borrow_requests (user_id, request_date DESC, id DESC);
+
+DROP INDEX IF EXISTS idx_borrow_archive_user_date;
+CREATE INDEX idx_borrow_archive_user_date ON borrow_requests_archive (user_id, request_date DESC, id DESC);
@@ -0,0 +1,10 @@
+-- Substring search for the admin user directory (/api/admin/users?q=&role=).
+-- Trigram GIN indexes let ILIKE '%term%' use an index on each searched column.
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS idx_users_full_name_trgm ON personnal_infos USING gin (full_name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_users_username_trgm ON personnal_infos USING gin (username gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_users_email_trgm ON personnal_infos USING gin (email gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_users_phone_trgm ON personnal_infos USING gin (phone_number gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_users_role ON personnal_infos (role, id);
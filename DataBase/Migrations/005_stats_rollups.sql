@@ -0,0 +1,29 @@
+-- Rollup tables behind /api/admin/stats, updated on every borrow request status change.
+-- Run `flask --app app backfill-stats` once after applying this migration.
+
+ALTER TABLE borrow_requests ADD COLUMN IF NOT EXISTS approved_at TIMESTAMP WITH TIME ZONE;
+ALTER TABLE borrow_requests_archive ADD COLUMN IF NOT EXISTS approved_at TIMESTAMP WITH TIME ZONE;
+
+CREATE TABLE IF NOT EXISTS stats_daily_loans (
+    day DATE NOT NULL,
+    category VARCHAR(50) NOT NULL,
+    requested INT NOT NULL DEFAULT 0,
+    approved INT NOT NULL DEFAULT 0,
+    rejected INT NOT NULL DEFAULT 0,
+    returned INT NOT NULL DEFAULT 0,
+    approval_latency_seconds BIGINT NOT NULL DEFAULT 0, -- sum over the day's approvals
+    approval_latency_samples INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, category)
+);
+
+CREATE TABLE IF NOT EXISTS stats_product_utilization (
+    product_id INT PRIMARY KEY REFERENCES products(id) ON DELETE CASCADE,
+    loans INT NOT NULL DEFAULT 0,
+    borrowed_days INT NOT NULL DEFAULT 0,
+    last_borrowed_at TIMESTAMP WITH TIME ZONE
+);
+
+CREATE TABLE IF NOT EXISTS stats_backlog (
+    name VARCHAR(50) PRIMARY KEY,
+    value INT NOT NULL DEFAULT 0
+);
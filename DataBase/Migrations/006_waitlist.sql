@@ -0,0 +1,12 @@
+-- Waiting list for items that are currently borrowed (/api/waitlist).
+
+CREATE TABLE IF NOT EXISTS waitlist (
+    id SERIAL PRIMARY KEY,
+    product_id INT NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+    user_id INT NOT NULL REFERENCES personnal_infos(id) ON DELETE CASCADE,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (product_id, user_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_waitlist_queue ON waitlist (product_id, created_at, id);
+CREATE INDEX IF NOT EXISTS idx_waitlist_user ON waitlist (user_id);
@@ -0,0 +1,19 @@
+-- Date-range reservations: every loan gets a [start_date, returned_date] period and active
+-- periods of a product may not overlap. Overlapping active loans already in the table must be
+-- resolved (rejected or returned) before the constraint can be added.
+
+CREATE EXTENSION IF NOT EXISTS btree_gist;
+
+ALTER TABLE borrow_requests ADD COLUMN IF NOT EXISTS start_date DATE;
+UPDATE borrow_requests SET start_date = LEAST(request_date::date, COALESCE(returned_date, request_date::date)) WHERE start_date IS NULL;
+ALTER TABLE borrow_requests ALTER COLUMN start_date SET DEFAULT CURRENT_DATE;
+ALTER TABLE borrow_requests ALTER COLUMN start_date SET NOT NULL;
+ALTER TABLE borrow_requests ADD COLUMN IF NOT EXISTS loan_period DATERANGE
+    GENERATED ALWAYS AS (daterange(start_date, returned_date, '[]')) STORED;
+
+ALTER TABLE borrow_requests DROP CONSTRAINT IF EXISTS borrow_requests_no_overlap;
+ALTER TABLE borrow_requests ADD CONSTRAINT borrow_requests_no_overlap
+    EXCLUDE USING gist (product_id WITH =, loan_period WITH &&) WHERE (status IN ('pending', 'approved', 'confirmation_pending'));
+
+ALTER TABLE borrow_requests_archive ADD COLUMN IF NOT EXISTS start_date DATE;
+UPDATE borrow_requests_archive SET start_date = LEAST(request_date::date, COALESCE(returned_date, request_date::date)) WHERE start_date IS NULL;
@@ -0,0 +1,4 @@
+-- Uploaded photos (stored under UPLOAD_DIR, see the Product Photos section of app.py).
+
+ALTER TABLE products ADD COLUMN IF NOT EXISTS photo_path VARCHAR(100);
+ALTER TABLE donation_requests ADD COLUMN IF NOT EXISTS photo_path VARCHAR(100);
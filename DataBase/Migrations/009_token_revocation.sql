@@ -0,0 +1,9 @@
+-- Per-user token version, so role changes and deleted accounts invalidate issued JWTs.
+
+ALTER TABLE personnal_infos ADD COLUMN IF NOT EXISTS token_version INT NOT NULL DEFAULT 0;
+
+CREATE TABLE IF NOT EXISTS token_revocations (
+    user_id INT PRIMARY KEY, -- no FK: the row must outlive a deleted account
+    min_version INT NOT NULL,
+    revoked_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,10 @@
+-- Records the applied migrations, so /readyz can tell whether the database matches the deployed code.
+-- From now on every migration ends by inserting its own number.
+
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version INT PRIMARY KEY,
+    applied_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+-- 001 to 009 were applied before this table existed
+INSERT INTO schema_migrations (version) SELECT generate_series(1, 10) ON CONFLICT (version) DO NOTHING;
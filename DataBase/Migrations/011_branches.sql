@@ -0,0 +1,36 @@
+-- Lending centers. Everything that exists today becomes branch 1; the global settings become its settings.
+
+CREATE TABLE IF NOT EXISTS branches (
+    id SERIAL PRIMARY KEY,
+    name VARCHAR(100) UNIQUE NOT NULL,
+    city VARCHAR(50)
+);
+
+INSERT INTO branches (id, name) VALUES (1, 'סניף ראשי') ON CONFLICT (id) DO NOTHING;
+SELECT setval(pg_get_serial_sequence('branches', 'id'), (SELECT MAX(id) FROM branches));
+
+ALTER TABLE personnal_infos ADD COLUMN IF NOT EXISTS branch_id INT REFERENCES branches(id);
+ALTER TABLE products ADD COLUMN IF NOT EXISTS branch_id INT NOT NULL DEFAULT 1 REFERENCES branches(id);
+ALTER TABLE donation_requests ADD COLUMN IF NOT EXISTS branch_id INT NOT NULL DEFAULT 1 REFERENCES branches(id);
+ALTER TABLE borrow_requests_archive ADD COLUMN IF NOT EXISTS branch_id INT;
+
+-- Loans carry their product's branch
+ALTER TABLE borrow_requests ADD COLUMN IF NOT EXISTS branch_id INT REFERENCES branches(id);
+UPDATE borrow_requests br SET branch_id = p.branch_id FROM products p WHERE br.product_id = p.id AND br.branch_id IS NULL;
+ALTER TABLE borrow_requests ALTER COLUMN branch_id SET NOT NULL;
+UPDATE borrow_requests_archive a SET branch_id = p.branch_id FROM products p WHERE a.product_id = p.id AND a.branch_id IS NULL;
+
+-- Settings are keyed by (branch, key)
+ALTER TABLE system_settings ADD COLUMN IF NOT EXISTS branch_id INT NOT NULL DEFAULT 1 REFERENCES branches(id) ON DELETE CASCADE;
+ALTER TABLE system_settings ALTER COLUMN branch_id DROP DEFAULT;
+ALTER TABLE system_settings DROP CONSTRAINT IF EXISTS system_settings_pkey;
+ALTER TABLE system_settings ADD CONSTRAINT system_settings_pkey PRIMARY KEY (branch_id, setting_key);
+
+-- Indexes lead with the branch
+DROP INDEX IF EXISTS idx_borrow_request_status;
+CREATE INDEX IF NOT EXISTS idx_borrow_request_branch_status ON borrow_requests (branch_id, status);
+CREATE INDEX IF NOT EXISTS idx_products_branch_status ON products (branch_id, status);
+CREATE INDEX IF NOT EXISTS idx_products_branch_id ON products (branch_id, id);
+CREATE INDEX IF NOT EXISTS idx_donation_requests_branch_status ON donation_requests (branch_id, status, created_at);
+
+INSERT INTO schema_migrations (version) VALUES (11) ON CONFLICT (version) DO NOTHING;
@@ -0,0 +1,18 @@
+-- Who currently holds each product, stored on the product so the inventory listing reads one table.
+-- The app updates it wherever a loan starts or ends (see set_current_borrow / release_product in app.py).
+
+ALTER TABLE products ADD COLUMN IF NOT EXISTS current_borrow_id INT REFERENCES borrow_requests(id) ON DELETE SET NULL;
+ALTER TABLE products ADD COLUMN IF NOT EXISTS current_borrower_username VARCHAR(50);
+CREATE INDEX IF NOT EXISTS idx_products_current_borrow ON products (current_borrow_id) WHERE current_borrow_id IS NOT NULL;
+
+-- Backfill: the latest approved loan that has started (overdue loans still hold their product)
+UPDATE products p SET current_borrow_id = cur.id, current_borrower_username = cur.username
+FROM (
+    SELECT DISTINCT ON (br.product_id) br.product_id, br.id, u.username
+    FROM borrow_requests br JOIN personnal_infos u ON u.id = br.user_id
+    WHERE br.status = 'approved' AND br.start_date <= CURRENT_DATE
+    ORDER BY br.product_id, br.start_date DESC, br.id DESC
+) cur
+WHERE p.id = cur.product_id AND p.current_borrow_id IS NULL;
+
+INSERT INTO schema_migrations (version) VALUES (12) ON CONFLICT (version) DO NOTHING;
@@ -0,0 +1,6 @@
+-- Catalog snapshots are stamped with a per-branch version, so an older rebuild never replaces a newer one
+-- and instances can tell that their copy is out of date.
+
+ALTER TABLE branches ADD COLUMN IF NOT EXISTS catalog_version BIGINT NOT NULL DEFAULT 0;
+
+INSERT INTO schema_migrations (version) VALUES (14) ON CONFLICT (version) DO NOTHING;
@@ -0,0 +1,14 @@
+-- Archiving a loan deleted its extension requests (ON DELETE CASCADE); they now move to their own archive.
+
+CREATE TABLE IF NOT EXISTS extension_requests_archive (
+    id INT PRIMARY KEY, -- keeps the original extension_requests id
+    borrow_id INT NOT NULL REFERENCES borrow_requests_archive(id) ON DELETE CASCADE,
+    new_returned_date DATE NOT NULL,
+    status VARCHAR(20) NOT NULL,
+    request_date TIMESTAMP WITH TIME ZONE,
+    archived_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_extension_archive_borrow ON extension_requests_archive (borrow_id);
+
+INSERT INTO schema_migrations (version) VALUES (15) ON CONFLICT (version) DO NOTHING;
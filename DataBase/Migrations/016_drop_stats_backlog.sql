@@ -0,0 +1,6 @@
+-- The pending backlog is counted from borrow_requests (branch_id, status) index; its counter row made every
+-- borrow transaction queue on one row lock.
+
+DROP TABLE IF EXISTS stats_backlog;
+
+INSERT INTO schema_migrations (version) VALUES (16) ON CONFLICT (version) DO NOTHING;
@@ -0,0 +1,293 @@
+"""
+Fills a LevKatan database with synthetic, production-like data for profiling.
+
+Volumes are configurable; rows are streamed with COPY in batches. The data follows the app's rules:
+- active loans of a product never overlap (borrow_requests_no_overlap)
+- products, loans and donations are spread over --branches lending centers
+- nobody holds more than a branch's max_borrow_items active loans there
+- product statuses match the loan covering today
+- extension requests hang off approved loans
+Names, product names and descriptions are in Hebrew. Every generated account has the password
+GENERATED_PASSWORD (hashed once).
+
+Usage:
+    DATABASE_URL=postgres://... python DataBase/generate_data.py --users 50000 --products 20000 --loans 1000000
+
+Run it on a database created from CreateTables.sql (or fully migrated). Afterwards rebuild the
+statistics rollups with `flask --app app backfill-stats`.
+"""
+import io
+import os
+import csv
+import random
+import argparse
+from datetime import date, datetime, timedelta, timezone
+
+import bcrypt
+import psycopg2
+from dotenv import load_dotenv
+
+GENERATED_PASSWORD = "levkatan123"
+ORG_USERNAME = "עמותת לב קטן"
+BATCH_ROWS = 100000
+
+FIRST_NAMES = ["נועה", "תמר", "מיכל", "יעל", "שירה", "אביגיל", "מאיה", "רותם", "הדס", "ליאור", "אורי", "יונתן",
+               "דניאל", "איתי", "נועם", "אריאל", "עומר", "יוסף", "משה", "דוד", "שרה", "רבקה", "לאה", "רחל",
+               "אסתר", "חנה", "מרים", "אליאור", "עידו", "גיל"]
+LAST_NAMES = ["כהן", "לוי", "מזרחי", "פרץ", "ביטון", "דהן", "אברהם", "פרידמן", "אזולאי", "מלכה", "כץ", "שפירא",
+              "אוחיון", "חדד", "גבאי", "בן דוד", "יוסף", "עמר", "רוזנברג", "גולדשטיין"]
+CITIES = ["ירושלים", "תל אביב", "חיפה", "באר שבע", "בני ברק", "פתח תקווה", "אשדוד", "נתניה", "רחובות", "בית שמש"]
+
+# category -> (weight, product names)
+CATALOG = {
+    'strollers': (30, ["עגלת תינוק", "עגלת טיולון", "עגלת תאומים", "עגלה משולבת", "טיולון קל"]),
+    'cribs': (15, ["עריסה", "עריסת נדנדה", "עריסה צמודת מיטה", "סל קלוע"]),
+    'car seats': (25, ["כיסא בטיחות", "סלקל", "בוסטר", "כיסא בטיחות מסתובב"]),
+    'toys': (20, ["משחק התפתחותי", "אוניברסיטה לתינוק", "קוביות", "נדנדה", "הליכון"]),
+    'baby beds': (10, ["מיטת תינוק", "לול", "מיטת מעבר", "לול מתקפל"]),
+}
+CONDITIONS = ["במצב מצוין", "כמו חדש", "במצב טוב", "משומש קלות", "עם סימני שימוש קלים"]
+EXTRAS = ["כולל כיסוי גשם", "כולל מזרן", "מתקפל בקלות", "מתאים מגיל לידה", "כולל תיק החתלה", "צבע אפור", "צבע כחול"]
+
+# Outcome of a past loan request
+PAST_STATUSES = (['returned'] * 85) + (['rejected'] * 15)
+
+
+def hebrew_name(rng):
+    return f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+
+
+def description(rng, category):
+    return f"{rng.choice(CATALOG[category][1])} {rng.choice(CONDITIONS)}, {rng.choice(EXTRAS)}. איסוף מ{rng.choice(CITIES)}."[:200]
+
+
+def at(day, rng, earliest_hour=8):
+    """A timestamp on the given day, during opening hours (never in the future)."""
+    moment = datetime(day.year, day.month, day.day, rng.randint(earliest_hour, 21), rng.randint(0, 59), tzinfo=timezone.utc)
+    return min(moment, datetime.now(timezone.utc))
+
+
+class CopyWriter:
+    """Buffers CSV rows and COPYs them in batches, so a million rows never sit in memory at once."""
+    def __init__(self, cur, table, columns, parent=None):
+        self.cur, self.table, self.columns = cur, table, columns
+        self.parent = parent  # writer of the rows these reference, flushed first
+        self.count = 0
+        self._reset()
+
+    def _reset(self):
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+        self.pending = 0
+
+    def write(self, row):
+        self.writer.writerow(['\\N' if v is None else v for v in row])
+        self.pending += 1
+        self.count += 1
+        if self.pending >= BATCH_ROWS:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            if self.parent is not None:
+                self.parent.flush()
+            self.buffer.seek(0)
+            self.cur.copy_expert(f"COPY {self.table} ({', '.join(self.columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", self.buffer)
+        self._reset()
+
+
+def next_id(cur, table):
+    cur.execute(f"SELECT COALESCE(MAX(id), 0) + 1 FROM {table}")
+    return cur.fetchone()[0]
+
+
+def generate(conn, args):
+    rng = random.Random(args.seed)
+    cur = conn.cursor()
+    today = date.today()
+    first_day = today - timedelta(days=args.history_days)
+
+    # Branches (the first one exists already) and their settings (kept if already configured)
+    for city in CITIES[1:args.branches]:
+        cur.execute("INSERT INTO branches (name, city) VALUES (%s, %s) ON CONFLICT (name) DO NOTHING", (f"סניף {city}", city))
+    cur.execute("SELECT id FROM branches ORDER BY id LIMIT %s", (args.branches,))
+    branch_ids = [r[0] for r in cur.fetchall()]
+    for branch_id in branch_ids:
+        for key, value in (('max_borrow_items', args.max_items), ('max_borrow_days', args.max_days)):
+            cur.execute("INSERT INTO system_settings (branch_id, setting_key, setting_value) VALUES (%s, %s, %s) ON CONFLICT (branch_id, setting_key) DO NOTHING",
+                        (branch_id, key, str(value)))
+    cur.execute("SELECT branch_id, setting_key, setting_value FROM system_settings WHERE branch_id = ANY(%s)", (branch_ids,))
+    settings = {}
+    for branch_id, key, value in cur.fetchall():
+        settings.setdefault(branch_id, {})[key] = int(value)
+    max_days = min(s['max_borrow_days'] for s in settings.values())
+
+    # 1. Users: one admin, a few employees, families
+    password_hash = bcrypt.hashpw(GENERATED_PASSWORD.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    first_user = next_id(cur, 'personnal_infos')
+    users = CopyWriter(cur, 'personnal_infos', ['id', 'full_name', 'username', 'phone_number', 'email', 'passwd', 'role', 'branch_id'])
+    usernames = []
+    for i in range(args.users):
+        user_id = first_user + i
+        role = 'admin' if i == 0 else 'employee' if i <= max(1, args.users // 200) else 'user'
+        username = f"gen_{role}_{user_id}"
+        usernames.append(username)
+        users.write([user_id, hebrew_name(rng), username, f"05{rng.randint(0, 8)}-{rng.randint(1000000, 9999999)}",
+                     f"{username}@levkatan.test", password_hash, role, branch_ids[i % len(branch_ids)] if role == 'employee' else None])
+    users.flush()
+    user_ids = list(range(first_user, first_user + args.users))
+
+    # 2. Products (statuses are set once the loans are known)
+    first_product = next_id(cur, 'products')
+    categories = list(CATALOG)
+    category_weights = [CATALOG[c][0] for c in categories]
+    product_categories = rng.choices(categories, weights=category_weights, k=args.products)
+    product_branches = rng.choices(branch_ids, k=args.products)
+    products = CopyWriter(cur, 'products', ['id', 'product_name', 'category', 'publish_date', 'status', 'donator_username', 'description', 'branch_id'])
+    for i, category in enumerate(product_categories):
+        donor = ORG_USERNAME if rng.random() < 0.3 else rng.choice(usernames)
+        products.write([first_product + i, rng.choice(CATALOG[category][1]), category,
+                        first_day + timedelta(days=rng.randint(0, args.history_days // 2)), 'available', donor, description(rng, category),
+                        product_branches[i]])
+    products.flush()
+
+    # 3. Loans: a timeline per product, walking back from today. Popular products get more loans,
+    #    but no more than one a day fits in the history.
+    weights = [rng.paretovariate(1.5) for _ in range(args.products)]
+    total_weight = sum(weights)
+    loans_per_product = [min(args.history_days, int(args.loans * w / total_weight)) for w in weights]
+    missing = args.loans - sum(loans_per_product)
+    while missing > 0 and min(loans_per_product) < args.history_days:
+        for i in range(args.products):
+            if missing and loans_per_product[i] < args.history_days:
+                loans_per_product[i] += 1
+                missing -= 1
+
+    active_count = {}  # (user_id, branch_id) -> active loans, to respect the branch's max_borrow_items
+    def borrower(branch_id):
+        for _ in range(20):
+            user_id = rng.choice(user_ids)
+            if active_count.get((user_id, branch_id), 0) < settings[branch_id]['max_borrow_items']:
+                active_count[user_id, branch_id] = active_count.get((user_id, branch_id), 0) + 1
+                return user_id
+        return None
+
+    first_loan = next_id(cur, 'borrow_requests')
+    loans = CopyWriter(cur, 'borrow_requests', ['id', 'user_id', 'product_id', 'branch_id', 'request_date', 'start_date', 'returned_date', 'status', 'approved_at'])
+    extensions = CopyWriter(cur, 'extension_requests', ['borrow_id', 'new_returned_date', 'status', 'request_date'], parent=loans)
+    product_status = {}
+    loan_id = first_loan
+
+    def add_loan(user_id, product_id, start, end, status):
+        nonlocal loan_id
+        requested = at(start - timedelta(days=rng.randint(0, 3)), rng)
+        approved_at = None
+        if status in ('approved', 'returned'):
+            approved_at = max(requested, min(requested + timedelta(minutes=rng.randint(5, 3 * 24 * 60)), at(start, rng, 21)))
+        loans.write([loan_id, user_id, product_id, product_branches[product_id - first_product], requested.isoformat(), start, None if status == 'rejected' else end, status,
+                     approved_at.isoformat() if approved_at else None])
+
+        # About one loan in eight asks for more time
+        if status in ('approved', 'returned') and rng.random() < 0.125:
+            ext_status = 'extension_pending' if status == 'approved' else rng.choice(['extension_approved', 'extension_rejected'])
+            extensions.write([loan_id, end + timedelta(days=rng.randint(2, 7)), ext_status, at(max(start, end - timedelta(days=2)), rng).isoformat()])
+        loan_id += 1
+
+    for index, count in enumerate(loans_per_product):
+        product_id = first_product + index
+        cursor_day = today  # loans are laid out backwards from here, without overlaps
+        if count == 0:
+            continue
+
+        # The most recent loan may still be running (or waiting for approval), possibly with a reservation after it
+        roll = rng.random()
+        if roll < args.active_share:
+            user_id = borrower(product_branches[index])
+            if user_id is not None:
+                start = today - timedelta(days=rng.randint(0, max_days - 1))
+                end = start + timedelta(days=rng.randint(max(1, (today - start).days), max_days))
+                status = 'pending' if rng.random() < 0.15 else 'approved'
+                add_loan(user_id, product_id, start, end, status)
+                product_status[product_id] = 'borrowed' if status == 'approved' else 'unavailable'
+                count -= 1
+                cursor_day = start - timedelta(days=1)
+
+                if count and rng.random() < 0.1:
+                    reserver = borrower(product_branches[index])
+                    if reserver is not None:
+                        reserve_start = end + timedelta(days=rng.randint(1, 10))
+                        add_loan(reserver, product_id, reserve_start, reserve_start + timedelta(days=rng.randint(2, max_days)),
+                                 rng.choice(['pending', 'approved']))
+                        count -= 1
+
+        slot = max(1, (cursor_day - first_day).days // max(1, count))  # days per past loan, gap included
+        for _ in range(count):
+            length = rng.randint(min(2, slot), min(max_days, slot))
+            end = cursor_day - timedelta(days=rng.randint(0, slot - length))
+            start = end - timedelta(days=length - 1)
+            if start < first_day:
+                break
+            add_loan(rng.choice(user_ids), product_id, start, end, rng.choice(PAST_STATUSES))
+            cursor_day = start - timedelta(days=1)
+    loans.flush()
+    extensions.flush()
+
+    cur.execute("CREATE TEMP TABLE generated_status (product_id INT PRIMARY KEY, status VARCHAR(20)) ON COMMIT DROP")
+    statuses = CopyWriter(cur, 'generated_status', ['product_id', 'status'])
+    for row in product_status.items():
+        statuses.write(row)
+    statuses.flush()
+    cur.execute("UPDATE products p SET status = s.status FROM generated_status s WHERE p.id = s.product_id")
+    cur.execute("""
+        UPDATE products p SET current_borrow_id = br.id, current_borrower_username = u.username
+        FROM borrow_requests br JOIN personnal_infos u ON u.id = br.user_id
+        WHERE br.product_id = p.id AND p.id >= %s AND p.status = 'borrowed' AND br.status = 'approved' AND br.start_date <= CURRENT_DATE
+    """, (first_product,))
+
+    # 4. Donation requests
+    donations = CopyWriter(cur, 'donation_requests', ['product_name', 'category', 'description', 'donator_username', 'status', 'created_at', 'branch_id'])
+    for _ in range(args.donations):
+        category = rng.choices(categories, weights=category_weights)[0]
+        status = rng.choices(['donation_pending', 'donation_approved', 'donation_rejected'], weights=[10, 70, 20])[0]
+        donations.write([rng.choice(CATALOG[category][1]), category, description(rng, category), rng.choice(usernames), status,
+                         at(first_day + timedelta(days=rng.randint(0, args.history_days)), rng).isoformat(), rng.choice(branch_ids)])
+    donations.flush()
+
+    # Explicit ids were used: move the sequences past them
+    for table in ('personnal_infos', 'products', 'borrow_requests'):
+        cur.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT MAX(id) FROM {table}))")
+    conn.commit()
+
+    conn.autocommit = True
+    for table in ('personnal_infos', 'products', 'borrow_requests', 'extension_requests', 'donation_requests'):
+        cur.execute(f"ANALYZE {table}")
+    return {'branches': len(branch_ids), 'users': users.count, 'products': products.count, 'loans': loans.count,
+            'extensions': extensions.count, 'donations': donations.count}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--products', type=int, default=5000)
+    parser.add_argument('--loans', type=int, default=100000)
+    parser.add_argument('--donations', type=int, default=5000)
+    parser.add_argument('--history-days', type=int, default=5 * 365, help="how far back the loan history goes")
+    parser.add_argument('--active-share', type=float, default=0.35, help="share of products currently lent or requested")
+    parser.add_argument('--max-items', type=int, default=3, help="max_borrow_items, if not configured yet")
+    parser.add_argument('--max-days', type=int, default=14, help="max_borrow_days, if not configured yet")
+    parser.add_argument('--branches', type=int, default=3, help=f"lending centers to spread the data over (1-{len(CITIES)})")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    load_dotenv()
+    conn = psycopg2.connect(os.getenv("DATABASE_URL"), sslmode='require')
+    try:
+        counts = generate(conn, args)
+    finally:
+        conn.close()
+    print("Generated " + ", ".join(f"{n} {name}" for name, n in counts.items()) + f" (password: {GENERATED_PASSWORD})")
+    print("Now run: flask --app app backfill-stats")
+
+
+if __name__ == '__main__':
+    main()
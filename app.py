@@ -1,858 +1,3069 @@
-import os
-import jwt
-import psycopg2
-import bcrypt
-from flask import Flask, request, jsonify
-from flask_cors import CORS
-from dotenv import load_dotenv
-from datetime import datetime, timedelta
-from functools import wraps
-
-app = Flask(__name__)
-CORS(app)
-
-load_dotenv()
-DATABASE_URL = os.getenv("DATABASE_URL")
-
-JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY")
-if not JWT_SECRET_KEY:  # Forces you to have a secure key in .env. Fails safely if missing.
-    raise ValueError("No JWT_SECRET_KEY set for Flask application")
-
-JWT_ALGORITHM = "HS256"
-
-# --- DB Helper ---
-def get_db_connection():
-    try:
-        conn = psycopg2.connect(DATABASE_URL, sslmode='require')
-        return conn
-    except Exception as e:
-        print(f"DB Connection Error: {e}")
-        return None
-
-# --- Decorators ---
-def token_required(f):
-    @wraps(f)
-    def decorated(*args, **kwargs):
-        if request.method == 'OPTIONS': return jsonify({}), 200
-        token_header = request.headers.get('Authorization')
-        if not token_header or not token_header.startswith('Bearer '):
-            return jsonify({'message': 'Token missing'}), 401
-        try:
-            token = token_header[7:]
-            data = jwt.decode(token, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
-            request.user_data = data # Store user info for the route to use
-        except Exception:
-            return jsonify({'message': 'Invalid Token'}), 401
-        return f(*args, **kwargs)
-    return decorated
-
-def admin_required(f):
-    @wraps(f)
-    def decorated(*args, **kwargs):
-        if request.method == 'OPTIONS': return jsonify({}), 200
-        token_header = request.headers.get('Authorization')
-        if not token_header: return jsonify({'message': 'Token missing'}), 401
-        try:
-            token = token_header.split(" ")[1]
-            data = jwt.decode(token, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
-            if data['role'] != 'admin':
-                return jsonify({'message': 'Admin access required'}), 403
-        except Exception:
-            return jsonify({'message': 'Invalid Token'}), 401
-        return f(*args, **kwargs)
-    return decorated
-
-def employee_required(f):
-    @wraps(f)
-    def decorated(*args, **kwargs):
-        if request.method == 'OPTIONS': return jsonify({}), 200
-        token_header = request.headers.get('Authorization')
-        if not token_header: return jsonify({'message': 'Token missing'}), 401
-        try:
-            token = token_header.split(" ")[1]
-            data = jwt.decode(token, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
-            if data['role'] not in ['admin', 'employee']:
-                return jsonify({'message': 'Employee access required'}), 403
-        except Exception:
-            return jsonify({'message': 'Invalid Token'}), 401
-        return f(*args, **kwargs)
-    return decorated
-
-# --- AUTH ROUTES (Login/Register) ---
-@app.route('/api/register', methods=['POST'])
-def register():
-    data = request.json
-    full_name = data.get('fullName')
-    username = data.get('username')
-    phone_number = data.get('phone_number')
-    email = data.get('email')
-    passwd = data.get('password')
-    
-    # Basic validation
-    if not all([full_name, username, email, passwd]):
-        return jsonify({"message": "Missing required fields"}), 400
-
-    password_bytes = passwd.encode('utf-8')
-    hashed_password = bcrypt.hashpw(password_bytes, bcrypt.gensalt()).decode('utf-8')
-    conn = get_db_connection()
-    cur = conn.cursor()
-    try:
-        cur.execute("INSERT INTO personnal_infos (full_name, username, phone_number, email, passwd, role) VALUES (%s, %s, %s, %s, %s, 'user') RETURNING id;", (full_name, username, phone_number, email, hashed_password))
-        user_id = cur.fetchone()[0]
-        conn.commit()
-        return jsonify({"message": "Registered", "userId": user_id}), 200
-    except Exception as e:
-        conn.rollback()
-        return jsonify({"message": str(e)}), 400
-    finally:
-        conn.close()
-
-@app.route('/api/login', methods=['POST'])
-def login():
-    data = request.json
-    email = data.get('email')
-    password = data.get('password')
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id, username, passwd, role FROM personnal_infos WHERE email = %s", (email,))
-    user = cur.fetchone()
-    conn.close()
-    if user and bcrypt.checkpw(password.encode('utf-8'), user[2].encode('utf-8')):
-        token = jwt.encode({'user_id': user[0], 'username': user[1], 'role': user[3], 'exp': datetime.utcnow() + timedelta(hours=24)}, JWT_SECRET_KEY, algorithm=JWT_ALGORITHM)
-        return jsonify({"message": "Success", "username": user[1], "role": user[3], "token": token}), 200
-    return jsonify({"message": "Invalid credentials"}), 401
-
-
-# ----- USER ROUTES (Catalog / Borrowing requests / Profile / Donation requests) -----
-
-#---- PROFILE------
-@app.route('/api/user/me', methods=['GET'])
-@token_required
-def get_user_profile():
-    user_id = request.user_data['user_id']
-    
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({"message": "INTERNAL SERVOR ERROR (DB)"}), 500
-    cur = conn.cursor()
-    
-    try:
-        # Selects the user's personal data
-        sql = """
-            SELECT username, full_name, email, phone_number 
-            FROM personnal_infos 
-            WHERE id = %s;
-        """
-        cur.execute(sql, (user_id,))
-        user_info = cur.fetchone()
-        
-        if user_info:
-            columns = ['username', 'full_name', 'email', 'phone_number']
-            result = dict(zip(columns, user_info))
-            return jsonify(result), 200
-        else:
-            return jsonify({"message": "User profile not found"}), 404
-            
-    except Exception as e:
-        print(f"Error retrieving profile: {e}")
-        return jsonify({"message": "Server error"}), 500
-    finally:
-        conn.close()
-
-
-@app.route('/api/user/me', methods=['PUT'])
-@token_required
-def update_user_profile():
-    user_id = request.user_data['user_id']
-    data = request.json
-    
-    # Editable data sent by the Frontend: The username cannot be changed
-    full_name = data.get('full_name')
-    email = data.get('email')
-    phone_number = data.get('phone_number')
-    
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({"message": "INTERNAL SERVER ERROR (DB)"}), 500
-    cur = conn.cursor()
-    
-    try:
-        # Mise à jour des champs modifiables.
-        sql = """
-            UPDATE personnal_infos 
-            SET full_name = %s, 
-                email = %s, 
-                phone_number = %s
-            WHERE id = %s 
-            RETURNING id;
-        """
-        cur.execute(sql, (full_name, email, phone_number, user_id))
-        
-        updated_id = cur.fetchone()
-        
-        if updated_id:
-            conn.commit()
-            return jsonify({"message": "Profil mis à jour"}), 200
-        else:
-            conn.rollback()
-            return jsonify({"message": "Profil non trouvé"}), 404
-            
-    except Exception as e:
-        conn.rollback()
-        print(f"Error updating profile: {e}")
-        return jsonify({"message": f"update error: {e}"}), 400
-    finally:
-        conn.close()
-
-#--- CATALOG ----
-@app.route('/api/products', methods=['GET'])
-def get_products():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    try:
-        # UPDATED: Select donator_username
-        cur.execute("SELECT id, product_name, category, status, description, donator_username FROM products WHERE status = 'available';")
-        products = [{
-            'id': r[0], 
-            'name': r[1], 
-            'category': r[2], 
-            'status': r[3],
-            'description': r[4], 
-            'donator_username': r[5] # Updated key
-        } for r in cur.fetchall()]
-    except Exception as e:
-        print(f"Error fetching products: {e}")
-        conn.rollback()
-        # Fallback query if columns are missing
-        cur.execute("SELECT id, product_name, category, status FROM products WHERE status = 'available';")
-        products = [{'id': r[0], 'name': r[1], 'category': r[2], 'status': r[3], 'description': '', 'donator_username': ''} for r in cur.fetchall()]
-
-    conn.close()
-    return jsonify(products), 200
-
-
-@app.route('/api/borrow', methods=['POST'])
-@token_required
-def borrow_product():
-    data = request.json
-    product_id = data.get('product_id')
-    returned_date_str = data.get('returned_date') # YYYY-MM-DD
-    user_id = request.user_data['user_id']
-    
-    conn = get_db_connection()
-    cur = conn.cursor()
-    try:
-        # 1. Fetch Limits
-        cur.execute("SELECT setting_key, setting_value FROM system_settings;")
-        rows = cur.fetchall()
-        settings = {row[0]: row[1] for row in rows}
-        max_items = int(settings.get('max_borrow_items', 3))
-        max_days = int(settings.get('max_borrow_days', 14))
-
-        # 2. Check User's Current Limit
-        cur.execute("SELECT COUNT(*) FROM borrow_requests WHERE user_id = %s AND status IN ('pending', 'approved', 'confirmation_pending')", (user_id,))
-        current_count = cur.fetchone()[0]
-        
-        if current_count >= max_items:
-            return jsonify({"message": f"הגעת למכסת ההשאלות שלך ({max_items} פריטים)."}), 400
-
-        # 3. Validate Date
-        if not returned_date_str:
-            return jsonify({"message": "Date is required"}), 400
-            
-        return_date = datetime.strptime(returned_date_str, "%Y-%m-%d").date()
-        today = datetime.now().date()
-        
-        if return_date <= today:
-            return jsonify({"message": "תאריך ההחזרה חייב להיות עתידי"}), 400
-            
-        delta = return_date - today
-        if delta.days > max_days:
-            return jsonify({"message": f"תקופת ההשאלה חורגת מהמותר ({max_days} ימים)."}), 400
-
-        # 4. Check Availability & Create Request (Existing Logic)
-        cur.execute("SELECT status FROM products WHERE id = %s", (product_id,))
-        status = cur.fetchone()
-        if not status or status[0] != 'available':
-            return jsonify({"message": "Product not available"}), 400
-            
-        cur.execute("INSERT INTO borrow_requests (user_id, product_id, returned_date) VALUES (%s, %s, %s)", (user_id, product_id, returned_date_str))
-        cur.execute("UPDATE products SET status = 'unavailable' WHERE id = %s", (product_id,))
-        
-        conn.commit()
-        return jsonify({"message": "בקשתך נשלחה בהצלחה!"}), 200
-    except Exception as e:
-        conn.rollback()
-        return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
-
-
-#---BORROWING REQUEST---
-@app.route('/api/my-requests', methods=['GET'])
-@token_required
-def get_my_requests():
-    user_id = request.user_data['user_id']
-    conn = get_db_connection()
-    cur = conn.cursor()
-    sql = """
-        SELECT br.id, p.product_name, br.request_date, br.status, br.returned_date
-        FROM borrow_requests br
-        JOIN products p ON br.product_id = p.id  
-        WHERE br.user_id = %s ORDER BY br.request_date DESC
-    """
-    cur.execute(sql, (user_id,))
-    requests = [{'id': r[0], 'product': r[1], 'date': str(r[2]), 'status': r[3], 'returned_date': str(r[4]) if r[4] else None
-    } for r in cur.fetchall()]
-    
-    conn.close()
-    return jsonify(requests), 200
-
-#---DONATION REQUEST---
-@app.route('/api/donate', methods=['POST'])
-@token_required
-def request_donation():
-    data = request.json
-    p_name = data.get('product_name')
-    cat = data.get('category')
-    desc = data.get('description')
-    username = data.get('donator_username') # Changed from donator_email
-
-    conn = get_db_connection()
-    cur = conn.cursor()
-    try:
-        cur.execute("""
-            INSERT INTO donation_requests (product_name, category, description, donator_username)
-            VALUES (%s, %s, %s, %s)
-        """, (p_name, cat, desc, username))
-        conn.commit()
-        return jsonify({"message": "Donation request submitted"}), 201
-    except Exception as e:
-        conn.rollback()
-        return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
-
-
-# --- EMPLOYEE ROUTES (Manage Products - CRUD) ---
-
-@app.route('/api/employee/products', methods=['POST'])
-@employee_required
-def create_product():
-    
-    data = request.json
-    product_name = data.get('product_name')
-    category = data.get('category')
-    description = data.get('description')
-    donator_username = data.get('donator_username') # Changed
-
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({"message": "Erreur interne du serveur (DB)"}), 500
-
-    cur = conn.cursor()
-
-    try:
-        sql = """
-            INSERT INTO products 
-            (product_name, category, description, donator_username)
-            VALUES (%s, %s, %s, %s) 
-            RETURNING id;
-        """
-        cur.execute(sql, (product_name, category, description, donator_username))
-        product_id = cur.fetchone()[0]
-        conn.commit()
-
-        return jsonify(
-            {"message": "Produit créé avec succès", "id": product_id}), 201
-
-    except Exception as e:
-        conn.rollback()
-        return jsonify(
-            {"message": f"Erreur lors de la création du produit: {e}"}), 400
-    finally:
-        conn.close()
-
-@app.route('/api/employee/products/<int:product_id>', methods=['GET'])
-@employee_required
-def get_single_product(product_id):
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({"message": "Erreur interne du serveur (DB)"}), 500
-
-    cur = conn.cursor()
-
-    try:
-        sql = """
-            SELECT id, product_name, category, description, donator_username, status 
-            FROM products 
-            WHERE id = %s;
-        """
-        cur.execute(sql, (product_id,))
-        product = cur.fetchone()
-
-        if product:
-            columns = ['id', 'product_name', 'category', 'description', 'donator_username', 'status']
-            result = dict(zip(columns, product))
-            return jsonify(result), 200
-        else:
-            return jsonify({"message": "Produit non trouvé"}), 404
-
-    except Exception as e:
-        print(f"Erreur lors de la récupération du produit: {e}")
-        return jsonify({"message": "Erreur serveur"}), 500
-    finally:
-        conn.close()
-
-
-@app.route('/api/employee/products', methods=['GET'])
-@employee_required
-def get_all_products():
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({"message": "Erreur interne du serveur (DB)"}), 500
-        
-    cur = conn.cursor()
-    
-    try:
-        sql = """
-            SELECT 
-                p.id, p.product_name, p.category, p.status, p.donator_username, p.publish_date,
-                u.username as borrower_name
-            FROM products p
-            LEFT JOIN borrow_requests br ON p.id = br.product_id AND br.status = 'approved'
-            LEFT JOIN personnal_infos u ON br.user_id = u.id
-            ORDER BY p.id DESC;
-        """
-        cur.execute(sql)
-        
-        columns = ['id', 'product_name', 'category', 'status', 'donator_username', 'publish_date', 'borrower_name']
-        products = [dict(zip(columns, r)) for r in cur.fetchall()]
-        
-        for p in products:
-            p['publish_date'] = str(p['publish_date'])
-        
-        return jsonify(products), 200
-        
-    except Exception as e:
-        print(f"Erreur lors de la récupération des produits: {e}")
-        return jsonify({"message": "Erreur serveur"}), 500
-    finally:
-        conn.close()
-
-
-@app.route('/api/employee/products/<int:product_id>', methods=['PUT'])
-@employee_required
-def update_product(product_id):
-    data = request.json
-
-    product_name = data.get('product_name')
-    category = data.get('category')
-    description = data.get('description')
-    donator_username = data.get('donator_username') # Changed
-    status = data.get('status')
-
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({"message": "Erreur interne du serveur (DB)"}), 500
-
-    cur = conn.cursor()
-
-    try:
-        sql = """
-            UPDATE products 
-            SET product_name = %s, 
-                category = %s, 
-                description = %s, 
-                donator_username = %s, 
-                status = %s
-            WHERE id = %s 
-            RETURNING id;
-        """
-        cur.execute(sql, (product_name, category, description, donator_username, status, product_id ))
-
-        updated_id = cur.fetchone()
-
-        if updated_id:
-            conn.commit()
-            return jsonify({"message": "Produit mis à jour"}), 200
-        else:
-            conn.rollback()
-            return jsonify({"message": "Produit non trouvé"}), 404
-
-    except Exception as e:
-        conn.rollback()
-        print(f"Erreur lors de la mise à jour du produit: {e}")
-        return jsonify({"message": f"Erreur de mise à jour: {e}"}), 400
-    finally:
-        conn.close()
-
-
-@app.route('/api/employee/products/<int:product_id>', methods=['DELETE'])
-@employee_required
-def delete_product(product_id):
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({"message": "Erreur interne du serveur (DB)"}), 500
-
-    cur = conn.cursor()
-
-    try:
-        cur.execute("DELETE FROM products WHERE id = %s RETURNING id;",
-                    (product_id,))
-        deleted_id = cur.fetchone()
-
-        if deleted_id:
-            conn.commit()
-            return jsonify({
-                               "message": "Produit supprimé"}), 204  # 204 No Content pour une suppression réussie
-        else:
-            return jsonify({"message": "Produit non trouvé"}), 404
-
-    except Exception as e:
-        conn.rollback()
-        return jsonify(
-            {"message": f"Erreur lors de la suppression du produit: {e}"}), 500
-    finally:
-        conn.close()
-
-
-
-# --- EMPLOYEE ROUTES (Manage Requests) ---
-
-@app.route('/api/employee/requests', methods=['GET'])
-@employee_required
-def get_all_requests():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    sql = """
-        SELECT br.id, u.username, p.product_name, br.status, br.request_date, br.returned_date
-        FROM borrow_requests br
-        JOIN personnal_infos u ON br.user_id = u.id
-        JOIN products p ON br.product_id = p.id
-        WHERE br.status = 'pending'
-    """
-    cur.execute(sql)
-    # On ajoute r[5] qui est returned_date
-    requests = [{
-        'id': r[0], 
-        'username': r[1], 
-        'product': r[2], 
-        'status': r[3], 
-        'date': str(r[4]),
-        'returned_date': str(r[5]) if r[5] else 'לא צוין'
-    } for r in cur.fetchall()]
-    conn.close()
-    return jsonify(requests), 200
-
-@app.route('/api/employee/requests/<int:req_id>', methods=['PUT'])
-@employee_required
-def update_request_status(req_id):
-    data = request.json
-    new_status = data.get('status') # 'approved' or 'rejected'
-    
-    conn = get_db_connection()
-    cur = conn.cursor()
-    try:
-        # 1. Mise à jour du statut de la requête
-        # Si le statut est 'rejected', on remet returned_date à NULL
-        if new_status == 'rejected':
-            sql_req = "UPDATE borrow_requests SET status = %s, returned_date = NULL WHERE id = %s RETURNING product_id"
-        else:
-            sql_req = "UPDATE borrow_requests SET status = %s WHERE id = %s RETURNING product_id"
-            
-        cur.execute(sql_req, (new_status, req_id))
-        result = cur.fetchone()
-        
-        if result:
-            product_id = result[0]
-            
-            if new_status == 'approved':
-                # Produit prêté
-                cur.execute("UPDATE products SET status = 'borrowed' WHERE id = %s", (product_id,))
-            elif new_status == 'rejected':
-                # Produit refusé -> redevient disponible
-                cur.execute("UPDATE products SET status = 'available' WHERE id = %s", (product_id,))
-                
-            conn.commit()
-            return jsonify({"message": "Status updated and date cleared if rejected"}), 200
-        else:
-            return jsonify({"message": "Request not found"}), 404
-    except Exception as e:
-        conn.rollback()
-        return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
-
-# --- EMPLOYEE ROUTES (DONATIONS Requests) ---
-
-@app.route('/api/employee/donations', methods=['GET'])
-@employee_required
-def get_donations():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id, product_name, category, description, donator_username, created_at FROM donation_requests WHERE status = 'donation_pending' ORDER BY created_at DESC")
-    dons = [{'id':r[0], 'product_name':r[1], 'category':r[2], 'description':r[3], 'donator_username':r[4], 'created_at':str(r[5])} for r in cur.fetchall()]
-    conn.close()
-    return jsonify(dons), 200
-
-@app.route('/api/employee/donations/<int:don_id>/reject', methods=['DELETE'])
-@employee_required
-def reject_donation(don_id):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM donation_requests WHERE id = %s", (don_id,))
-    conn.commit()
-    conn.close()
-    return '', 204
-
-@app.route('/api/employee/donations/<int:don_id>/approve', methods=['POST'])
-@employee_required
-def approve_donation(don_id):
-    data = request.json
-    conn = get_db_connection()
-    cur = conn.cursor()
-    try:
-        cur.execute("""
-            INSERT INTO products (product_name, category, description, donator_username, status)
-            VALUES (%s, %s, %s, %s, 'available')
-        """, (data['product_name'], data['category'], data['description'], data['donator_username']))
-        
-        cur.execute("UPDATE donation_requests SET status = 'approved' WHERE id = %s", (don_id,))
-        
-        conn.commit()
-        return jsonify({"message": "Donation converted to product"}), 201
-    except Exception as e:
-        conn.rollback()
-        return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
-
-# --- Early Return ---
-@app.route('/api/return', methods=['POST'])
-@token_required
-def return_product():
-    data = request.json
-    borrow_id = data.get('borrow_id')
-    user_id = request.user_data['user_id']
-
-    conn = get_db_connection()
-    cur = conn.cursor()
-    try:
-        # Verify the borrow request belongs to the user and is currently active (approved)
-        cur.execute("SELECT product_id FROM borrow_requests WHERE id = %s AND user_id = %s AND status = 'approved'", (borrow_id, user_id))
-        result = cur.fetchone()
-
-        if not result:
-            return jsonify({"message": "Borrow request not found or not active."}), 404
-
-        product_id = result[0]
-
-        # 1. Mark the request as 'returned' (Historical record)
-        cur.execute("UPDATE borrow_requests SET status = 'returned' WHERE id = %s", (borrow_id,))
-
-        # 2. Mark the product as 'available' in the catalog
-        cur.execute("UPDATE products SET status = 'available' WHERE id = %s", (product_id,))
-
-        conn.commit()
-        return jsonify({"message": "Product returned successfully"}), 200
-    except Exception as e:
-        conn.rollback()
-        return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
-
-# --- EXTENSION Requests ---
-
-@app.route('/api/extensions', methods=['POST'])
-@token_required
-def request_extension():
-    data = request.json
-    borrow_id = data.get('borrow_id')
-    new_date = data.get('new_returned_date')
-    
-    conn = get_db_connection()
-    cur = conn.cursor()
-    try:
-        # Check if an extension request is already pending for this loan.
-        cur.execute("SELECT id FROM extension_requests WHERE borrow_id = %s AND status = 'extension_pending'", (borrow_id,))
-        if cur.fetchone():
-            return jsonify({"message": "כבר קיימת בקשת הארכה ממתינה עבור מוצר זה."}), 400
-
-        cur.execute("""
-            INSERT INTO extension_requests (borrow_id, new_returned_date)
-            VALUES (%s, %s)
-        """, (borrow_id, new_date))
-        
-        conn.commit()
-        return jsonify({"message": "בקשת ההארכה נשלחה בהצלחה! ממתין לאישור עובד."}), 201
-    except Exception as e:
-        conn.rollback()
-        return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
-
-# List extension requests
-@app.route('/api/employee/extensions', methods=['GET'])
-@employee_required
-def get_extension_requests():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    sql = """
-        SELECT er.id, u.username, p.product_name, br.returned_date, er.new_returned_date
-        FROM extension_requests er
-        JOIN borrow_requests br ON er.borrow_id = br.id
-        JOIN personnal_infos u ON br.user_id = u.id
-        JOIN products p ON br.product_id = p.id
-        WHERE er.status = 'extension_pending'
-    """
-    cur.execute(sql)
-    results = cur.fetchall()
-    extensions = [{
-        'id': r[0],
-        'username': r[1],
-        'product_name': r[2],
-        'current_return_date': str(r[3]),
-        'new_return_date': str(r[4])
-    } for r in results]
-    conn.close()
-    return jsonify(extensions), 200
-
-#  Approve or Reject the extension
-@app.route('/api/employee/extensions/<int:ext_id>', methods=['PUT'])
-@employee_required
-def update_extension_status(ext_id):
-    data = request.json
-    status = data.get('status') # 'approved' or 'rejected'
-    
-    new_status = f"extension_{status}" # Transforme en 'extension_approved' ou 'extension_rejected' -- decision---
-    
-    conn = get_db_connection()
-    cur = conn.cursor()
-    try:
-        if status == 'approved':
-            cur.execute("SELECT borrow_id, new_returned_date FROM extension_requests WHERE id = %s", (ext_id,))
-            res = cur.fetchone()
-            if res:
-                borrow_id, new_date = res
-                cur.execute("UPDATE borrow_requests SET returned_date = %s WHERE id = %s", (new_date, borrow_id))
-        
-        cur.execute("UPDATE extension_requests SET status = %s WHERE id = %s", (new_status, ext_id))
-        
-        conn.commit()
-        return jsonify({"message": f"Extension status updated to {new_status}"}), 200
-    except Exception as e:
-        conn.rollback()
-        return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
-
-# --- ADMIN ROUTES (Manage Users) ---
-@app.route('/api/admin/users', methods=['GET', 'OPTIONS'])
-@admin_required
-def get_all_users():
-    if request.method == 'OPTIONS': return jsonify({}), 200
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id, full_name, username, phone_number, email, role FROM personnal_infos ORDER BY id;")
-    users = [dict(zip(['id', 'full_name', 'username', 'phone_number', 'email', 'role'], r)) for r in cur.fetchall()]
-    conn.close()
-    return jsonify(users), 200
-
-@app.route('/api/admin/users/<int:user_id>/role', methods=['PUT', 'OPTIONS'])
-@admin_required
-def update_user_role(user_id):
-    if request.method == 'OPTIONS': return jsonify({}), 200
-    new_role = request.json.get('role')
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("UPDATE personnal_infos SET role = %s WHERE id = %s;", (new_role, user_id))
-    conn.commit()
-    conn.close()
-    return jsonify({"message": "Role updated"}), 200
-
-@app.route('/api/admin/users/<int:user_id>', methods=['DELETE', 'OPTIONS'])
-@admin_required
-def delete_user(user_id):
-    if request.method == 'OPTIONS': return jsonify({}), 200
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM personnal_infos WHERE id = %s;", (user_id,))
-    conn.commit()
-    conn.close()
-    return jsonify({"message": "User deleted"}), 200
-
-# --- SETTINGS & LIMITS ROUTES ---
-@app.route('/api/config', methods=['GET'])
-def get_config():
-    """Returns the system settings (max days, max items)."""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT setting_key, setting_value FROM system_settings;")
-    rows = cur.fetchall()
-    conn.close()
-    
-    settings = {row[0]: row[1] for row in rows}
-    # Provide defaults if missing
-    return jsonify({
-        "max_borrow_days": int(settings.get('max_borrow_days', 14)),
-        "max_borrow_items": int(settings.get('max_borrow_items', 3))
-    }), 200
-
-@app.route('/api/admin/config', methods=['POST'])
-@admin_required
-def update_config():
-    """Updates system settings."""
-    data = request.json
-    max_days = data.get('max_borrow_days')
-    max_items = data.get('max_borrow_items')
-    
-    conn = get_db_connection()
-    cur = conn.cursor()
-    try:
-        # Upsert logic (Update if exists, Insert if not)
-        cur.execute("INSERT INTO system_settings (setting_key, setting_value) VALUES ('max_borrow_days', %s) ON CONFLICT (setting_key) DO UPDATE SET setting_value = EXCLUDED.setting_value;", (max_days,))
-        cur.execute("INSERT INTO system_settings (setting_key, setting_value) VALUES ('max_borrow_items', %s) ON CONFLICT (setting_key) DO UPDATE SET setting_value = EXCLUDED.setting_value;", (max_items,))
-        conn.commit()
-        return jsonify({"message": "Settings updated successfully"}), 200
-    except Exception as e:
-        conn.rollback()
-        return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
-
-@app.route('/api/borrow-status', methods=['GET'])
-@token_required
-def get_borrow_status():
-    """Checks how many items the user has currently borrowed vs the limit."""
-    user_id = request.user_data['user_id']
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    # Get Limits
-    cur.execute("SELECT setting_key, setting_value FROM system_settings;")
-    rows = cur.fetchall()
-    settings = {row[0]: row[1] for row in rows}
-    max_items = int(settings.get('max_borrow_items', 3))
-    max_days = int(settings.get('max_borrow_days', 14))
-
-    # Count active requests (pending or approved)
-    cur.execute("SELECT COUNT(*) FROM borrow_requests WHERE user_id = %s AND status IN ('pending', 'approved', 'confirmation_pending')", (user_id,))
-    current_count = cur.fetchone()[0]
-    
-    conn.close()
-    
-    return jsonify({
-        "current_borrowed": current_count,
-        "max_items": max_items,
-        "remaining_slots": max_items - current_count,
-        "max_days": max_days
-    }), 200
-
-if __name__ == '__main__':
-    # Reads the string "True" or "False" from .env and converts to boolean
-    debug_mode = os.getenv("FLASK_DEBUG", "False").lower() in ('true', '1', 't')
-
-
-    app.run(debug=debug_mode, port=5230, host='0.0.0.0')
-
+import os
+import jwt
+import gzip
+import json
+import time
+import queue
+import random
+import select
+import signal
+import socket
+import smtplib
+import base64
+import hashlib
+import mimetypes
+import tempfile
+import threading
+import psycopg2
+import psycopg2.pool
+import psycopg2.extensions
+import psycopg2.errors
+import bcrypt
+import click
+from flask import Flask, request, jsonify, Response, make_response, g, has_app_context, send_from_directory
+from flask_cors import CORS
+from dotenv import load_dotenv
+from email.message import EmailMessage
+from datetime import datetime, date, timedelta
+from functools import wraps
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+app = Flask(__name__)
+
+load_dotenv()
+
+# The frontend is served from GitHub Pages (and from this app itself, same origin). Browsers send a preflight
+# before every call carrying the Authorization header; it is answered before routing (no auth, no database)
+# and cached by the browser for CORS_MAX_AGE seconds, so each dashboard action costs one request, not two.
+# The pages call the deployed API, so the local dev server's origin must be allowed there too.
+DEV_SERVER_PORT = 5230
+CORS_ALLOWED_ORIGINS = [o.strip() for o in os.getenv("CORS_ALLOWED_ORIGINS", f"https://dandanseb.github.io,http://localhost:{DEV_SERVER_PORT},http://127.0.0.1:{DEV_SERVER_PORT}").split(',') if o.strip()]
+CORS_MAX_AGE = int(os.getenv("CORS_MAX_AGE", 86400))
+CORS(app, origins=CORS_ALLOWED_ORIGINS, max_age=CORS_MAX_AGE)
+
+@app.before_request
+def answer_preflight():
+    if request.method == 'OPTIONS':
+        return Response(status=204)  # flask-cors adds the Access-Control-* headers for allowed origins
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+# Checked on first use (and by /readyz) rather than at import, so a misconfigured instance still
+# starts and reports itself not ready instead of crash-looping.
+JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY")
+JWT_ALGORITHM = "HS256"
+
+def jwt_secret():
+    if not JWT_SECRET_KEY:  # Forces you to have a secure key in .env. Fails safely if missing.
+        raise ValueError("No JWT_SECRET_KEY set for Flask application")
+    return JWT_SECRET_KEY
+
+# --- DB Helper ---
+# Connections are kept open in a per-process pool. Routes still call conn.close() when they
+# are done; for a pooled connection that rolls back anything left open and hands it back.
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", 10))
+# A slow or unreachable database must not hold every worker: connecting and each statement are bounded.
+# Routes that need another limit use @statement_timeout(ms).
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", 5))  # seconds
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", 5000))  # 0 leaves the server default (for poolers refusing startup options)
+DB_SESSION_OPTIONS = {'options': f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"} if DB_STATEMENT_TIMEOUT_MS else {}
+
+class DatabaseUnavailable(Exception):
+    """Raised by get_db_connection when no connection can be had; answered with a 503 (see db_unavailable)."""
+
+# Errors that mean the database, not the request, failed. Routes with a catch-all handler re-raise them
+# (`except DB_ERRORS: raise`) so @retry_reads retries them and db_unavailable answers a 503.
+DB_ERRORS = (DatabaseUnavailable, psycopg2.OperationalError, psycopg2.InterfaceError)
+
+class CircuitBreaker:
+    """Stops sending work to the database after `failure_threshold` consecutive failures. While open every
+    call fails fast; after `reset_timeout` seconds one trial connection is let through, and its outcome closes
+    or re-opens the circuit. Outcomes are recorded per connection, so threads and CLI commands outside a
+    request count the same as routes."""
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Returns (allowed, trial). The caller given the trial must call end_trial() once it is decided."""
+        with self._lock:
+            if self.opened_at is None:
+                return True, False
+            if self.trial_running or time.monotonic() - self.opened_at < self.reset_timeout:
+                return False, False
+            self.trial_running = True
+            return True, True
+
+    def end_trial(self):
+        """Lets the next trial through if this one ended without recording an outcome (e.g. pool exhausted)."""
+        with self._lock:
+            self.trial_running = False
+
+    def is_open(self):
+        return self.opened_at is not None
+
+    def retry_after(self):
+        """Seconds until the next trial request, for the Retry-After header."""
+        if self.opened_at is None:
+            return 1
+        return max(1, int(self.reset_timeout - (time.monotonic() - self.opened_at)) + 1)
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    print(f"Database circuit opened after {self.failures} failures")
+                self.opened_at = time.monotonic()
+            self.trial_running = False
+
+db_breaker = CircuitBreaker(int(os.getenv("DB_BREAKER_FAILURES", 5)), int(os.getenv("DB_BREAKER_RESET_SECONDS", 30)))
+
+def note_db_failure():
+    """Counts a database failure towards the breaker, once per request however many connections it broke."""
+    if has_app_context():
+        if g.get('db_failed'):
+            return
+        g.db_failed = True
+    db_breaker.record_failure()
+
+class AppConnection(psycopg2.extensions.connection):
+    """psycopg2 connection that remembers which named statements its server session has PREPAREd."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+class PooledConnection:
+    def __init__(self, db_pool, conn):
+        self._pool = db_pool
+        self._conn = conn
+        self.timeout_overridden = False
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        broken = conn.closed != 0
+        if not broken:
+            try:
+                conn.rollback()
+                if self.timeout_overridden:
+                    set_statement_timeout(conn, None)
+            except Exception:
+                broken = True
+        if broken:
+            note_db_failure()
+        elif not db_breaker.is_open() and not (has_app_context() and g.get('db_failed')):
+            db_breaker.record_success()  # resets the consecutive failures; only a trial closes an open circuit
+        self._pool.putconn(conn, close=broken)
+
+_db_pool = None
+_db_pool_pid = None
+_db_pool_lock = threading.Lock()
+
+def get_db_pool():
+    """Creates the pool lazily, and again after a fork, so gunicorn workers never share sockets."""
+    global _db_pool, _db_pool_pid
+    if _db_pool is None or _db_pool_pid != os.getpid():
+        with _db_pool_lock:
+            if _db_pool is None or _db_pool_pid != os.getpid():
+                _db_pool = psycopg2.pool.ThreadedConnectionPool(
+                    DB_POOL_MIN, DB_POOL_MAX, DATABASE_URL, sslmode='require', connection_factory=AppConnection,
+                    connect_timeout=DB_CONNECT_TIMEOUT, **DB_SESSION_OPTIONS)
+                _db_pool_pid = os.getpid()
+    return _db_pool
+
+def set_statement_timeout(conn, timeout_ms):
+    """Session-level statement_timeout (None restores DB_STATEMENT_TIMEOUT_MS), outside any transaction so a rollback keeps it."""
+    conn.autocommit = True
+    try:
+        cur = conn.cursor()
+        if timeout_ms is None:
+            cur.execute("RESET statement_timeout;")
+        else:
+            cur.execute("SELECT set_config('statement_timeout', %s, false);", (str(timeout_ms),))
+    finally:
+        conn.autocommit = False
+
+def get_db_connection():
+    """A pooled connection. Raises DatabaseUnavailable (a 503 for routes) when the circuit is open or connecting fails.
+    The half-open trial pings the database right away, so its outcome never depends on how the caller ends."""
+    allowed, trial = db_breaker.allow()
+    if not allowed:
+        raise DatabaseUnavailable("circuit open")
+    try:
+        db_pool = get_db_pool()
+        conn = db_pool.getconn()
+        if conn.closed:
+            db_pool.putconn(conn, close=True)
+            conn = db_pool.getconn()
+        if trial:
+            try:
+                conn.cursor().execute("SELECT 1;")
+                conn.rollback()
+            except Exception:
+                db_pool.putconn(conn, close=True)
+                raise
+            db_breaker.record_success()
+    except psycopg2.pool.PoolError as e:
+        # Every connection is in use: the database is busy, not down
+        raise DatabaseUnavailable(str(e))
+    except Exception as e:
+        print(f"DB Connection Error: {e}")
+        note_db_failure()
+        raise DatabaseUnavailable(str(e))
+    finally:
+        if trial:
+            db_breaker.end_trial()
+
+    pooled = PooledConnection(db_pool, conn)
+    if has_app_context():
+        g.setdefault('db_connections', []).append(pooled)
+        timeout_ms = g.get('statement_timeout_ms')
+        if timeout_ms is not None:
+            try:
+                set_statement_timeout(conn, timeout_ms)
+                pooled.timeout_overridden = True
+            except Exception as e:
+                pooled.close()
+                raise DatabaseUnavailable(str(e))
+    return pooled
+
+@app.teardown_appcontext
+def release_db_connections(exc):
+    # Routes that raise before reaching conn.close() must not leak their connection out of the pool
+    for conn in g.pop('db_connections', []):
+        conn.close()
+
+@app.errorhandler(DatabaseUnavailable)
+@app.errorhandler(psycopg2.OperationalError)
+@app.errorhandler(psycopg2.InterfaceError)
+def db_unavailable(e):
+    """Connection lost, statement timeout or open circuit: a retryable 503 instead of a 500 stack trace."""
+    if isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+        note_db_failure()
+    print(f"Database unavailable: {e}")
+    response = jsonify({"message": "Database temporarily unavailable, please retry"})
+    response.headers['Retry-After'] = str(db_breaker.retry_after())
+    return response, 503
+
+def statement_timeout(timeout_ms):
+    """Route (or CLI command) decorator: runs its statements under another statement_timeout. 0 disables it."""
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            g.statement_timeout_ms = timeout_ms
+            return f(*args, **kwargs)
+        return decorated
+    return decorator
+
+# Read-only routes can safely run again when the connection drops (failover, idle connection killed by a
+# proxy). Retries back off exponentially with full jitter, so workers don't reconnect in lockstep. A statement
+# timeout is not retried: the query would only be slow again.
+DB_READ_RETRIES = int(os.getenv("DB_READ_RETRIES", 2))
+DB_RETRY_BASE_DELAY = 0.1  # seconds
+
+def retry_reads(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        for attempt in range(DB_READ_RETRIES + 1):
+            try:
+                return f(*args, **kwargs)
+            except DB_ERRORS as e:
+                if attempt == DB_READ_RETRIES or isinstance(e, psycopg2.errors.QueryCanceled) or db_breaker.is_open():
+                    raise
+                for conn in g.pop('db_connections', []):
+                    conn.close()  # a dropped connection is discarded (and counted by the breaker) here
+                time.sleep(random.uniform(0, DB_RETRY_BASE_DELAY * 2 ** attempt))
+    return decorated
+
+# Hot queries, PREPAREd once per pooled connection and then run with EXECUTE, so Postgres skips
+# parsing and, once it settles on a generic plan, planning. Placeholders are psycopg2 style (%s).
+# Set DB_PREPARED_STATEMENTS=false when DATABASE_URL points at a transaction-mode pooler.
+USE_PREPARED_STATEMENTS = os.getenv("DB_PREPARED_STATEMENTS", "true").lower() in ('true', '1', 't')
+
+ACTIVE_BORROW_STATUSES = "('pending', 'approved', 'confirmation_pending')"
+CLOSED_BORROW_STATUSES = "('returned', 'rejected')"
+ALL_BORROW_STATUSES = "('pending', 'approved', 'confirmation_pending', 'returned', 'rejected')"
+
+MY_REQUESTS_LIVE = """
+        SELECT br.id, p.product_name, br.request_date, br.status, br.returned_date, br.start_date
+        FROM borrow_requests br
+        JOIN products p ON br.product_id = p.id
+        WHERE br.user_id = %s AND br.status IN {statuses} AND (br.request_date, br.id) < (%s, %s)
+        ORDER BY br.request_date DESC, br.id DESC LIMIT %s
+"""
+MY_REQUESTS_ARCHIVE = """
+        SELECT a.id, p.product_name, a.request_date, a.status, a.returned_date, a.start_date
+        FROM borrow_requests_archive a
+        JOIN products p ON a.product_id = p.id
+        WHERE a.user_id = %s AND (a.request_date, a.id) < (%s, %s)
+        ORDER BY a.request_date DESC, a.id DESC LIMIT %s
+"""
+
+PREPARED_STATEMENTS = {
+    # Params: branch_id
+    'system_settings': "SELECT setting_key, setting_value FROM system_settings WHERE branch_id = %s",
+    # Params: user_id, branch_id (the quota is per branch)
+    'borrow_quota_count': "SELECT COUNT(*) FROM borrow_requests WHERE user_id = %s AND branch_id = %s AND status IN ('pending', 'approved', 'confirmation_pending')",
+    'product_status': "SELECT status, branch_id FROM products WHERE id = %s",
+    # Keyset pages of a user's requests, newest first. Params: user_id, cursor date, cursor id, limit
+    # (the archive half of the UNION repeats them, then the outer limit).
+    'my_requests_active': MY_REQUESTS_LIVE.format(statuses=ACTIVE_BORROW_STATUSES),
+    'my_requests_history': f"""
+        ({MY_REQUESTS_LIVE.format(statuses=CLOSED_BORROW_STATUSES)})
+        UNION ALL ({MY_REQUESTS_ARCHIVE})
+        ORDER BY 3 DESC, 1 DESC LIMIT %s
+    """,
+    'my_requests_all': f"""
+        ({MY_REQUESTS_LIVE.format(statuses=ALL_BORROW_STATUSES)})
+        UNION ALL ({MY_REQUESTS_ARCHIVE})
+        ORDER BY 3 DESC, 1 DESC LIMIT %s
+    """,
+    'pending_borrow_requests': """
+        SELECT br.id, u.username, p.product_name, br.status, br.request_date, br.returned_date
+        FROM borrow_requests br
+        JOIN personnal_infos u ON br.user_id = u.id
+        JOIN products p ON br.product_id = p.id
+        WHERE br.branch_id = %s AND br.status = 'pending'
+    """,
+    'pending_extension_requests': """
+        SELECT er.id, u.username, p.product_name, br.returned_date, er.new_returned_date
+        FROM extension_requests er
+        JOIN borrow_requests br ON er.borrow_id = br.id
+        JOIN personnal_infos u ON br.user_id = u.id
+        JOIN products p ON br.product_id = p.id
+        WHERE er.status = 'extension_pending' AND br.branch_id = %s
+    """,
+}
+
+def numbered_placeholders(sql):
+    """Rewrites psycopg2 %s placeholders as the $1, $2... that PREPARE expects."""
+    parts = sql.split('%s')
+    return parts[0] + ''.join(f"${i}{part}" for i, part in enumerate(parts[1:], start=1))
+
+def prepare_statement(cur, name):
+    """PREPAREs a PREPARED_STATEMENTS entry on the cursor's connection, unless already done. Returns False
+    when prepared statements are disabled or the connection is not pooled."""
+    prepared = getattr(cur.connection, 'prepared', None)
+    if not USE_PREPARED_STATEMENTS or prepared is None:
+        return False
+    if name not in prepared:
+        cur.execute(f"PREPARE {name} AS {numbered_placeholders(PREPARED_STATEMENTS[name])}")
+        prepared.add(name)
+    return True
+
+def execute_prepared(cur, name, params=()):
+    """Runs a PREPARED_STATEMENTS entry by name, preparing it on this connection the first time."""
+    if not prepare_statement(cur, name):
+        cur.execute(PREPARED_STATEMENTS[name], params)
+        return
+    if params:
+        cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+    else:
+        cur.execute(f"EXECUTE {name}")
+
+# --- Catalog Snapshot ---
+# The available catalog is read far more often than it changes, so /api/products is served
+# from pre-serialized JSON bytes, published to a file shared by every gunicorn worker; each worker
+# only re-reads it when the file changes. There is one snapshot per branch.
+# Routes that change a product only bump branches.catalog_version in their own transaction and, once
+# committed, drop the branch's file; the next read rebuilds it. A rebuild stamps the snapshot with the
+# version it read under the branch row's lock, so an out-of-order rebuild never overwrites newer data
+# and concurrent readers build it once. Every CATALOG_MAX_AGE_SECONDS a worker compares its copy with
+# the database version, which picks up changes made on another instance (each has its own file).
+CATALOG_SNAPSHOT_PATH = os.getenv("CATALOG_SNAPSHOT_PATH", os.path.join(tempfile.gettempdir(), "levkatan_catalog.json"))
+CATALOG_MAX_AGE_SECONDS = int(os.getenv("CATALOG_MAX_AGE_SECONDS", 30))
+
+_catalog_snapshots = {}  # branch_id -> {'stat', 'version', 'checked_at', 'body', 'gzip', 'etag'}
+_catalog_lock = threading.Lock()
+
+def catalog_snapshot_path(branch_id):
+    root, ext = os.path.splitext(CATALOG_SNAPSHOT_PATH)
+    return f"{root}.{int(branch_id)}{ext}"
+
+def lock_catalog_version(cur, branch_id):
+    """Takes the branch row's lock (held until commit, so rebuilds and changes of a branch take turns) and
+    returns its catalog version."""
+    cur.execute("SELECT catalog_version FROM branches WHERE id = %s FOR NO KEY UPDATE;", (branch_id,))
+    return cur.fetchone()[0]
+
+def bump_catalog_version(cur, *branch_ids):
+    """Marks the branches' catalogs as changed, in the caller's transaction. Call it last, right before the
+    commit: it holds the branch rows until then. Follow the commit with drop_catalog_snapshot."""
+    for branch_id in sorted(set(branch_ids)):  # a fixed order, so two multi-branch changes can't deadlock
+        cur.execute("UPDATE branches SET catalog_version = catalog_version + 1 WHERE id = %s;", (branch_id,))
+
+def drop_catalog_snapshot(*branch_ids):
+    """Called after a product change is committed: removes the branches' snapshot files, so the next read
+    (in any worker of this instance) rebuilds them instead of waiting for CATALOG_MAX_AGE_SECONDS."""
+    for branch_id in set(branch_ids):
+        try:
+            os.remove(catalog_snapshot_path(branch_id))
+        except OSError:
+            pass
+
+def snapshot_file_version(path):
+    try:
+        with open(path, 'rb') as f:
+            return int(f.readline())
+    except (OSError, ValueError):
+        return None
+
+def rebuild_catalog_snapshot(conn, branch_id):
+    """Queries the branch's available products and publishes them as its new catalog snapshot (unless the
+    file already holds this version or a newer one). Commits the connection."""
+    cur = conn.cursor()
+    version = lock_catalog_version(cur, branch_id)
+    snapshot = load_catalog_snapshot(branch_id)
+    if snapshot is not None and snapshot['version'] == version:
+        conn.commit()  # another worker rebuilt it while this one waited for the lock
+        return snapshot
+    try:
+        cur.execute("SELECT id, product_name, category, status, description, donator_username, photo_path FROM products WHERE branch_id = %s AND status = 'available';", (branch_id,))
+        products = [{
+            'id': r[0],
+            'name': r[1],
+            'category': r[2],
+            'status': r[3],
+            'description': r[4],
+            'donator_username': r[5],
+            'photo': r[6],
+            'photo_variants': photo_variants(r[6])
+        } for r in cur.fetchall()]
+    except Exception as e:
+        print(f"Error fetching products: {e}")
+        conn.rollback()
+        version = lock_catalog_version(cur, branch_id)
+        # Fallback query if columns are missing
+        cur.execute("SELECT id, product_name, category, status FROM products WHERE branch_id = %s AND status = 'available';", (branch_id,))
+        products = [{'id': r[0], 'name': r[1], 'category': r[2], 'status': r[3], 'description': '', 'donator_username': ''} for r in cur.fetchall()]
+
+    body = json.dumps(products, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    # Write then rename, so other workers never read a half written file. The version goes on the first line.
+    path = catalog_snapshot_path(branch_id)
+    current = snapshot_file_version(path)
+    if current is None or current <= version:
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(f"{version}\n".encode() + body)
+        os.replace(tmp_path, path)
+    conn.commit()  # releases the branch row once the file is in place
+    # A change committed since may already have dropped the file: serve what was just built
+    return load_catalog_snapshot(branch_id) or catalog_snapshot(None, version, body)
+
+def catalog_snapshot(stat, version, body):
+    return {
+        'stat': stat,
+        'version': version,
+        'checked_at': time.monotonic(),
+        'body': body,
+        'gzip': gzip.compress(body, compresslevel=9),
+        'etag': hashlib.sha1(body).hexdigest()
+    }
+
+def load_catalog_snapshot(branch_id):
+    """Returns this worker's copy of the branch's snapshot, re-reading the shared file only if it changed
+    (inode, size or mtime: a coarse mtime alone can miss a replacement)."""
+    path = catalog_snapshot_path(branch_id)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    stat = (st.st_ino, st.st_size, st.st_mtime_ns)
+    snapshot = _catalog_snapshots.get(branch_id)
+    if snapshot is None or stat != snapshot['stat']:
+        with _catalog_lock:
+            snapshot = _catalog_snapshots.get(branch_id)
+            if snapshot is None or stat != snapshot['stat']:
+                try:
+                    with open(path, 'rb') as f:
+                        version = int(f.readline())
+                        body = f.read()
+                except (OSError, ValueError):
+                    return None  # removed meanwhile, or written by an older release: rebuilt by the caller
+                snapshot = catalog_snapshot(stat, version, body)
+                _catalog_snapshots[branch_id] = snapshot
+    return snapshot
+
+def fresh_catalog_snapshot(conn, branch_id, snapshot):
+    """The worker's snapshot if it still matches the database's catalog version, else a rebuilt one."""
+    if snapshot is not None:
+        cur = conn.cursor()
+        cur.execute("SELECT catalog_version FROM branches WHERE id = %s;", (branch_id,))
+        version = cur.fetchone()[0]
+        conn.rollback()
+        if version == snapshot['version']:
+            snapshot['checked_at'] = time.monotonic()
+            return snapshot
+        if version < snapshot['version']:
+            # The database went back (restored or recreated): the file's version no longer means anything
+            print(f"Catalog version of branch {branch_id} went back from {snapshot['version']} to {version}")
+            try:
+                os.remove(catalog_snapshot_path(branch_id))
+            except OSError:
+                pass
+    return rebuild_catalog_snapshot(conn, branch_id)
+
+def catalog_response(snapshot):
+    use_gzip = 'gzip' in request.accept_encodings
+    response = Response(snapshot['gzip'] if use_gzip else snapshot['body'], mimetype='application/json')
+    if use_gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'  # Browsers revalidate with If-None-Match and get a 304
+    response.set_etag(snapshot['etag'])
+    return response.make_conditional(request)
+
+# --- Product Photos ---
+# Uploads are streamed to UPLOAD_DIR/photos in chunks and named after their content hash
+# (photos/<hash>.<ext>). Resized variants (image_variants.py) are rendered by a process pool off the
+# request path into photos/v/<hash>/, and published with the catalog snapshot once they exist. They are only
+# scheduled once the request is over and a row refers to the photo; a photo whose insert failed is deleted.
+# On Azure App Service point UPLOAD_DIR at /home so every instance sees the same files.
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads'))
+PHOTO_DIR = os.path.join(UPLOAD_DIR, 'photos')
+MAX_PHOTO_BYTES = int(os.getenv("MAX_PHOTO_MB", 10)) * 1024 * 1024
+PHOTO_WORKERS = int(os.getenv("PHOTO_WORKERS", 1))
+PHOTO_CHUNK_SIZE = 64 * 1024
+VARIANT_FORMATS = {'avif': 'avif', 'webp': 'webp', 'png': 'png', 'jpg': 'jpeg'}
+app.config['MAX_CONTENT_LENGTH'] = MAX_PHOTO_BYTES + 64 * 1024  # the photo plus the other form fields
+
+_photo_pool = None
+_photo_pool_pid = None
+_photo_pool_lock = threading.Lock()
+
+def get_photo_pool():
+    """The thumbnail process pool, created lazily in each (forked) worker."""
+    global _photo_pool, _photo_pool_pid
+    if _photo_pool is None or _photo_pool_pid != os.getpid():
+        with _photo_pool_lock:
+            if _photo_pool is None or _photo_pool_pid != os.getpid():
+                _photo_pool = ProcessPoolExecutor(max_workers=PHOTO_WORKERS)
+                _photo_pool_pid = os.getpid()
+    return _photo_pool
+
+def discard_photo_pool(pool):
+    """Forgets a broken (a child process died) or shut down pool, so the next get_photo_pool() builds a new one."""
+    global _photo_pool
+    with _photo_pool_lock:
+        if _photo_pool is pool:
+            _photo_pool = None
+    pool.shutdown(wait=False)
+
+def request_data():
+    """Fields of a multipart/form-data request (sent when a photo is attached), otherwise the JSON body."""
+    if request.mimetype == 'multipart/form-data':
+        return request.form
+    return request.json
+
+def sniff_photo_type(head):
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'jpg'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+def save_photo(upload):
+    """Streams an uploaded photo to PHOTO_DIR. Returns (stored path 'photos/<hash>.<ext>', whether the file is
+    new), or (None, False) if it is not a PNG, JPEG or WebP image."""
+    head = upload.stream.read(12)
+    ext = sniff_photo_type(head)
+    if not ext:
+        return None, False
+
+    os.makedirs(PHOTO_DIR, exist_ok=True)
+    digest = hashlib.sha256(head)
+    with tempfile.NamedTemporaryFile(dir=PHOTO_DIR, suffix='.tmp', delete=False) as tmp:
+        tmp.write(head)
+        for chunk in iter(lambda: upload.stream.read(PHOTO_CHUNK_SIZE), b''):
+            digest.update(chunk)
+            tmp.write(chunk)
+    # Same 16 hex digits as image_variants.source_key, so the variants directory is photos/v/<name stem>
+    photo_path = f"photos/{digest.hexdigest()[:16]}.{ext}"
+    target = os.path.join(UPLOAD_DIR, photo_path)
+    created = not os.path.exists(target)  # the same picture uploaded before is shared, never deleted here
+    os.replace(tmp.name, target)
+    return photo_path, created
+
+def schedule_photo_variants(photo_path):
+    from image_variants import ensure_variants  # Pillow is only needed once a photo is uploaded
+    for attempt in range(2):
+        pool = get_photo_pool()
+        try:
+            future = pool.submit(ensure_variants, [os.path.join(UPLOAD_DIR, photo_path)], os.path.join(PHOTO_DIR, 'v'))
+            break
+        except (BrokenProcessPool, RuntimeError):  # RuntimeError: the pool was shut down
+            discard_photo_pool(pool)
+            if attempt:
+                raise
+    future.add_done_callback(publish_photo_variants)
+
+def uploaded_photo():
+    """(photo_path, error_response) for the request's optional 'photo' file."""
+    upload = request.files.get('photo')
+    if not upload or not upload.filename:
+        return None, None
+    photo_path, created = save_photo(upload)
+    if not photo_path:
+        return None, (jsonify({"message": "The photo must be a PNG, JPEG or WebP image"}), 400)
+    g.setdefault('uploaded_photos', []).append((photo_path, created))
+    return photo_path, None
+
+@app.teardown_request
+def settle_uploaded_photos(exc):
+    """Once the request is over: renders the variants of the photos a row now refers to, and deletes the new
+    files nothing refers to (failed insert, unknown product, database error). Unsure while the database is
+    down, the files are kept."""
+    uploaded = g.pop('uploaded_photos', [])
+    if not uploaded:
+        return
+    photo_paths = [photo_path for photo_path, _ in uploaded]
+    try:
+        conn = get_db_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT photo_path FROM products WHERE photo_path = ANY(%(paths)s)
+                UNION SELECT photo_path FROM donation_requests WHERE photo_path = ANY(%(paths)s);
+            """, {'paths': photo_paths})
+            used = {r[0] for r in cur.fetchall()}
+        finally:
+            conn.close()
+    except Exception as e:
+        print(f"Could not check uploaded photos: {e}")
+        used = set(photo_paths)
+    for photo_path, created in uploaded:
+        if photo_path in used:
+            try:
+                schedule_photo_variants(photo_path)
+            except Exception as e:  # the response is already decided: the photo just has no variants yet
+                print(f"Could not schedule variants of {photo_path}: {e}")
+        elif created:
+            try:
+                os.remove(os.path.join(UPLOAD_DIR, photo_path))
+            except OSError:
+                pass
+
+# Rendered variants are published (catalogs refreshed) by one thread per worker process, never in the
+# pool's result thread that runs the done-callbacks.
+_photo_publish_queue = queue.Queue()
+_photo_publisher_pid = None
+
+def publish_photo_variants(future):
+    """Done-callback of a variants job: hands the rendered photos over to the publisher thread."""
+    global _photo_publisher_pid
+    if future.exception():
+        print(f"Photo variants failed: {future.exception()}")
+        return
+    with _photo_pool_lock:
+        if _photo_publisher_pid != os.getpid():
+            threading.Thread(target=photo_publisher, name="photo-publisher", daemon=True).start()
+            _photo_publisher_pid = os.getpid()
+    _photo_publish_queue.put([os.path.relpath(source, UPLOAD_DIR).replace(os.sep, '/') for source in future.result()])
+
+def photo_publisher():
+    """Refreshes the catalogs showing each batch of newly rendered photos, so their variants are used."""
+    while True:
+        photo_paths = _photo_publish_queue.get()
+        try:
+            conn = get_db_connection()
+            try:
+                cur = conn.cursor()
+                cur.execute("SELECT DISTINCT branch_id FROM products WHERE photo_path = ANY(%s);", (photo_paths,))
+                branch_ids = [r[0] for r in cur.fetchall()]
+                bump_catalog_version(cur, *branch_ids)
+                conn.commit()
+                drop_catalog_snapshot(*branch_ids)
+            finally:
+                conn.close()
+        except Exception as e:
+            print(f"Catalog not refreshed for new photo variants: {e}")
+
+def photo_variants(photo_path):
+    """Variants rendered so far for a stored photo: {format: [[width, path]]}, smallest first."""
+    if not photo_path:
+        return {}
+    key = os.path.splitext(os.path.basename(photo_path))[0]
+    try:
+        names = os.listdir(os.path.join(PHOTO_DIR, 'v', key))
+    except OSError:
+        return {}
+    variants = {}
+    for name in names:
+        parts = name.split('.')
+        if len(parts) != 2 or parts[1] not in VARIANT_FORMATS:
+            continue  # a variant still being written
+        variants.setdefault(VARIANT_FORMATS[parts[1]], []).append([int(parts[0]), f"photos/v/{key}/{name}"])
+    for entries in variants.values():
+        entries.sort()
+    return variants
+
+# --- Statistics Rollups ---
+# /api/admin/stats reads small rollup tables that are updated in the same transaction as each
+# borrow request status change, instead of aggregating borrow_requests on every read.
+# `flask --app app backfill-stats` rebuilds them from the whole history.
+ROLLUP_COLUMNS = {'pending': 'requested', 'approved': 'approved', 'rejected': 'rejected', 'returned': 'returned'}
+
+def record_borrow_transition(cur, borrow_id, new_status):
+    """Applies one borrow request status change to the rollups. They count events, like backfill-stats: a
+    loan approved then rejected counts once in each column, so the status it leaves needs no correction."""
+    column = ROLLUP_COLUMNS.get(new_status)
+    if column:
+        # Approval latency (request_date -> now) is summed per day/category, averaged on read
+        approved = new_status == 'approved'
+        cur.execute(f"""
+            INSERT INTO stats_daily_loans (day, category, {column}, approval_latency_seconds, approval_latency_samples)
+            SELECT CURRENT_DATE, p.category, 1,
+                   CASE WHEN %s THEN GREATEST(EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - br.request_date), 0)::bigint ELSE 0 END,
+                   CASE WHEN %s THEN 1 ELSE 0 END
+            FROM borrow_requests br JOIN products p ON br.product_id = p.id
+            WHERE br.id = %s
+            ON CONFLICT (day, category) DO UPDATE SET
+                {column} = stats_daily_loans.{column} + 1,
+                approval_latency_seconds = stats_daily_loans.approval_latency_seconds + EXCLUDED.approval_latency_seconds,
+                approval_latency_samples = stats_daily_loans.approval_latency_samples + EXCLUDED.approval_latency_samples;
+        """, (approved, approved, borrow_id))
+
+    if new_status == 'approved':
+        cur.execute("""
+            INSERT INTO stats_product_utilization (product_id, loans, last_borrowed_at)
+            SELECT product_id, 1, CURRENT_TIMESTAMP FROM borrow_requests WHERE id = %s
+            ON CONFLICT (product_id) DO UPDATE SET
+                loans = stats_product_utilization.loans + 1,
+                last_borrowed_at = EXCLUDED.last_borrowed_at;
+        """, (borrow_id,))
+    elif new_status == 'returned':
+        cur.execute("""
+            INSERT INTO stats_product_utilization (product_id, borrowed_days)
+            SELECT product_id, GREATEST(CURRENT_DATE - COALESCE(approved_at, request_date)::date, 0)
+            FROM borrow_requests WHERE id = %s
+            ON CONFLICT (product_id) DO UPDATE SET
+                borrowed_days = stats_product_utilization.borrowed_days + EXCLUDED.borrowed_days;
+        """, (borrow_id,))
+
+# --- Background Jobs ---
+# Slow follow-up work (e-mails, ...) leaves the request path: a route calls enqueue_job() in its own
+# transaction, so the job exists exactly when the change it follows is committed, and returns at once.
+# `flask --app app work-jobs` (started next to gunicorn by gunicorn.conf.py) runs them: each queue gets
+# JOB_CONCURRENCY threads per worker process, which claim one job at a time with FOR UPDATE SKIP LOCKED.
+# A failed job is retried with exponential backoff until max_attempts; a job whose worker died is
+# claimed again once JOB_LEASE_SECONDS have passed, so handlers must be safe to run twice.
+JOB_CONCURRENCY = {name: int(n) for name, n in (item.split('=') for item in os.getenv("JOB_CONCURRENCY", "default=2,email=1").split(',') if item)}
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", 2))
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", 300))
+JOB_BACKOFF_SECONDS = int(os.getenv("JOB_BACKOFF_SECONDS", 30))  # first retry; doubles with each attempt
+JOB_BACKOFF_MAX_SECONDS = 6 * 3600
+JOB_RETENTION_DAYS = int(os.getenv("JOB_RETENTION_DAYS", 7))
+
+_job_handlers = {}  # kind -> (function(payload), queue)
+
+def job_handler(kind, queue='default'):
+    """Registers the decorated function(payload) as the handler of `kind` jobs, run on `queue`."""
+    def register(f):
+        _job_handlers[kind] = (f, queue)
+        return f
+    return register
+
+def enqueue_job(cur, kind, payload=None, delay=None, max_attempts=5):
+    """Queues a job in the caller's transaction. Returns its id."""
+    cur.execute("""
+        INSERT INTO jobs (queue, kind, payload, run_at, max_attempts)
+        VALUES (%s, %s, %s, CURRENT_TIMESTAMP + %s, %s) RETURNING id;
+    """, (_job_handlers[kind][1], kind, json.dumps(payload or {}), delay or timedelta(0), max_attempts))
+    return cur.fetchone()[0]
+
+def claim_job(queue, worker_id):
+    """Takes the oldest due job of the queue (skipping those other workers hold). Returns (id, kind, payload,
+    attempts, max_attempts) or None."""
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE jobs SET status = 'running', attempts = attempts + 1, locked_at = CURRENT_TIMESTAMP, locked_by = %s
+            WHERE id = (
+                SELECT id FROM jobs WHERE queue = %s AND status = 'queued' AND run_at <= CURRENT_TIMESTAMP
+                ORDER BY run_at, id LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, kind, payload, attempts, max_attempts;
+        """, (worker_id, queue))
+        job = cur.fetchone()
+        conn.commit()
+        return job
+    finally:
+        conn.close()
+
+def finish_job(job_id, attempts, max_attempts, error=None):
+    """Marks the job done, or schedules its retry (failed for good after max_attempts)."""
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        if error is None:
+            cur.execute("UPDATE jobs SET status = 'done', finished_at = CURRENT_TIMESTAMP, last_error = NULL WHERE id = %s;", (job_id,))
+        elif attempts >= max_attempts:
+            cur.execute("UPDATE jobs SET status = 'failed', finished_at = CURRENT_TIMESTAMP, last_error = %s WHERE id = %s;", (error, job_id))
+        else:
+            delay = min(JOB_BACKOFF_MAX_SECONDS, JOB_BACKOFF_SECONDS * 2 ** (attempts - 1)) * random.uniform(0.5, 1)
+            cur.execute("""
+                UPDATE jobs SET status = 'queued', run_at = CURRENT_TIMESTAMP + make_interval(secs => %s), locked_at = NULL, last_error = %s
+                WHERE id = %s;
+            """, (delay, error, job_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+def requeue_stale_jobs():
+    """Gives back the jobs of workers that died mid-job (running for longer than JOB_LEASE_SECONDS)."""
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE jobs SET status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'queued' END,
+                locked_at = NULL, last_error = 'lease expired', finished_at = CASE WHEN attempts >= max_attempts THEN CURRENT_TIMESTAMP END
+            WHERE status = 'running' AND locked_at < CURRENT_TIMESTAMP - make_interval(secs => %s);
+        """, (JOB_LEASE_SECONDS,))
+        conn.commit()
+        return cur.rowcount
+    finally:
+        conn.close()
+
+def run_next_job(queue, worker_id):
+    """Claims and runs one job of the queue. Returns False when none was due."""
+    job = claim_job(queue, worker_id)
+    if job is None:
+        return False
+    job_id, kind, payload, attempts, max_attempts = job
+    try:
+        handler = _job_handlers[kind][0]
+        handler(payload)
+        error = None
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        print(f"Job {job_id} ({kind}) failed, attempt {attempts}/{max_attempts}: {error}")
+    finish_job(job_id, attempts, max_attempts, error)
+    return True
+
+def work_queue(queue, worker_id, stop):
+    """Worker thread: runs the queue's jobs until stop is set, polling every JOB_POLL_SECONDS when idle."""
+    while not stop.is_set():
+        try:
+            if run_next_job(queue, worker_id):
+                continue
+        except Exception as e:  # database down: the breaker fails fast, wait and try again
+            print(f"Job worker {worker_id} ({queue}): {e}")
+        stop.wait(JOB_POLL_SECONDS)
+
+# Notifications. Without SMTP_HOST the mails are only logged (development).
+SMTP_HOST = os.getenv("SMTP_HOST")
+SMTP_PORT = int(os.getenv("SMTP_PORT", 587))
+SMTP_USER = os.getenv("SMTP_USER")
+SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
+MAIL_FROM = os.getenv("MAIL_FROM", "Lev Katan <no-reply@levkatan.org>")
+
+def send_email(to, subject, body):
+    if not SMTP_HOST:
+        print(f"E-mail to {to} (SMTP_HOST not set): {subject}")
+        return
+    message = EmailMessage()
+    message['From'], message['To'], message['Subject'] = MAIL_FROM, to, subject
+    message.set_content(body)
+    with smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=30) as smtp:
+        smtp.starttls()
+        if SMTP_USER:
+            smtp.login(SMTP_USER, SMTP_PASSWORD)
+        smtp.send_message(message)
+
+@job_handler('email', queue='email')
+def email_user(payload):
+    """payload: {'user_id', 'subject', 'body'}. The address is read at sending time; a deleted user gets nothing."""
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT email FROM personnal_infos WHERE id = %s;", (payload['user_id'],))
+        row = cur.fetchone()
+    finally:
+        conn.close()
+    if row:
+        send_email(row[0], payload['subject'], payload['body'])
+
+# --- Waiting List Hand-off ---
+def hand_off_to_waitlist(cur, product_id, branch_id):
+    """Called in the transaction that frees a product (return, rejected request). Turns the first waiter
+    who still has quota left (at the product's branch) into a pending borrow request for it, so nobody has
+    to poll the catalog. Returns the user id that received the item, or None if the product stays available."""
+    execute_prepared(cur, 'system_settings', (branch_id,))
+    settings = {row[0]: row[1] for row in cur.fetchall()}
+    max_items = int(settings.get('max_borrow_items', 3))
+    max_days = int(settings.get('max_borrow_days', 14))
+
+    # The loan must end before the next reservation of the item starts
+    cur.execute(f"""
+        SELECT LEAST(CURRENT_DATE + %s, MIN(start_date) - 1) FROM borrow_requests
+        WHERE product_id = %s AND status IN {ACTIVE_BORROW_STATUSES} AND start_date > CURRENT_DATE
+    """, (max_days, product_id))
+    due_date = cur.fetchone()[0] or date.today() + timedelta(days=max_days)
+    if due_date <= date.today():
+        return None
+
+    cur.execute(f"""
+        DELETE FROM waitlist WHERE id = (
+            SELECT w.id FROM waitlist w
+            WHERE w.product_id = %s
+              AND (SELECT COUNT(*) FROM borrow_requests br
+                   WHERE br.user_id = w.user_id AND br.branch_id = %s AND br.status IN {ACTIVE_BORROW_STATUSES}) < %s
+            ORDER BY w.created_at, w.id
+            LIMIT 1
+            FOR UPDATE OF w SKIP LOCKED
+        )
+        RETURNING user_id;
+    """, (product_id, branch_id, max_items))
+    waiter = cur.fetchone()
+    if not waiter:
+        return None
+
+    cur.execute("INSERT INTO borrow_requests (user_id, product_id, returned_date, branch_id) VALUES (%s, %s, %s, %s) RETURNING id",
+                (waiter[0], product_id, due_date, branch_id))
+    borrow_id = cur.fetchone()[0]
+    cur.execute("UPDATE products SET status = 'unavailable', current_borrow_id = NULL, current_borrower_username = NULL WHERE id = %s RETURNING product_name", (product_id,))
+    product_name = cur.fetchone()[0]
+    record_borrow_transition(cur, borrow_id, 'pending')
+    enqueue_job(cur, 'email', {'user_id': waiter[0], 'subject': f"הגיע תורך: {product_name}",
+                               'body': f"{product_name} שחיכית לו התפנה ונשמר עבורך עד {due_date:%d/%m/%Y}. הבקשה ממתינה לאישור הצוות."})
+    return waiter[0]
+
+def set_current_borrow(cur, product_id, borrow_id):
+    """Records on the product the loan (and borrower) holding it, or nobody with borrow_id None. Called
+    wherever an approved loan starts or ends, so the inventory listing reads products alone."""
+    cur.execute("""
+        UPDATE products SET current_borrow_id = %(borrow_id)s, current_borrower_username = (
+            SELECT u.username FROM borrow_requests br JOIN personnal_infos u ON u.id = br.user_id WHERE br.id = %(borrow_id)s)
+        WHERE id = %(product_id)s;
+    """, {'product_id': product_id, 'borrow_id': borrow_id})
+
+def release_product(cur, product_id):
+    """Called when the loan holding a product ends early (return, rejection). The product goes to the
+    reservation covering today if there is one, otherwise to the waiting list, otherwise back to the catalog."""
+    cur.execute(f"""
+        UPDATE products p
+        SET status = CASE WHEN next.id IS NULL THEN 'available' WHEN next.status = 'approved' THEN 'borrowed' ELSE 'unavailable' END,
+            current_borrow_id = CASE WHEN next.status = 'approved' THEN next.id END,
+            current_borrower_username = CASE WHEN next.status = 'approved' THEN next.username END
+        FROM (SELECT %s AS id) target
+        LEFT JOIN LATERAL (
+            SELECT br.id, br.status, u.username
+            FROM borrow_requests br JOIN personnal_infos u ON u.id = br.user_id
+            WHERE br.product_id = target.id AND br.status IN {ACTIVE_BORROW_STATUSES} AND br.loan_period @> CURRENT_DATE
+            LIMIT 1
+        ) next ON true
+        WHERE p.id = target.id
+        RETURNING p.status, p.branch_id;
+    """, (product_id,))
+    status, branch_id = cur.fetchone()
+    if status == 'available':
+        hand_off_to_waitlist(cur, product_id, branch_id)
+
+# --- Token Revocation ---
+# Tokens carry the account's token_version ('tv'). Changing a role or deleting an account bumps it,
+# stores the new minimum in token_revocations and NOTIFYs every worker. Each worker keeps the minimums
+# in memory, fed by a LISTEN thread, so the decorators check a token with one dict lookup.
+TOKEN_LIFETIME = timedelta(hours=24)
+REVOCATION_CHANNEL = 'token_revocations'
+ACCOUNT_DELETED = 2147483647  # minimum version of a deleted account: none of its tokens is valid
+# LISTEN needs a real session; point this at the direct database port when DATABASE_URL goes through a transaction pooler
+DB_LISTEN_URL = os.getenv("DB_LISTEN_URL", DATABASE_URL)
+
+_revoked_versions = {}  # user_id -> lowest token version still accepted
+_revocations_loaded = threading.Event()
+_revocation_listener_pid = None
+_revocation_listener_lock = threading.Lock()
+
+def revoke_tokens(cur, user_id, min_version):
+    """Invalidates user_id's tokens older than min_version, in every worker once the transaction commits."""
+    cur.execute("""
+        INSERT INTO token_revocations (user_id, min_version) VALUES (%s, %s)
+        ON CONFLICT (user_id) DO UPDATE SET min_version = EXCLUDED.min_version, revoked_at = CURRENT_TIMESTAMP;
+    """, (user_id, min_version))
+    cur.execute("SELECT pg_notify(%s, %s);", (REVOCATION_CHANNEL, f"{user_id}:{min_version}"))
+
+def listen_for_revocations():
+    """Worker thread: loads the recent revocations, then applies the notifications. Reconnects on error."""
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(DB_LISTEN_URL, sslmode='require')
+            conn.autocommit = True
+            cur = conn.cursor()
+            cur.execute(f"LISTEN {REVOCATION_CHANNEL};")  # before loading, so nothing is missed in between
+            # Older revocations only concern tokens that have expired anyway
+            cur.execute("SELECT user_id, min_version FROM token_revocations WHERE revoked_at > CURRENT_TIMESTAMP - %s;", (TOKEN_LIFETIME,))
+            _revoked_versions.update(cur.fetchall())
+            _revocations_loaded.set()
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    cur.execute("SELECT 1;")  # keeps idle-timeout proxies from dropping the session
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    user_id, min_version = map(int, conn.notifies.pop(0).payload.split(':'))
+                    _revoked_versions[user_id] = max(min_version, _revoked_versions.get(user_id, 0))
+        except Exception as e:
+            print(f"Token revocation listener error: {e}")
+        finally:
+            if conn is not None:
+                conn.close()
+        time.sleep(5)
+
+def ensure_revocation_listener():
+    """Starts this worker's listener on first use (after gunicorn forks) and waits briefly for its first load."""
+    global _revocation_listener_pid
+    if _revocation_listener_pid != os.getpid():
+        with _revocation_listener_lock:
+            if _revocation_listener_pid != os.getpid():
+                _revocations_loaded.clear()
+                threading.Thread(target=listen_for_revocations, name='token-revocations', daemon=True).start()
+                _revocation_listener_pid = os.getpid()
+        _revocations_loaded.wait(timeout=5)
+
+def token_revoked(data):
+    ensure_revocation_listener()
+    return data.get('tv', 0) < _revoked_versions.get(data['user_id'], 0)
+
+# --- Decorators ---
+def token_required(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        token_header = request.headers.get('Authorization')
+        if not token_header or not token_header.startswith('Bearer '):
+            return jsonify({'message': 'Token missing'}), 401
+        try:
+            token = token_header[7:]
+            data = jwt.decode(token, jwt_secret(), algorithms=[JWT_ALGORITHM])
+            request.user_data = data # Store user info for the route to use
+        except Exception:
+            return jsonify({'message': 'Invalid Token'}), 401
+        if token_revoked(data):
+            return jsonify({'message': 'Token revoked'}), 401
+        return f(*args, **kwargs)
+    return decorated
+
+def admin_required(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        token_header = request.headers.get('Authorization')
+        if not token_header: return jsonify({'message': 'Token missing'}), 401
+        try:
+            token = token_header.split(" ")[1]
+            data = jwt.decode(token, jwt_secret(), algorithms=[JWT_ALGORITHM])
+            if data['role'] != 'admin':
+                return jsonify({'message': 'Admin access required'}), 403
+            request.user_data = data
+        except Exception:
+            return jsonify({'message': 'Invalid Token'}), 401
+        if token_revoked(data):
+            return jsonify({'message': 'Token revoked'}), 401
+        return f(*args, **kwargs)
+    return decorated
+
+def employee_required(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        token_header = request.headers.get('Authorization')
+        if not token_header: return jsonify({'message': 'Token missing'}), 401
+        try:
+            token = token_header.split(" ")[1]
+            data = jwt.decode(token, jwt_secret(), algorithms=[JWT_ALGORITHM])
+            if data['role'] not in ['admin', 'employee']:
+                return jsonify({'message': 'Employee access required'}), 403
+            request.user_data = data
+        except Exception:
+            return jsonify({'message': 'Invalid Token'}), 401
+        if token_revoked(data):
+            return jsonify({'message': 'Token revoked'}), 401
+        return f(*args, **kwargs)
+    return decorated
+
+# Retried POSTs carrying the same Idempotency-Key get the stored response back instead of
+# re-running the route. Keys are scoped per user and expire after IDEMPOTENCY_TTL_HOURS. A key whose
+# request never stored an outcome (worker killed, database lost) can be claimed again after
+# IDEMPOTENCY_LOCK_SECONDS, so such a retry is not refused as "in progress" for a day.
+IDEMPOTENCY_TTL_HOURS = int(os.getenv("IDEMPOTENCY_TTL_HOURS", 24))
+IDEMPOTENCY_LOCK_SECONDS = int(os.getenv("IDEMPOTENCY_LOCK_SECONDS", 60))
+
+def release_idempotency_key(user_id, key):
+    """Forgets a claimed key, so the client's retry runs the route again."""
+    try:
+        conn = get_db_connection()
+    except DatabaseUnavailable as e:
+        print(f"Error releasing Idempotency-Key: {e}")  # the claim expires after IDEMPOTENCY_LOCK_SECONDS
+        return
+    try:
+        conn.cursor().execute("DELETE FROM idempotency_keys WHERE user_id = %s AND idempotency_key = %s AND status_code IS NULL", (user_id, key))
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        print(f"Error releasing Idempotency-Key: {e}")
+    finally:
+        conn.close()
+
+def idempotent(f):
+    """Must be applied under @token_required (needs request.user_data)."""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return f(*args, **kwargs)
+        if len(key) > 100:
+            return jsonify({'message': 'Idempotency-Key too long'}), 400
+        user_id = request.user_data['user_id']
+
+        conn = get_db_connection()
+        cur = conn.cursor()
+        try:
+            # Claim the key. The primary key makes concurrent retries race on this insert, not on the route.
+            # An expired row, or an abandoned claim, is recycled in place.
+            cur.execute("""
+                INSERT INTO idempotency_keys (user_id, idempotency_key, endpoint)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (user_id, idempotency_key) DO UPDATE
+                    SET endpoint = EXCLUDED.endpoint, status_code = NULL, response_body = NULL, created_at = CURRENT_TIMESTAMP
+                    WHERE idempotency_keys.created_at < CURRENT_TIMESTAMP - make_interval(hours => %s)
+                       OR (idempotency_keys.status_code IS NULL AND idempotency_keys.created_at < CURRENT_TIMESTAMP - make_interval(secs => %s))
+                RETURNING user_id;
+            """, (user_id, key, request.path, IDEMPOTENCY_TTL_HOURS, IDEMPOTENCY_LOCK_SECONDS))
+            claimed = cur.fetchone()
+            if not claimed:
+                cur.execute("SELECT endpoint, status_code, response_body FROM idempotency_keys WHERE user_id = %s AND idempotency_key = %s", (user_id, key))
+                stored = cur.fetchone()
+                if stored and stored[0] != request.path:
+                    return jsonify({'message': 'Idempotency-Key already used for another endpoint'}), 422
+                if not stored or stored[1] is None:
+                    return jsonify({'message': 'A request with this Idempotency-Key is still in progress'}), 409
+                replay = Response(stored[2], status=stored[1], mimetype='application/json')
+                replay.headers['Idempotent-Replayed'] = 'true'
+                return replay
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            return jsonify({"error": str(e)}), 500
+        finally:
+            conn.close()
+
+        try:
+            response = make_response(f(*args, **kwargs))
+        except Exception:
+            # Database errors (answered 503 by the error handler), bad JSON, bugs: nothing to replay
+            release_idempotency_key(user_id, key)
+            raise
+
+        # Store the outcome. Server errors release the key so the client's retry runs the route again.
+        if response.status_code >= 500:
+            release_idempotency_key(user_id, key)
+            return response
+        try:
+            conn = get_db_connection()
+        except DatabaseUnavailable as e:
+            print(f"Error storing idempotent response: {e}")  # the claim expires after IDEMPOTENCY_LOCK_SECONDS
+            return response
+        cur = conn.cursor()
+        try:
+            cur.execute("UPDATE idempotency_keys SET status_code = %s, response_body = %s WHERE user_id = %s AND idempotency_key = %s",
+                        (response.status_code, response.get_data(as_text=True), user_id, key))
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f"Error storing idempotent response: {e}")
+        finally:
+            conn.close()
+        return response
+    return decorated
+
+# --- Branches ---
+# Each lending center has its own inventory, loans, donations and limits. Employees work on their own
+# branch (the branch_id claim of their token); admins and families choose one with ?branch=<id>.
+DEFAULT_BRANCH_ID = 1  # the original center, which every pre-existing row belongs to
+
+def request_branch_id():
+    """The branch the current request works on: an employee's own branch, otherwise ?branch= (default DEFAULT_BRANCH_ID)."""
+    user_data = getattr(request, 'user_data', None) or {}
+    if user_data.get('role') == 'employee':
+        return user_data.get('branch_id') or DEFAULT_BRANCH_ID
+    return request.args.get('branch', DEFAULT_BRANCH_ID, type=int)
+
+# Known branch ids. An id missing from the set re-reads the table, at most every BRANCH_CACHE_SECONDS, so a
+# branch opened from another instance is found and garbage ids cost no query.
+BRANCH_CACHE_SECONDS = 30
+_branch_ids = set()
+_branch_ids_loaded_at = None
+
+def remember_branch_ids(branch_ids):
+    global _branch_ids, _branch_ids_loaded_at
+    _branch_ids = set(branch_ids)
+    _branch_ids_loaded_at = time.monotonic()
+
+def is_known_branch(branch_id):
+    if branch_id in _branch_ids:
+        return True
+    if _branch_ids_loaded_at is not None and time.monotonic() - _branch_ids_loaded_at < BRANCH_CACHE_SECONDS:
+        return False
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM branches;")
+        remember_branch_ids(r[0] for r in cur.fetchall())
+    finally:
+        conn.close()
+    return branch_id in _branch_ids
+
+@app.before_request
+def check_branch_param():
+    """?branch= must name an existing branch: the per-branch caches (catalog snapshot, settings) are only
+    ever created for real ones."""
+    branch_id = request.args.get('branch', type=int)
+    if branch_id is not None and not is_known_branch(branch_id):
+        return jsonify({"message": "Unknown branch"}), 404
+
+# --- AUTH ROUTES (Login/Register) ---
+@app.route('/api/register', methods=['POST'])
+def register():
+    data = request.json
+    full_name = data.get('fullName')
+    username = data.get('username')
+    phone_number = data.get('phone_number')
+    email = data.get('email')
+    passwd = data.get('password')
+    
+    # Basic validation
+    if not all([full_name, username, email, passwd]):
+        return jsonify({"message": "Missing required fields"}), 400
+
+    password_bytes = passwd.encode('utf-8')
+    hashed_password = bcrypt.hashpw(password_bytes, bcrypt.gensalt()).decode('utf-8')
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute("INSERT INTO personnal_infos (full_name, username, phone_number, email, passwd, role) VALUES (%s, %s, %s, %s, %s, 'user') RETURNING id;", (full_name, username, phone_number, email, hashed_password))
+        user_id = cur.fetchone()[0]
+        conn.commit()
+        return jsonify({"message": "Registered", "userId": user_id}), 200
+    except Exception as e:
+        conn.rollback()
+        return jsonify({"message": str(e)}), 400
+    finally:
+        conn.close()
+
+@app.route('/api/login', methods=['POST'])
+def login():
+    data = request.json
+    email = data.get('email')
+    password = data.get('password')
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT id, username, passwd, role, token_version, branch_id FROM personnal_infos WHERE email = %s", (email,))
+    user = cur.fetchone()
+    conn.close()
+    if user and bcrypt.checkpw(password.encode('utf-8'), user[2].encode('utf-8')):
+        token = jwt.encode({'user_id': user[0], 'username': user[1], 'role': user[3], 'tv': user[4], 'branch_id': user[5],
+                            'exp': datetime.utcnow() + TOKEN_LIFETIME}, jwt_secret(), algorithm=JWT_ALGORITHM)
+        return jsonify({"message": "Success", "username": user[1], "role": user[3], "branch_id": user[5], "token": token}), 200
+    return jsonify({"message": "Invalid credentials"}), 401
+
+
+# ----- USER ROUTES (Catalog / Borrowing requests / Profile / Donation requests) -----
+
+#---- PROFILE------
+@app.route('/api/user/me', methods=['GET'])
+@retry_reads
+@token_required
+def get_user_profile():
+    user_id = request.user_data['user_id']
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    try:
+        # Selects the user's personal data
+        sql = """
+            SELECT username, full_name, email, phone_number 
+            FROM personnal_infos 
+            WHERE id = %s;
+        """
+        cur.execute(sql, (user_id,))
+        user_info = cur.fetchone()
+        
+        if user_info:
+            columns = ['username', 'full_name', 'email', 'phone_number']
+            result = dict(zip(columns, user_info))
+            return jsonify(result), 200
+        else:
+            return jsonify({"message": "User profile not found"}), 404
+            
+    except DB_ERRORS:
+        raise
+    except Exception as e:
+        print(f"Error retrieving profile: {e}")
+        return jsonify({"message": "Server error"}), 500
+    finally:
+        conn.close()
+
+
+@app.route('/api/user/me', methods=['PUT'])
+@token_required
+def update_user_profile():
+    user_id = request.user_data['user_id']
+    data = request.json
+    
+    # Editable data sent by the Frontend: The username cannot be changed
+    full_name = data.get('full_name')
+    email = data.get('email')
+    phone_number = data.get('phone_number')
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    try:
+        # Mise à jour des champs modifiables.
+        sql = """
+            UPDATE personnal_infos 
+            SET full_name = %s, 
+                email = %s, 
+                phone_number = %s
+            WHERE id = %s 
+            RETURNING id;
+        """
+        cur.execute(sql, (full_name, email, phone_number, user_id))
+        
+        updated_id = cur.fetchone()
+        
+        if updated_id:
+            conn.commit()
+            return jsonify({"message": "Profil mis à jour"}), 200
+        else:
+            conn.rollback()
+            return jsonify({"message": "Profil non trouvé"}), 404
+            
+    except Exception as e:
+        conn.rollback()
+        print(f"Error updating profile: {e}")
+        return jsonify({"message": f"update error: {e}"}), 400
+    finally:
+        conn.close()
+
+#--- CATALOG ----
+@app.route('/api/products', methods=['GET'])
+@retry_reads
+@statement_timeout(2000)
+def get_products():
+    """GET /api/products?branch=<id> -- the branch's available products."""
+    branch_id = request_branch_id()
+    snapshot = load_catalog_snapshot(branch_id)
+    if snapshot is None or time.monotonic() - snapshot['checked_at'] > CATALOG_MAX_AGE_SECONDS:
+        # First read since startup or since a change dropped the file, or time to check for changes made on another
+        # instance: build it from the DB. While the DB is down, the last copy this worker loaded beats an error page.
+        try:
+            conn = get_db_connection()
+            try:
+                snapshot = fresh_catalog_snapshot(conn, branch_id, snapshot)
+            finally:
+                conn.close()
+        except (DatabaseUnavailable, psycopg2.OperationalError) as e:
+            snapshot = _catalog_snapshots.get(branch_id)
+            if snapshot is None:
+                raise
+            if isinstance(e, psycopg2.OperationalError):
+                note_db_failure()
+            print(f"Serving the last catalog snapshot: {e}")
+    return catalog_response(snapshot)
+
+
+# --- RESERVATIONS (date ranges) ---
+# Each active loan occupies borrow_requests.loan_period = [start_date, returned_date]; the
+# borrow_requests_no_overlap exclusion constraint (GiST) keeps bookings of a product disjoint and
+# serves the overlap lookups below.
+@app.route('/api/products/availability', methods=['GET'])
+@retry_reads
+@statement_timeout(2000)
+def get_available_products():
+    """GET /api/products/availability?from=YYYY-MM-DD&to=YYYY-MM-DD&branch=<id> -- the branch's products free for the whole window."""
+    try:
+        start = datetime.strptime(request.args['from'], "%Y-%m-%d").date()
+        end = datetime.strptime(request.args['to'], "%Y-%m-%d").date()
+    except (KeyError, ValueError):
+        return jsonify({"message": "from and to are required (YYYY-MM-DD)"}), 400
+    if start < date.today() or end <= start:
+        return jsonify({"message": "Invalid date range"}), 400
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        # A window starting today also needs the item on the shelf (an overdue loan has no period covering today)
+        cur.execute(f"""
+            SELECT p.id, p.product_name, p.category, p.status, p.description, p.donator_username
+            FROM products p
+            WHERE p.branch_id = %(branch)s AND (p.status = 'available' OR %(start)s > CURRENT_DATE)
+              AND NOT EXISTS (
+                SELECT 1 FROM borrow_requests br
+                WHERE br.product_id = p.id AND br.status IN {ACTIVE_BORROW_STATUSES}
+                  AND br.loan_period && daterange(%(start)s, %(end)s, '[]'))
+            ORDER BY p.id;
+        """, {'start': start, 'end': end, 'branch': request_branch_id()})
+        products = [{'id': r[0], 'name': r[1], 'category': r[2], 'status': r[3], 'description': r[4], 'donator_username': r[5]}
+                    for r in cur.fetchall()]
+        return jsonify(products), 200
+    except DB_ERRORS:
+        raise
+    except Exception as e:
+        print(f"Error fetching availability: {e}")
+        return jsonify({"message": "Server error"}), 500
+    finally:
+        conn.close()
+
+@app.route('/api/products/<int:product_id>/calendar', methods=['GET'])
+@retry_reads
+@statement_timeout(2000)
+def get_product_calendar(product_id):
+    """GET /api/products/<id>/calendar?days=60 -- booked periods and free slots from today on."""
+    days = min(max(request.args.get('days', 60, type=int), 1), 365)
+    horizon = date.today() + timedelta(days=days)
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute(f"""
+            SELECT start_date, returned_date, status FROM borrow_requests
+            WHERE product_id = %s AND status IN {ACTIVE_BORROW_STATUSES}
+              AND loan_period && daterange(CURRENT_DATE, %s, '[]')
+            ORDER BY start_date;
+        """, (product_id, horizon))
+        booked = [{'from': str(r[0]), 'to': str(r[1]) if r[1] else None, 'status': r[2]} for r in cur.fetchall()]
+
+        # Free slots = the window minus the union of the booked periods (ranges are [lower, upper) once normalised)
+        cur.execute(f"""
+            SELECT lower(slot), upper(slot) - 1
+            FROM unnest(datemultirange(daterange(CURRENT_DATE, %s, '[]')) - COALESCE(
+                (SELECT range_agg(loan_period) FROM borrow_requests
+                 WHERE product_id = %s AND status IN {ACTIVE_BORROW_STATUSES}),
+                '{{}}'::datemultirange)) AS slot
+            ORDER BY 1;
+        """, (horizon, product_id))
+        free = [{'from': str(r[0]), 'to': str(r[1])} for r in cur.fetchall()]
+        return jsonify({"product_id": product_id, "booked": booked, "free": free}), 200
+    except DB_ERRORS:
+        raise
+    except Exception as e:
+        print(f"Error fetching calendar: {e}")
+        return jsonify({"message": "Server error"}), 500
+    finally:
+        conn.close()
+
+
+@app.route('/api/borrow', methods=['POST'])
+@token_required
+@idempotent
+def borrow_product():
+    data = request.json
+    product_id = data.get('product_id')
+    returned_date_str = data.get('returned_date') # YYYY-MM-DD
+    start_date_str = data.get('start_date') # YYYY-MM-DD, optional: a future reservation
+    user_id = request.user_data['user_id']
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        # 0. The product decides the branch, whose limits apply
+        execute_prepared(cur, 'product_status', (product_id,))
+        status = cur.fetchone()
+        if not status:
+            return jsonify({"message": "Product not available", "can_join_waitlist": False}), 400
+        branch_id = status[1]
+
+        # 1. Fetch Limits
+        execute_prepared(cur, 'system_settings', (branch_id,))
+        rows = cur.fetchall()
+        settings = {row[0]: row[1] for row in rows}
+        max_items = int(settings.get('max_borrow_items', 3))
+        max_days = int(settings.get('max_borrow_days', 14))
+
+        # 2. Check User's Current Limit
+        execute_prepared(cur, 'borrow_quota_count', (user_id, branch_id))
+        current_count = cur.fetchone()[0]
+        
+        if current_count >= max_items:
+            return jsonify({"message": f"הגעת למכסת ההשאלות שלך ({max_items} פריטים)."}), 400
+
+        # 3. Validate Date
+        if not returned_date_str:
+            return jsonify({"message": "Date is required"}), 400
+            
+        return_date = datetime.strptime(returned_date_str, "%Y-%m-%d").date()
+        today = datetime.now().date()
+        start_date = datetime.strptime(start_date_str, "%Y-%m-%d").date() if start_date_str else today
+
+        if start_date < today:
+            return jsonify({"message": "תאריך ההתחלה לא יכול להיות בעבר"}), 400
+
+        if return_date <= start_date:
+            return jsonify({"message": "תאריך ההחזרה חייב להיות עתידי"}), 400
+            
+        delta = return_date - start_date
+        if delta.days > max_days:
+            return jsonify({"message": f"תקופת ההשאלה חורגת מהמותר ({max_days} ימים)."}), 400
+
+        # 4. Check Availability & Create Request
+        starts_now = start_date == today
+        if starts_now and status[0] != 'available':
+            return jsonify({"message": "Product not available", "can_join_waitlist": True}), 400
+
+        # Overlapping bookings are refused by the borrow_requests_no_overlap exclusion constraint
+        cur.execute("SAVEPOINT reserve")
+        try:
+            cur.execute("INSERT INTO borrow_requests (user_id, product_id, start_date, returned_date, branch_id) VALUES (%s, %s, %s, %s, %s) RETURNING id",
+                        (user_id, product_id, start_date, return_date, branch_id))
+        except psycopg2.errors.ExclusionViolation:
+            cur.execute("ROLLBACK TO SAVEPOINT reserve")
+            return jsonify({"message": "המוצר כבר שמור לחלק מהתאריכים האלה. בדוק את לוח הזמינות.", "can_join_waitlist": starts_now}), 409
+        borrow_id = cur.fetchone()[0]
+        if starts_now:
+            cur.execute("UPDATE products SET status = 'unavailable', current_borrow_id = NULL, current_borrower_username = NULL WHERE id = %s", (product_id,))
+        record_borrow_transition(cur, borrow_id, 'pending')
+        if starts_now:
+            bump_catalog_version(cur, branch_id)
+        
+        conn.commit()
+        if starts_now:
+            drop_catalog_snapshot(branch_id)
+        return jsonify({"message": "בקשתך נשלחה בהצלחה!"}), 200
+    except Exception as e:
+        conn.rollback()
+        return jsonify({"error": str(e)}), 500
+    finally:
+        conn.close()
+
+
+#---BORROWING REQUEST---
+# GET /api/my-requests?status=active|history|all&limit=N&cursor=...
+# Pages are keyset-paginated on (request_date, id), so every page costs the same however long the
+# account's history is. 'history' and 'all' also read borrow_requests_archive.
+MY_REQUESTS_PAGE_SIZE = 20
+
+def encode_requests_cursor(request_date, request_id):
+    return base64.urlsafe_b64encode(f"{request_date.isoformat()}|{request_id}".encode()).decode()
+
+def decode_requests_cursor(cursor):
+    if not cursor:
+        return 'infinity', 0  # (request_date, id) < ('infinity', 0) matches every row
+    request_date, request_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    return datetime.fromisoformat(request_date), int(request_id)
+
+def my_requests_page(user_id, status):
+    try:
+        cursor_date, cursor_id = decode_requests_cursor(request.args.get('cursor'))
+    except (ValueError, UnicodeDecodeError):
+        return jsonify({"message": "Invalid cursor"}), 400
+    if status not in ('active', 'history', 'all'):
+        return jsonify({"message": "status must be active, history or all"}), 400
+    limit = max(1, min(request.args.get('limit', MY_REQUESTS_PAGE_SIZE, type=int), 100))
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        # Fetch one extra row to know whether there is a next page
+        params = (user_id, cursor_date, cursor_id, limit + 1)
+        if status != 'active':
+            params = params + params + (limit + 1,)
+        execute_prepared(cur, f'my_requests_{status}', params)
+        rows = cur.fetchall()
+    except DB_ERRORS:
+        raise
+    except Exception as e:
+        print(f"Error retrieving requests: {e}")
+        return jsonify({"message": "Server error"}), 500
+    finally:
+        conn.close()
+
+    next_cursor = encode_requests_cursor(rows[limit - 1][2], rows[limit - 1][0]) if len(rows) > limit else None
+    requests = [{'id': r[0], 'product': r[1], 'date': str(r[2]), 'status': r[3], 'returned_date': str(r[4]) if r[4] else None,
+                 'start_date': str(r[5]) if r[5] else None
+    } for r in rows[:limit]]
+    return jsonify({"requests": requests, "next_cursor": next_cursor}), 200
+
+@app.route('/api/my-requests', methods=['GET'])
+@retry_reads
+@statement_timeout(2000)
+@token_required
+def get_my_requests():
+    return my_requests_page(request.user_data['user_id'], request.args.get('status', 'all'))
+
+@app.route('/api/my-requests/history', methods=['GET'])
+@retry_reads
+@statement_timeout(2000)
+@token_required
+def get_my_archived_requests():
+    """Returned and rejected loans, including the ones moved to borrow_requests_archive."""
+    return my_requests_page(request.user_data['user_id'], 'history')
+
+#---DONATION REQUEST---
+@app.route('/api/donate', methods=['POST'])
+@token_required
+@idempotent
+def request_donation():
+    data = request_data()
+    p_name = data.get('product_name')
+    cat = data.get('category')
+    desc = data.get('description')
+    username = data.get('donator_username') # Changed from donator_email
+    photo_path, error = uploaded_photo()
+    if error:
+        return error
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            INSERT INTO donation_requests (product_name, category, description, donator_username, photo_path, branch_id)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        """, (p_name, cat, desc, username, photo_path, request_branch_id()))
+        conn.commit()
+        return jsonify({"message": "Donation request submitted"}), 201
+    except Exception as e:
+        conn.rollback()
+        return jsonify({"error": str(e)}), 500
+    finally:
+        conn.close()
+
+
+#---WAITING LIST---
+@app.route('/api/waitlist', methods=['GET'])
+@retry_reads
+@token_required
+def get_my_waitlist():
+    user_id = request.user_data['user_id']
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            SELECT w.product_id, p.product_name, p.category, w.created_at,
+                   (SELECT COUNT(*) FROM waitlist ahead
+                    WHERE ahead.product_id = w.product_id AND (ahead.created_at, ahead.id) <= (w.created_at, w.id)) AS position
+            FROM waitlist w
+            JOIN products p ON w.product_id = p.id
+            WHERE w.user_id = %s ORDER BY w.created_at;
+        """, (user_id,))
+        entries = [{'product_id': r[0], 'product_name': r[1], 'category': r[2], 'joined_at': str(r[3]), 'position': r[4]} for r in cur.fetchall()]
+        return jsonify(entries), 200
+    except DB_ERRORS:
+        raise
+    except Exception as e:
+        print(f"Error retrieving waitlist: {e}")
+        return jsonify({"message": "Server error"}), 500
+    finally:
+        conn.close()
+
+@app.route('/api/waitlist', methods=['POST'])
+@token_required
+def join_waitlist():
+    product_id = request.json.get('product_id')
+    user_id = request.user_data['user_id']
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        # Locked until the commit: a return freeing the product meanwhile either waits and then hands it to
+        # this user, or has already made it available and the user is told to borrow it instead
+        cur.execute("SELECT status FROM products WHERE id = %s FOR UPDATE", (product_id,))
+        status = cur.fetchone()
+        if not status:
+            return jsonify({"message": "Product not found"}), 404
+        if status[0] == 'available':
+            return jsonify({"message": "המוצר זמין כעת, ניתן לבקש להשאיל אותו."}), 400
+        cur.execute(f"SELECT 1 FROM borrow_requests WHERE user_id = %s AND product_id = %s AND status IN {ACTIVE_BORROW_STATUSES}", (user_id, product_id))
+        if cur.fetchone():
+            return jsonify({"message": "כבר קיימת לך בקשה פעילה עבור מוצר זה."}), 400
+
+        cur.execute("INSERT INTO waitlist (product_id, user_id) VALUES (%s, %s) ON CONFLICT (product_id, user_id) DO NOTHING RETURNING id", (product_id, user_id))
+        joined = cur.fetchone()
+        conn.commit()
+        if not joined:
+            return jsonify({"message": "את/ה כבר ברשימת ההמתנה למוצר זה."}), 200
+        return jsonify({"message": "נוספת לרשימת ההמתנה! המוצר יוקצה לך אוטומטית כשיתפנה."}), 201
+    except Exception as e:
+        conn.rollback()
+        return jsonify({"error": str(e)}), 500
+    finally:
+        conn.close()
+
+@app.route('/api/waitlist/<int:product_id>', methods=['DELETE'])
+@token_required
+def leave_waitlist(product_id):
+    user_id = request.user_data['user_id']
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute("DELETE FROM waitlist WHERE product_id = %s AND user_id = %s RETURNING id", (product_id, user_id))
+        left = cur.fetchone()
+        conn.commit()
+        if not left:
+            return jsonify({"message": "Not on the waiting list"}), 404
+        return jsonify({"message": "הוסרת מרשימת ההמתנה"}), 200
+    except Exception as e:
+        conn.rollback()
+        return jsonify({"error": str(e)}), 500
+    finally:
+        conn.close()
+
+
+# --- EMPLOYEE ROUTES (Manage Products - CRUD) ---
+
+@app.route('/api/employee/products', methods=['POST'])
+@employee_required
+def create_product():
+    
+    data = request_data()
+    product_name = data.get('product_name')
+    category = data.get('category')
+    description = data.get('description')
+    donator_username = data.get('donator_username') # Changed
+    photo_path, error = uploaded_photo()
+    if error:
+        return error
+
+    conn = get_db_connection()
+
+    cur = conn.cursor()
+
+    branch_id = request_branch_id()
+    try:
+        sql = """
+            INSERT INTO products 
+            (product_name, category, description, donator_username, photo_path, branch_id)
+            VALUES (%s, %s, %s, %s, %s, %s) 
+            RETURNING id;
+        """
+        cur.execute(sql, (product_name, category, description, donator_username, photo_path, branch_id))
+        product_id = cur.fetchone()[0]
+        bump_catalog_version(cur, branch_id)
+        conn.commit()
+        drop_catalog_snapshot(branch_id)
+
+        return jsonify(
+            {"message": "Produit créé avec succès", "id": product_id}), 201
+
+    except Exception as e:
+        conn.rollback()
+        return jsonify(
+            {"message": f"Erreur lors de la création du produit: {e}"}), 400
+    finally:
+        conn.close()
+
+@app.route('/api/employee/products/<int:product_id>', methods=['GET'])
+@retry_reads
+@employee_required
+def get_single_product(product_id):
+    conn = get_db_connection()
+
+    cur = conn.cursor()
+
+    try:
+        sql = """
+            SELECT id, product_name, category, description, donator_username, status, photo_path 
+            FROM products 
+            WHERE id = %s AND branch_id = %s;
+        """
+        cur.execute(sql, (product_id, request_branch_id()))
+        product = cur.fetchone()
+
+        if product:
+            columns = ['id', 'product_name', 'category', 'description', 'donator_username', 'status', 'photo']
+            result = dict(zip(columns, product))
+            return jsonify(result), 200
+        else:
+            return jsonify({"message": "Produit non trouvé"}), 404
+
+    except DB_ERRORS:
+        raise
+    except Exception as e:
+        print(f"Erreur lors de la récupération du produit: {e}")
+        return jsonify({"message": "Erreur serveur"}), 500
+    finally:
+        conn.close()
+
+
+@app.route('/api/employee/products', methods=['GET'])
+@retry_reads
+@employee_required
+def get_all_products():
+    conn = get_db_connection()
+        
+    cur = conn.cursor()
+    
+    try:
+        # The borrower is kept on the product (see set_current_borrow): one index scan, one row per product
+        sql = """
+            SELECT id, product_name, category, status, donator_username, publish_date, current_borrower_username
+            FROM products
+            WHERE branch_id = %s
+            ORDER BY id DESC;
+        """
+        cur.execute(sql, (request_branch_id(),))
+        
+        columns = ['id', 'product_name', 'category', 'status', 'donator_username', 'publish_date', 'borrower_name']
+        products = [dict(zip(columns, r)) for r in cur.fetchall()]
+        
+        for p in products:
+            p['publish_date'] = str(p['publish_date'])
+        
+        return jsonify(products), 200
+        
+    except DB_ERRORS:
+        raise
+    except Exception as e:
+        print(f"Erreur lors de la récupération des produits: {e}")
+        return jsonify({"message": "Erreur serveur"}), 500
+    finally:
+        conn.close()
+
+
+@app.route('/api/employee/products/<int:product_id>', methods=['PUT'])
+@employee_required
+def update_product(product_id):
+    data = request_data()
+
+    product_name = data.get('product_name')
+    category = data.get('category')
+    description = data.get('description')
+    donator_username = data.get('donator_username') # Changed
+    status = data.get('status')
+    photo_path, error = uploaded_photo()
+    if error:
+        return error
+
+    conn = get_db_connection()
+
+    cur = conn.cursor()
+    branch_id = request_branch_id()
+
+    try:
+        # Sans nouvelle photo, on garde l'ancienne
+        sql = """
+            UPDATE products 
+            SET product_name = %(product_name)s, 
+                category = %(category)s, 
+                description = %(description)s, 
+                donator_username = %(donator_username)s, 
+                status = %(status)s,
+                photo_path = COALESCE(%(photo_path)s, photo_path),
+                -- Only a borrowed product has a holder
+                current_borrow_id = CASE WHEN %(status)s = 'borrowed' THEN current_borrow_id END,
+                current_borrower_username = CASE WHEN %(status)s = 'borrowed' THEN current_borrower_username END
+            WHERE id = %(id)s AND branch_id = %(branch_id)s
+            RETURNING id;
+        """
+        cur.execute(sql, {'product_name': product_name, 'category': category, 'description': description, 'donator_username': donator_username,
+                          'status': status, 'photo_path': photo_path, 'id': product_id, 'branch_id': branch_id})
+
+        updated_id = cur.fetchone()
+
+        if updated_id:
+            bump_catalog_version(cur, branch_id)
+            conn.commit()
+            drop_catalog_snapshot(branch_id)
+            return jsonify({"message": "Produit mis à jour"}), 200
+        else:
+            conn.rollback()
+            return jsonify({"message": "Produit non trouvé"}), 404
+
+    except Exception as e:
+        conn.rollback()
+        print(f"Erreur lors de la mise à jour du produit: {e}")
+        return jsonify({"message": f"Erreur de mise à jour: {e}"}), 400
+    finally:
+        conn.close()
+
+
+@app.route('/api/employee/products/<int:product_id>', methods=['DELETE'])
+@employee_required
+def delete_product(product_id):
+    conn = get_db_connection()
+
+    cur = conn.cursor()
+    branch_id = request_branch_id()
+
+    try:
+        cur.execute("DELETE FROM products WHERE id = %s AND branch_id = %s RETURNING id;",
+                    (product_id, branch_id))
+        deleted_id = cur.fetchone()
+
+        if deleted_id:
+            bump_catalog_version(cur, branch_id)
+            conn.commit()
+            drop_catalog_snapshot(branch_id)
+            return jsonify({
+                               "message": "Produit supprimé"}), 204  # 204 No Content pour une suppression réussie
+        else:
+            return jsonify({"message": "Produit non trouvé"}), 404
+
+    except Exception as e:
+        conn.rollback()
+        return jsonify(
+            {"message": f"Erreur lors de la suppression du produit: {e}"}), 500
+    finally:
+        conn.close()
+
+
+
+# --- EMPLOYEE ROUTES (Manage Requests) ---
+
+@app.route('/api/employee/requests', methods=['GET'])
+@retry_reads
+@employee_required
+def get_all_requests():
+    conn = get_db_connection()
+    cur = conn.cursor()
+    execute_prepared(cur, 'pending_borrow_requests', (request_branch_id(),))
+    # On ajoute r[5] qui est returned_date
+    requests = [{
+        'id': r[0], 
+        'username': r[1], 
+        'product': r[2], 
+        'status': r[3], 
+        'date': str(r[4]),
+        'returned_date': str(r[5]) if r[5] else 'לא צוין'
+    } for r in cur.fetchall()]
+    conn.close()
+    return jsonify(requests), 200
+
+@app.route('/api/employee/requests/<int:req_id>', methods=['PUT'])
+@employee_required
+def update_request_status(req_id):
+    data = request.json
+    new_status = data.get('status') # 'approved' or 'rejected'
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        # 1. Mise à jour du statut de la requête
+        # Si le statut est 'rejected', on remet returned_date à NULL
+        if new_status == 'rejected':
+            set_clause = "status = %s, returned_date = NULL"
+        elif new_status == 'approved':
+            set_clause = "status = %s, approved_at = CURRENT_TIMESTAMP"
+        else:
+            set_clause = "status = %s"
+
+        # The locked sub-select returns the status from before the update (an unchanged status isn't counted by the stats rollups)
+        branch_id = request_branch_id()
+        cur.execute(f"""
+            UPDATE borrow_requests br SET {set_clause}
+            FROM (SELECT id, status FROM borrow_requests WHERE id = %s AND branch_id = %s FOR UPDATE) old
+            WHERE br.id = old.id
+            RETURNING br.product_id, old.status, br.start_date <= CURRENT_DATE
+        """, (new_status, req_id, branch_id))
+        result = cur.fetchone()
+        
+        if result:
+            product_id, old_status, started = result
+
+            if old_status != new_status:
+                record_borrow_transition(cur, req_id, new_status)
+
+            # Une réservation future ne change pas le statut actuel du produit (voir activate-reservations)
+            if started and new_status == 'approved':
+                # Produit prêté
+                cur.execute("UPDATE products SET status = 'borrowed' WHERE id = %s", (product_id,))
+                set_current_borrow(cur, product_id, req_id)
+            elif started and new_status == 'rejected':
+                # Produit refusé -> prochaine réservation, liste d'attente, ou redevient disponible
+                release_product(cur, product_id)
+            if started:
+                bump_catalog_version(cur, branch_id)
+                
+            conn.commit()
+            if started:
+                drop_catalog_snapshot(branch_id)
+            return jsonify({"message": "Status updated and date cleared if rejected"}), 200
+        else:
+            return jsonify({"message": "Request not found"}), 404
+    except Exception as e:
+        conn.rollback()
+        return jsonify({"error": str(e)}), 500
+    finally:
+        conn.close()
+
+# --- EMPLOYEE ROUTES (DONATIONS Requests) ---
+
+@app.route('/api/employee/donations', methods=['GET'])
+@retry_reads
+@employee_required
+def get_donations():
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT id, product_name, category, description, donator_username, created_at, photo_path FROM donation_requests WHERE branch_id = %s AND status = 'donation_pending' ORDER BY created_at DESC",
+                (request_branch_id(),))
+    dons = [{'id':r[0], 'product_name':r[1], 'category':r[2], 'description':r[3], 'donator_username':r[4], 'created_at':str(r[5]), 'photo':r[6]} for r in cur.fetchall()]
+    conn.close()
+    return jsonify(dons), 200
+
+DONATION_OVERRIDE_FIELDS = ('product_name', 'category', 'description', 'donator_username')
+
+def approve_donations(cur, branch_id, approvals):
+    """Turns the branch's pending donations into products in one statement. approvals is a list of
+    {'id': ..., and optionally any of DONATION_OVERRIDE_FIELDS}: a given field replaces the donor's value.
+    Donations that are missing, of another branch or no longer pending are skipped.
+    Returns (approved donation ids, new product ids)."""
+    overrides = [{'id': int(a['id']), **{f: a[f] for f in DONATION_OVERRIDE_FIELDS if a.get(f)}} for a in approvals]
+    cur.execute("""
+        WITH o AS (
+            SELECT * FROM jsonb_to_recordset(%s::jsonb) AS o(id INT, product_name TEXT, category TEXT, description TEXT, donator_username TEXT)
+        ), approved AS (
+            UPDATE donation_requests d SET status = 'donation_approved'
+            FROM o WHERE d.id = o.id AND d.branch_id = %s AND d.status = 'donation_pending'
+            RETURNING d.id, COALESCE(o.product_name, d.product_name) AS product_name, COALESCE(o.category, d.category) AS category,
+                      COALESCE(o.description, d.description) AS description, COALESCE(o.donator_username, d.donator_username) AS donator_username,
+                      d.photo_path, d.branch_id
+        ), created AS (
+            INSERT INTO products (product_name, category, description, donator_username, status, photo_path, branch_id)
+            SELECT product_name, category, description, donator_username, 'available', photo_path, branch_id FROM approved ORDER BY id
+            RETURNING id
+        )
+        SELECT (SELECT COALESCE(array_agg(id ORDER BY id), '{}') FROM approved), (SELECT COALESCE(array_agg(id ORDER BY id), '{}') FROM created);
+    """, (json.dumps(overrides), branch_id))
+    approved, product_ids = cur.fetchone()
+
+    # Thank the donors who have an account (anonymous donations have none), from the job worker
+    cur.execute("""
+        SELECT u.id, d.product_name FROM donation_requests d JOIN personnal_infos u ON u.username = d.donator_username
+        WHERE d.id = ANY(%s);
+    """, (approved,))
+    for user_id, product_name in cur.fetchall():
+        enqueue_job(cur, 'email', {'user_id': user_id, 'subject': f"התרומה שלך אושרה: {product_name}",
+                                   'body': f"תודה! {product_name} שתרמת נוסף למלאי של לב קטן ויעזור למשפחות נוספות."})
+    return approved, product_ids
+
+def reject_donations(cur, branch_id, donation_ids):
+    """Deletes the branch's pending donations among donation_ids. Returns the deleted ids."""
+    cur.execute("DELETE FROM donation_requests WHERE id = ANY(%s) AND branch_id = %s AND status = 'donation_pending' RETURNING id",
+                (list(donation_ids), branch_id))
+    return sorted(r[0] for r in cur.fetchall())
+
+@app.route('/api/employee/donations/<int:don_id>/reject', methods=['DELETE'])
+@employee_required
+def reject_donation(don_id):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    reject_donations(cur, request_branch_id(), [don_id])
+    conn.commit()
+    conn.close()
+    return '', 204
+
+@app.route('/api/employee/donations/<int:don_id>/approve', methods=['POST'])
+@employee_required
+def approve_donation(don_id):
+    """Approves a donation; the JSON body may override product_name, category, description, donator_username."""
+    data = request.get_json(silent=True) or {}
+    conn = get_db_connection()
+    cur = conn.cursor()
+    branch_id = request_branch_id()
+    try:
+        approved, product_ids = approve_donations(cur, branch_id, [dict(data, id=don_id)])
+        if not approved:
+            return jsonify({"message": "Donation not found"}), 404
+        bump_catalog_version(cur, branch_id)
+        conn.commit()
+        drop_catalog_snapshot(branch_id)
+        return jsonify({"message": "Donation converted to product", "product_id": product_ids[0]}), 201
+    except Exception as e:
+        conn.rollback()
+        return jsonify({"error": str(e)}), 500
+    finally:
+        conn.close()
+
+@app.route('/api/employee/donations/bulk', methods=['POST'])
+@employee_required
+def bulk_donations():
+    """Approves and rejects many donations in one transaction.
+    Body: {"approve": [id or {"id": ..., <overrides>}, ...], "reject": [id, ...]}"""
+    data = request.get_json(silent=True) or {}
+    approvals, rejections = data.get('approve', []), data.get('reject', [])
+    if not isinstance(approvals, list) or not isinstance(rejections, list):
+        return jsonify({"message": "approve and reject must list donation ids"}), 400
+    approvals = [a if isinstance(a, dict) else {'id': a} for a in approvals]
+    if not all(str(a.get('id', '')).isdigit() for a in approvals) or not all(str(r).isdigit() for r in rejections):
+        return jsonify({"message": "approve and reject must list donation ids"}), 400
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    branch_id = request_branch_id()
+    try:
+        approved, product_ids = approve_donations(cur, branch_id, approvals) if approvals else ([], [])
+        rejected = reject_donations(cur, branch_id, [int(r) for r in rejections]) if rejections else []
+        if approved:
+            bump_catalog_version(cur, branch_id)
+        conn.commit()
+        if approved:
+            drop_catalog_snapshot(branch_id)
+        return jsonify({"approved": approved, "product_ids": product_ids, "rejected": rejected}), 200
+    except Exception as e:
+        conn.rollback()
+        return jsonify({"error": str(e)}), 500
+    finally:
+        conn.close()
+
+# --- Early Return ---
+@app.route('/api/return', methods=['POST'])
+@token_required
+@idempotent
+def return_product():
+    data = request.json
+    borrow_id = data.get('borrow_id')
+    user_id = request.user_data['user_id']
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        # Verify the borrow request belongs to the user and is currently active (approved)
+        cur.execute("""
+            SELECT br.product_id, br.branch_id, p.product_name FROM borrow_requests br JOIN products p ON p.id = br.product_id
+            WHERE br.id = %s AND br.user_id = %s AND br.status = 'approved'
+        """, (borrow_id, user_id))
+        result = cur.fetchone()
+
+        if not result:
+            return jsonify({"message": "Borrow request not found or not active."}), 404
+
+        product_id, branch_id, product_name = result
+
+        # 1. Mark the request as 'returned' (Historical record)
+        cur.execute("UPDATE borrow_requests SET status = 'returned' WHERE id = %s", (borrow_id,))
+
+        record_borrow_transition(cur, borrow_id, 'returned')
+
+        # 2. Free the product: next reservation, next family on the waiting list, or back in the catalog
+        release_product(cur, product_id)
+
+        # 3. Receipt, sent by the job worker
+        enqueue_job(cur, 'email', {'user_id': user_id, 'subject': f"ההחזרה של {product_name} נקלטה",
+                                   'body': f"תודה! קיבלנו את ההחזרה של {product_name}."})
+        bump_catalog_version(cur, branch_id)
+
+        conn.commit()
+        drop_catalog_snapshot(branch_id)
+        return jsonify({"message": "Product returned successfully"}), 200
+    except Exception as e:
+        conn.rollback()
+        return jsonify({"error": str(e)}), 500
+    finally:
+        conn.close()
+
+# --- EXTENSION Requests ---
+
+@app.route('/api/extensions', methods=['POST'])
+@token_required
+@idempotent
+def request_extension():
+    data = request.json
+    borrow_id = data.get('borrow_id')
+    new_date = data.get('new_returned_date')
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        # Check if an extension request is already pending for this loan.
+        cur.execute("SELECT id FROM extension_requests WHERE borrow_id = %s AND status = 'extension_pending'", (borrow_id,))
+        if cur.fetchone():
+            return jsonify({"message": "כבר קיימת בקשת הארכה ממתינה עבור מוצר זה."}), 400
+
+        cur.execute("""
+            INSERT INTO extension_requests (borrow_id, new_returned_date)
+            VALUES (%s, %s)
+        """, (borrow_id, new_date))
+        
+        conn.commit()
+        return jsonify({"message": "בקשת ההארכה נשלחה בהצלחה! ממתין לאישור עובד."}), 201
+    except Exception as e:
+        conn.rollback()
+        return jsonify({"error": str(e)}), 500
+    finally:
+        conn.close()
+
+# List extension requests
+@app.route('/api/employee/extensions', methods=['GET'])
+@retry_reads
+@employee_required
+def get_extension_requests():
+    conn = get_db_connection()
+    cur = conn.cursor()
+    execute_prepared(cur, 'pending_extension_requests', (request_branch_id(),))
+    results = cur.fetchall()
+    extensions = [{
+        'id': r[0],
+        'username': r[1],
+        'product_name': r[2],
+        'current_return_date': str(r[3]),
+        'new_return_date': str(r[4])
+    } for r in results]
+    conn.close()
+    return jsonify(extensions), 200
+
+#  Approve or Reject the extension
+def decide_extensions(cur, branch_id, ext_ids, status):
+    """Approves or rejects ('extension_approved' / 'extension_rejected') the branch's pending extension
+    requests among ext_ids in one statement. An approval moves the loan's returned_date. It is refused
+    ('not_active') unless the loan is approved, ('over_limit') past the branch's max_borrow_days counted
+    from the loan's start (not from today), and ('overlap') when another active loan
+    of the product holds the new dates.
+    Returns {ext_id: 'approved' | 'rejected' | 'not_active' | 'over_limit' | 'overlap'}. Ids that are
+    unknown, of another branch or already decided are left out."""
+    cur.execute(f"""
+        WITH target AS (
+            SELECT er.id, er.borrow_id, er.new_returned_date, br.status = 'approved' AS active,
+                   er.new_returned_date - COALESCE(br.start_date, br.request_date::date) <= COALESCE(s.setting_value::int, 14) AS within_limit,
+                   NOT EXISTS (
+                       SELECT 1 FROM borrow_requests o
+                       WHERE o.product_id = br.product_id AND o.id <> br.id AND o.status IN {ACTIVE_BORROW_STATUSES}
+                         AND o.loan_period && daterange(br.start_date, er.new_returned_date, '[]')
+                   ) AS free
+            FROM extension_requests er
+            JOIN borrow_requests br ON br.id = er.borrow_id
+            LEFT JOIN system_settings s ON s.branch_id = br.branch_id AND s.setting_key = 'max_borrow_days'
+            WHERE er.id = ANY(%(ids)s) AND br.branch_id = %(branch_id)s AND er.status = 'extension_pending'
+            FOR UPDATE OF er FOR NO KEY UPDATE OF br  -- the loan can't be returned or rejected meanwhile
+        ), decided AS (
+            UPDATE extension_requests er SET status = %(status)s
+            FROM target t
+            WHERE er.id = t.id AND (%(status)s = 'extension_rejected' OR (t.active AND t.within_limit AND t.free))
+            RETURNING er.id, er.borrow_id, er.new_returned_date
+        ), extended AS (
+            UPDATE borrow_requests br SET returned_date = d.new_returned_date
+            FROM decided d
+            WHERE br.id = d.borrow_id AND %(status)s = 'extension_approved' AND br.status = 'approved'
+            RETURNING br.id
+        )
+        SELECT t.id,
+               CASE WHEN d.id IS NOT NULL THEN replace(%(status)s, 'extension_', '')
+                    WHEN NOT t.active THEN 'not_active'
+                    WHEN NOT t.within_limit THEN 'over_limit' ELSE 'overlap' END
+        FROM target t LEFT JOIN decided d ON d.id = t.id;
+    """, {'ids': [int(i) for i in ext_ids], 'branch_id': branch_id, 'status': status})
+    return dict(cur.fetchall())
+
+@app.route('/api/employee/extensions/<int:ext_id>', methods=['PUT'])
+@employee_required
+def update_extension_status(ext_id):
+    data = request.json
+    status = data.get('status') # 'approved' or 'rejected'
+    if status not in ('approved', 'rejected'):
+        return jsonify({"message": "status must be 'approved' or 'rejected'"}), 400
+
+    new_status = f"extension_{status}" # Transforme en 'extension_approved' ou 'extension_rejected' -- decision---
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        result = decide_extensions(cur, request_branch_id(), [ext_id], new_status).get(ext_id)
+        if result is None:
+            return jsonify({"message": "Extension request not found"}), 404
+        if result == 'not_active':
+            return jsonify({"message": "Only an approved loan can be extended"}), 409
+        if result == 'over_limit':
+            return jsonify({"message": "The new return date exceeds max_borrow_days"}), 400
+        if result == 'overlap':
+            return jsonify({"message": "The extension overlaps another reservation of this product"}), 409
+
+        conn.commit()
+        return jsonify({"message": f"Extension status updated to {new_status}"}), 200
+    except psycopg2.errors.ExclusionViolation:
+        conn.rollback()
+        return jsonify({"message": "The extension overlaps another reservation of this product"}), 409
+    except Exception as e:
+        conn.rollback()
+        return jsonify({"error": str(e)}), 500
+    finally:
+        conn.close()
+
+@app.route('/api/employee/extensions/bulk', methods=['POST'])
+@employee_required
+def bulk_extensions():
+    """Approves and rejects many extension requests in one transaction.
+    Body: {"approve": [ids], "reject": [ids]}. Returns each id's outcome (see decide_extensions)."""
+    data = request.get_json(silent=True) or {}
+    approvals, rejections = data.get('approve', []), data.get('reject', [])
+    if not isinstance(approvals, list) or not isinstance(rejections, list) or not all(str(i).isdigit() for i in approvals + rejections):
+        return jsonify({"message": "approve and reject must list extension request ids"}), 400
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    branch_id = request_branch_id()
+    try:
+        results = {}
+        if rejections:
+            results.update(decide_extensions(cur, branch_id, rejections, 'extension_rejected'))
+        if approvals:
+            results.update(decide_extensions(cur, branch_id, approvals, 'extension_approved'))
+        conn.commit()
+        return jsonify({"results": {str(i): r for i, r in sorted(results.items())}}), 200
+    except psycopg2.errors.ExclusionViolation:
+        conn.rollback()
+        return jsonify({"message": "Two of the extensions overlap each other; approve them separately"}), 409
+    except Exception as e:
+        conn.rollback()
+        return jsonify({"error": str(e)}), 500
+    finally:
+        conn.close()
+
+# --- ADMIN ROUTES (Manage Users) ---
+@app.route('/api/admin/users', methods=['GET'])
+@retry_reads
+@admin_required
+def get_all_users():
+    """GET /api/admin/users?q=&role=&limit=&cursor= -- substring search over name, username, email and phone
+    (trigram indexed), optional role filter (repeatable), keyset pages ordered by id."""
+    search = (request.args.get('q') or '').strip()
+    roles = [r for r in request.args.getlist('role') if r in ('admin', 'employee', 'user')]
+    limit = max(1, min(request.args.get('limit', 50, type=int), 200))
+    after_id = request.args.get('cursor', 0, type=int)
+
+    where, params = ["id > %s"], [after_id]
+    if search:
+        pattern = '%' + search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        where.append("(full_name ILIKE %s OR username ILIKE %s OR email ILIKE %s OR phone_number ILIKE %s)")
+        params += [pattern] * 4
+    if roles:
+        where.append("role = ANY(%s)")
+        params.append(roles)
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute(f"SELECT id, full_name, username, phone_number, email, role, branch_id FROM personnal_infos WHERE {' AND '.join(where)} ORDER BY id LIMIT %s;",
+                params + [limit + 1])
+    rows = cur.fetchall()
+    conn.close()
+    users = [dict(zip(['id', 'full_name', 'username', 'phone_number', 'email', 'role', 'branch_id'], r)) for r in rows[:limit]]
+    next_cursor = users[-1]['id'] if len(rows) > limit else None
+    return jsonify({"users": users, "next_cursor": next_cursor}), 200
+
+@app.route('/api/admin/users/<int:user_id>/role', methods=['PUT'])
+@admin_required
+def update_user_role(user_id):
+    new_role = request.json.get('role')
+    # Employees are assigned to a branch (the default one unless given); other roles have none
+    branch_id = (request.json.get('branch_id') or DEFAULT_BRANCH_ID) if new_role == 'employee' else None
+    if branch_id is not None and not is_known_branch(branch_id):
+        return jsonify({"message": "Unknown branch"}), 400
+    conn = get_db_connection()
+    cur = conn.cursor()
+    # Tokens issued with the old role or branch stop working; the user logs in again to get the new one
+    cur.execute("""
+        UPDATE personnal_infos SET role = %s, branch_id = %s, token_version = token_version + 1
+        WHERE id = %s AND (role IS DISTINCT FROM %s OR branch_id IS DISTINCT FROM %s) RETURNING token_version;
+    """, (new_role, branch_id, user_id, new_role, branch_id))
+    changed = cur.fetchone()
+    if changed:
+        revoke_tokens(cur, user_id, changed[0])
+    conn.commit()
+    conn.close()
+    return jsonify({"message": "Role updated"}), 200
+
+@app.route('/api/admin/users/<int:user_id>', methods=['DELETE'])
+@admin_required
+def delete_user(user_id):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    # Products the user's requests occupy today (loans, pending or awaiting confirmation) are released once
+    # those requests are gone (deleted with the account): to the next reservation, the waiting list or the catalog
+    cur.execute(f"""
+        SELECT id, branch_id FROM products
+        WHERE id IN (SELECT product_id FROM borrow_requests
+                     WHERE user_id = %s AND status IN {ACTIVE_BORROW_STATUSES} AND loan_period @> CURRENT_DATE)
+        ORDER BY id
+        FOR UPDATE;
+    """, (user_id,))
+    held = cur.fetchall()
+    cur.execute("DELETE FROM personnal_infos WHERE id = %s RETURNING id;", (user_id,))
+    if cur.fetchone():
+        revoke_tokens(cur, user_id, ACCOUNT_DELETED)
+        for product_id, _ in held:
+            release_product(cur, product_id)
+        bump_catalog_version(cur, *(b for _, b in held))
+    conn.commit()
+    drop_catalog_snapshot(*(b for _, b in held))
+    conn.close()
+    return jsonify({"message": "User deleted"}), 200
+
+# --- ADMIN ROUTES (Statistics) ---
+@app.route('/api/admin/stats', methods=['GET'])
+@retry_reads
+@statement_timeout(15000)
+@admin_required
+def get_admin_stats():
+    """Loan statistics for the last `days` days, read from the rollup tables only."""
+    days = max(1, min(request.args.get('days', 30, type=int), 365))
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            SELECT day, category, requested, approved, rejected, returned, approval_latency_seconds, approval_latency_samples
+            FROM stats_daily_loans WHERE day > CURRENT_DATE - %s ORDER BY day, category;
+        """, (days,))
+        columns = ['day', 'category', 'requested', 'approved', 'rejected', 'returned', 'approval_latency_seconds', 'approval_latency_samples']
+        daily = [dict(zip(columns, r)) for r in cur.fetchall()]
+
+        categories = {}
+        for d in daily:
+            d['day'] = str(d['day'])
+            total = categories.setdefault(d['category'], {'category': d['category'], 'requested': 0, 'approved': 0, 'rejected': 0, 'returned': 0,
+                                                          'approval_latency_seconds': 0, 'approval_latency_samples': 0})
+            for key in columns[2:]:
+                total[key] += d[key]
+        for total in categories.values():
+            samples = total.pop('approval_latency_samples')
+            latency = total.pop('approval_latency_seconds')
+            total['avg_approval_hours'] = round(latency / samples / 3600, 1) if samples else None
+
+        cur.execute("""
+            SELECT u.product_id, p.product_name, p.category, u.loans, u.borrowed_days, u.last_borrowed_at
+            FROM stats_product_utilization u JOIN products p ON u.product_id = p.id
+            ORDER BY u.loans DESC, u.borrowed_days DESC LIMIT 10;
+        """)
+        top_products = [dict(zip(['product_id', 'product_name', 'category', 'loans', 'borrowed_days', 'last_borrowed_at'], r)) for r in cur.fetchall()]
+        for p in top_products:
+            p['last_borrowed_at'] = str(p['last_borrowed_at']) if p['last_borrowed_at'] else None
+
+        # Counted live from the (branch_id, status) index, one index-only range per branch: a shared counter row
+        # would make every borrow transaction wait for the previous one's commit
+        cur.execute("SELECT COUNT(*) FROM branches b JOIN borrow_requests br ON br.branch_id = b.id AND br.status = 'pending';")
+        backlog = cur.fetchone()
+
+        return jsonify({
+            "days": days,
+            "pending_backlog": backlog[0],
+            "categories": sorted(categories.values(), key=lambda c: -c['requested']),
+            "daily": daily,
+            "top_products": top_products
+        }), 200
+    except DB_ERRORS:
+        raise
+    except Exception as e:
+        print(f"Error retrieving stats: {e}")
+        return jsonify({"message": "Server error"}), 500
+    finally:
+        conn.close()
+
+# --- ADMIN ROUTES (Exports) ---
+# Full tables for reporting, streamed from COPY ... TO STDOUT: a thread runs the COPY and hands the output
+# through a bounded queue to the response generator, so memory stays flat whatever the table size.
+# Columns are (name, type); the types give the Parquet schema. Timestamps are exported in UTC.
+EXPORTS = {
+    'borrows': ("""
+        SELECT id, user_id, product_id, branch_id, status, request_date AT TIME ZONE 'UTC' AS request_date,
+               approved_at AT TIME ZONE 'UTC' AS approved_at, start_date, returned_date, NULL::timestamp AS archived_at
+        FROM borrow_requests
+        UNION ALL
+        SELECT id, user_id, product_id, branch_id, status, request_date AT TIME ZONE 'UTC', approved_at AT TIME ZONE 'UTC',
+               start_date, returned_date, archived_at AT TIME ZONE 'UTC'
+        FROM borrow_requests_archive
+    """, [('id', 'int'), ('user_id', 'int'), ('product_id', 'int'), ('branch_id', 'int'), ('status', 'text'), ('request_date', 'timestamp'),
+          ('approved_at', 'timestamp'), ('start_date', 'date'), ('returned_date', 'date'), ('archived_at', 'timestamp')]),
+    'donations': ("""
+        SELECT id, branch_id, product_name, category, description, donator_username, status, created_at AT TIME ZONE 'UTC' AS created_at
+        FROM donation_requests ORDER BY id
+    """, [('id', 'int'), ('branch_id', 'int'), ('product_name', 'text'), ('category', 'text'), ('description', 'text'),
+          ('donator_username', 'text'), ('status', 'text'), ('created_at', 'timestamp')]),
+    'products': ("""
+        SELECT id, branch_id, product_name, category, status, publish_date, donator_username, description FROM products ORDER BY id
+    """, [('id', 'int'), ('branch_id', 'int'), ('product_name', 'text'), ('category', 'text'), ('status', 'text'), ('publish_date', 'date'),
+          ('donator_username', 'text'), ('description', 'text')]),
+    'users': ("""
+        SELECT id, full_name, username, phone_number, email, role, branch_id FROM personnal_infos ORDER BY id
+    """, [('id', 'int'), ('full_name', 'text'), ('username', 'text'), ('phone_number', 'text'), ('email', 'text'), ('role', 'text'),
+          ('branch_id', 'int')]),
+}
+EXPORT_CHUNK_BYTES = 64 * 1024
+EXPORT_QUEUE_CHUNKS = 16  # at most ~1 MB buffered per export; a slow client slows the COPY down instead
+
+class ExportCancelled(Exception):
+    """The client went away: stops the COPY (or Parquet encoding) thread."""
+
+class ChunkQueueWriter:
+    """File-like sink (for copy_expert and ParquetWriter) that groups writes into EXPORT_CHUNK_BYTES chunks
+    and puts them on a bounded queue, blocking while the client reads slower than the database sends."""
+    def __init__(self, chunks, cancelled):
+        self.chunks = chunks
+        self.cancelled = cancelled
+        self.buffer = bytearray()
+        self.closed = False
+
+    def write(self, data):
+        self.buffer += data.encode('utf-8') if isinstance(data, str) else data
+        if len(self.buffer) >= EXPORT_CHUNK_BYTES:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.buffer:
+            self.put(bytes(self.buffer))
+            self.buffer.clear()
+
+    def put(self, item):
+        while True:
+            if self.cancelled.is_set():
+                raise ExportCancelled()
+            try:
+                self.chunks.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def close(self):
+        self.closed = True
+
+def copy_csv(conn, sql, sink):
+    conn.cursor().copy_expert(f"COPY ({sql}) TO STDOUT WITH (FORMAT csv, HEADER true)", sink)
+
+def csv_to_parquet(source, columns, sink):
+    """Re-encodes the CSV read from `source` as Parquet into `sink`, one row group per CSV block."""
+    import pyarrow as pa, pyarrow.csv, pyarrow.parquet
+    types = {'int': pa.int64(), 'text': pa.string(), 'date': pa.date32(), 'timestamp': pa.timestamp('us')}
+    schema = pa.schema([(name, types[kind]) for name, kind in columns])
+    reader = pa.csv.open_csv(source, convert_options=pa.csv.ConvertOptions(
+        column_types=schema, strings_can_be_null=True, quoted_strings_can_be_null=False))
+    with pa.parquet.ParquetWriter(sink, schema, compression='zstd') as writer:
+        for batch in reader:
+            writer.write_batch(batch)
+
+def stream_export(conn, kind, fmt):
+    """Starts the export threads and returns (generator yielding the file's chunks, cancel). The COPY
+    thread owns conn and gives it back to the pool when done; cancel() (run when the response is closed,
+    also before the end) stops the threads and the COPY."""
+    sql, columns = EXPORTS[kind]
+    chunks = queue.Queue(maxsize=EXPORT_QUEUE_CHUNKS)
+    cancelled = threading.Event()
+    sink = ChunkQueueWriter(chunks, cancelled)
+    conn_lock = threading.Lock()  # conn.cancel() must never reach a connection already back in the pool
+    copying = [True]
+
+    def run(job, last):
+        try:
+            job()
+            if last:
+                sink.flush()
+                sink.put(None)
+        except Exception as e:
+            if not cancelled.is_set():
+                print(f"Export of {kind} failed: {e}")
+                chunks.put(e)  # the consumer is still reading, so this makes progress
+
+    def copy(target):
+        try:
+            copy_csv(conn, sql, target)
+        finally:
+            with conn_lock:
+                copying[0] = False
+                conn.close()
+
+    if fmt == 'parquet':
+        read_fd, write_fd = os.pipe()
+        copy_failed = threading.Event()
+        def copy_into_pipe():
+            with os.fdopen(write_fd, 'wb') as pipe:
+                try:
+                    copy(pipe)
+                except Exception:
+                    copy_failed.set()  # before the pipe closes, so the encoder cannot mistake it for the end
+                    raise
+        def encode():
+            with os.fdopen(read_fd, 'rb') as pipe:
+                csv_to_parquet(pipe, columns, sink)
+            if copy_failed.is_set():
+                raise RuntimeError("COPY failed, the Parquet file would be truncated")
+        threads = [threading.Thread(target=run, args=(copy_into_pipe, False), daemon=True),
+                   threading.Thread(target=run, args=(encode, True), daemon=True)]
+    else:
+        threads = [threading.Thread(target=run, args=(lambda: copy(sink), True), daemon=True)]
+    for thread in threads:
+        thread.start()
+
+    def cancel():
+        cancelled.set()
+        with conn_lock:
+            if copying[0]:
+                conn.cancel()
+
+    def generate():
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk  # the response is cut short, so the client sees a failed download
+            yield chunk
+    return generate(), cancel
+
+@app.route('/api/admin/export/<kind>', methods=['GET'])
+@statement_timeout(0)
+@admin_required
+def export_table(kind):
+    """GET /api/admin/export/{borrows,donations,products,users}?format=csv|parquet -- the whole table as a
+    download. borrows includes the archived loans. Parquet needs the optional pyarrow package."""
+    fmt = request.args.get('format', 'csv')
+    if kind not in EXPORTS:
+        return jsonify({"message": f"Unknown export, expected one of: {', '.join(EXPORTS)}"}), 404
+    if fmt not in ('csv', 'parquet'):
+        return jsonify({"message": "format must be csv or parquet"}), 400
+    if fmt == 'parquet':
+        try:
+            import pyarrow.parquet  # noqa: F401
+        except ImportError:
+            return jsonify({"message": "Parquet export needs pyarrow installed on the server; use format=csv"}), 501
+
+    conn = get_db_connection()
+    g.db_connections.remove(conn)  # outlives the request: the export thread closes it, not the teardown
+    chunks, cancel = stream_export(conn, kind, fmt)
+    response = Response(chunks, mimetype='text/csv' if fmt == 'csv' else 'application/vnd.apache.parquet')
+    response.call_on_close(cancel)
+    response.headers['Content-Disposition'] = f'attachment; filename="levkatan-{kind}-{date.today()}.{fmt}"'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+# --- BRANCHES ROUTES ---
+@app.route('/api/branches', methods=['GET'])
+@retry_reads
+def get_branches():
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT id, name, city FROM branches ORDER BY id;")
+    branches = [{'id': r[0], 'name': r[1], 'city': r[2]} for r in cur.fetchall()]
+    conn.close()
+    return jsonify(branches), 200
+
+@app.route('/api/admin/branches', methods=['POST'])
+@admin_required
+def create_branch():
+    """Opens a branch, starting with the default branch's limits."""
+    data = request.json
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute("INSERT INTO branches (name, city) VALUES (%s, %s) RETURNING id;", (data.get('name'), data.get('city')))
+        branch_id = cur.fetchone()[0]
+        cur.execute("""
+            INSERT INTO system_settings (branch_id, setting_key, setting_value)
+            SELECT %s, setting_key, setting_value FROM system_settings WHERE branch_id = %s;
+        """, (branch_id, DEFAULT_BRANCH_ID))
+        conn.commit()
+        _branch_ids.add(branch_id)
+        return jsonify({"message": "Branch created", "id": branch_id}), 201
+    except psycopg2.errors.UniqueViolation:
+        conn.rollback()
+        return jsonify({"message": "A branch with this name already exists"}), 409
+    except Exception as e:
+        conn.rollback()
+        return jsonify({"error": str(e)}), 500
+    finally:
+        conn.close()
+
+# --- SETTINGS & LIMITS ROUTES ---
+# Public reads of the settings come from a short-lived per-worker cache, which also covers database outages.
+# Borrowing still reads them inside its own transaction.
+SETTINGS_CACHE_SECONDS = int(os.getenv("SETTINGS_CACHE_SECONDS", 30))
+_settings_cache = {}  # branch_id -> {'values', 'loaded_at'}
+
+def cached_system_settings(branch_id):
+    """The branch's system_settings as a dict, re-read at most every SETTINGS_CACHE_SECONDS. While the
+    database is unavailable the last good copy is returned, however old."""
+    cached = _settings_cache.get(branch_id)
+    if cached is not None and time.monotonic() - cached['loaded_at'] < SETTINGS_CACHE_SECONDS:
+        return cached['values']
+    try:
+        conn = get_db_connection()
+        try:
+            cur = conn.cursor()
+            execute_prepared(cur, 'system_settings', (branch_id,))
+            values = {row[0]: row[1] for row in cur.fetchall()}
+        finally:
+            conn.close()
+    except (DatabaseUnavailable, psycopg2.OperationalError) as e:
+        if cached is None:
+            raise
+        if isinstance(e, psycopg2.OperationalError):
+            note_db_failure()
+        print(f"Serving cached settings: {e}")
+        return cached['values']
+    _settings_cache[branch_id] = {'values': values, 'loaded_at': time.monotonic()}
+    return values
+
+@app.route('/api/config', methods=['GET'])
+@retry_reads
+def get_config():
+    """Returns the branch's settings (max days, max items). ?branch=<id>"""
+    settings = cached_system_settings(request_branch_id())
+    # Provide defaults if missing
+    return jsonify({
+        "max_borrow_days": int(settings.get('max_borrow_days', 14)),
+        "max_borrow_items": int(settings.get('max_borrow_items', 3))
+    }), 200
+
+@app.route('/api/admin/config', methods=['POST'])
+@admin_required
+def update_config():
+    """Updates the settings of the branch given by ?branch=<id>."""
+    data = request.json
+    max_days = data.get('max_borrow_days')
+    max_items = data.get('max_borrow_items')
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        # Upsert logic (Update if exists, Insert if not)
+        branch_id = request_branch_id()
+        cur.execute("INSERT INTO system_settings (branch_id, setting_key, setting_value) VALUES (%s, 'max_borrow_days', %s) ON CONFLICT (branch_id, setting_key) DO UPDATE SET setting_value = EXCLUDED.setting_value;", (branch_id, max_days))
+        cur.execute("INSERT INTO system_settings (branch_id, setting_key, setting_value) VALUES (%s, 'max_borrow_items', %s) ON CONFLICT (branch_id, setting_key) DO UPDATE SET setting_value = EXCLUDED.setting_value;", (branch_id, max_items))
+        conn.commit()
+        _settings_cache.pop(branch_id, None)  # re-read on the next request (other workers within SETTINGS_CACHE_SECONDS)
+        return jsonify({"message": "Settings updated successfully"}), 200
+    except Exception as e:
+        conn.rollback()
+        return jsonify({"error": str(e)}), 500
+    finally:
+        conn.close()
+
+@app.route('/api/borrow-status', methods=['GET'])
+@retry_reads
+@token_required
+def get_borrow_status():
+    """Checks how many items the user has currently borrowed at the branch (?branch=<id>) vs its limit."""
+    user_id = request.user_data['user_id']
+    branch_id = request_branch_id()
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    # Get Limits
+    execute_prepared(cur, 'system_settings', (branch_id,))
+    rows = cur.fetchall()
+    settings = {row[0]: row[1] for row in rows}
+    max_items = int(settings.get('max_borrow_items', 3))
+    max_days = int(settings.get('max_borrow_days', 14))
+
+    # Count active requests (pending or approved)
+    execute_prepared(cur, 'borrow_quota_count', (user_id, branch_id))
+    current_count = cur.fetchone()[0]
+    
+    conn.close()
+    
+    return jsonify({
+        "current_borrowed": current_count,
+        "max_items": max_items,
+        "remaining_slots": max_items - current_count,
+        "max_days": max_days
+    }), 200
+
+# --- PRODUCT PHOTOS (content-addressed, so cacheable forever) ---
+@app.route('/api/photos/<path:name>', methods=['GET'])
+def get_photo(name):
+    response = send_from_directory(PHOTO_DIR, name)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+# --- FRONTEND (static_build/, produced by `python build_assets.py`) ---
+# Fingerprinted files never change under their name and are cached for a year; the pages keep their
+# names and are revalidated (ETag) on every visit. Pre-compressed variants are picked from Accept-Encoding.
+ASSET_BUILD_DIR = os.getenv("ASSET_BUILD_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static_build'))
+ENCODING_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+_asset_manifest = None
+
+def load_asset_manifest():
+    global _asset_manifest
+    if _asset_manifest is None:
+        try:
+            with open(os.path.join(ASSET_BUILD_DIR, 'asset-manifest.json'), encoding='utf-8') as f:
+                _asset_manifest = json.load(f)['files']
+        except OSError:
+            _asset_manifest = {}  # not built: the frontend is served elsewhere (GitHub Pages)
+    return _asset_manifest
+
+@app.route('/', defaults={'filename': 'index.html'})
+@app.route('/<path:filename>')
+def serve_frontend(filename):
+    entry = load_asset_manifest().get(filename)
+    if entry is None:
+        return jsonify({"message": "Not found"}), 404
+
+    encoding = next((e for e in entry['encodings'] if request.accept_encodings[e] > 0), None)
+    response = send_from_directory(ASSET_BUILD_DIR, filename + ENCODING_SUFFIXES.get(encoding, ''),
+                                   mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if entry['encodings']:
+        response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable' if entry['immutable'] else 'no-cache'
+    return response
+
+
+# --- HEALTH & READINESS ---
+# /healthz only says the process answers (liveness). /readyz says this worker can serve traffic: config
+# present, database reachable at the expected schema version, caches loaded. Point the App Service
+# health check at /readyz; gunicorn.conf.py runs warm_up() in every worker before it accepts requests.
+EXPECTED_SCHEMA_VERSION = 16  # highest DataBase/Migrations file this code needs
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    return jsonify({"status": "ok"}), 200
+
+def readiness_checks():
+    """Runs the readiness checks, loading whatever is still cold on the way. Returns {check: bool}."""
+    checks = {'jwt_secret': bool(JWT_SECRET_KEY), 'database': False, 'schema': False, 'catalog': False, 'revocations': False}
+    try:
+        conn = get_db_connection()
+    except DatabaseUnavailable:
+        return checks
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT MAX(version) FROM schema_migrations;")
+        checks['database'] = True
+        checks['schema'] = (cur.fetchone()[0] or 0) >= EXPECTED_SCHEMA_VERSION
+        cur.execute("SELECT id FROM branches ORDER BY id;")
+        branch_ids = [r[0] for r in cur.fetchall()]
+        remember_branch_ids(branch_ids)
+        conn.rollback()
+        checks['catalog'] = all((load_catalog_snapshot(b) or rebuild_catalog_snapshot(conn, b)) is not None for b in branch_ids)
+    except Exception as e:
+        print(f"Readiness check error: {e}")
+    finally:
+        conn.close()
+
+    ensure_revocation_listener()
+    checks['revocations'] = _revocations_loaded.is_set()
+    load_asset_manifest()
+    return checks
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    checks = readiness_checks()
+    ready = all(checks.values())
+    return jsonify({"status": "ready" if ready else "not ready", "checks": checks,
+                    "expected_schema_version": EXPECTED_SCHEMA_VERSION}), 200 if ready else 503
+
+def warm_up():
+    """Opens the worker's pool connections, PREPAREs the hot statements on them and loads the caches,
+    so the first real requests don't pay for it. Never raises: a cold worker still serves."""
+    conns = []
+    try:
+        for _ in range(DB_POOL_MIN):
+            conn = get_db_connection()
+            conns.append(conn)
+            cur = conn.cursor()
+            for name in PREPARED_STATEMENTS:
+                prepare_statement(cur, name)
+            conn.commit()
+    except Exception as e:
+        print(f"Warm-up error: {e}")
+    finally:
+        for conn in conns:
+            conn.close()
+    checks = readiness_checks()
+    print(f"Worker {os.getpid()} warmed up: " + ", ".join(f"{name}={'ok' if ok else 'FAILED'}" for name, ok in checks.items()))
+
+
+# --- MAINTENANCE COMMANDS (flask --app app <command>) ---
+# Returned and rejected loans are history: once older than BORROW_ARCHIVE_AFTER_DAYS they are moved
+# to borrow_requests_archive, so the live table (quota count, inventory, my-requests) only holds
+# recent and active rows. Run archive-borrow-requests from a scheduled job.
+BORROW_ARCHIVE_AFTER_DAYS = int(os.getenv("BORROW_ARCHIVE_AFTER_DAYS", 90))
+
+def archive_closed_borrow_requests(conn, older_than_days=BORROW_ARCHIVE_AFTER_DAYS, batch_size=5000):
+    """Moves closed loans, and their extension requests, to the archive in batches, one transaction per
+    batch. Returns the number of loans moved."""
+    cur = conn.cursor()
+    total = 0
+    while True:
+        # The extension rows are read before the DELETE's cascade removes them (same statement snapshot)
+        cur.execute("""
+            WITH moved AS (
+                DELETE FROM borrow_requests
+                WHERE id IN (
+                    SELECT id FROM borrow_requests
+                    WHERE status IN ('returned', 'rejected')
+                      AND COALESCE(returned_date, request_date::date) < CURRENT_DATE - %s
+                    ORDER BY id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, user_id, product_id, request_date, start_date, returned_date, status, approved_at, branch_id
+            ), archived AS (
+                INSERT INTO borrow_requests_archive (id, user_id, product_id, request_date, start_date, returned_date, status, approved_at, branch_id)
+                SELECT id, user_id, product_id, request_date, start_date, returned_date, status, approved_at, branch_id FROM moved
+                RETURNING id
+            ), archived_extensions AS (
+                INSERT INTO extension_requests_archive (id, borrow_id, new_returned_date, status, request_date)
+                SELECT er.id, er.borrow_id, er.new_returned_date, er.status, er.request_date
+                FROM extension_requests er WHERE er.borrow_id IN (SELECT id FROM archived)
+            )
+            SELECT COUNT(*) FROM archived;
+        """, (older_than_days, batch_size))
+        moved = cur.fetchone()[0]
+        conn.commit()
+        total += moved
+        if moved < batch_size:
+            return total
+
+@app.cli.command('archive-borrow-requests')
+@click.option('--older-than-days', default=BORROW_ARCHIVE_AFTER_DAYS, show_default=True, type=int)
+def archive_borrow_requests(older_than_days):
+    """Moves returned/rejected loans older than the given age to borrow_requests_archive."""
+    conn = get_db_connection()
+    moved = archive_closed_borrow_requests(conn, older_than_days)
+    conn.close()
+    print(f"Archived {moved} borrow requests")
+
+@app.cli.command('activate-reservations')
+def activate_reservations():
+    """Takes products whose reservation starts today off the shelf. Schedule it daily, just after midnight."""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute(f"""
+        UPDATE products p SET status = CASE WHEN br.status = 'approved' THEN 'borrowed' ELSE 'unavailable' END,
+            current_borrow_id = CASE WHEN br.status = 'approved' THEN br.id END,
+            current_borrower_username = CASE WHEN br.status = 'approved' THEN u.username END
+        FROM borrow_requests br JOIN personnal_infos u ON u.id = br.user_id
+        WHERE br.product_id = p.id AND p.status = 'available'
+          AND br.status IN {ACTIVE_BORROW_STATUSES} AND br.loan_period @> CURRENT_DATE
+        RETURNING p.branch_id;
+    """)
+    branch_ids = {r[0] for r in cur.fetchall()}
+    print(f"Activated {cur.rowcount} reservations")
+    bump_catalog_version(cur, *branch_ids)
+    conn.commit()
+    drop_catalog_snapshot(*branch_ids)
+    conn.close()
+
+@app.cli.command('purge-token-revocations')
+def purge_token_revocations():
+    """Deletes revocations older than the token lifetime (every token they concerned has expired)."""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("DELETE FROM token_revocations WHERE revoked_at < CURRENT_TIMESTAMP - %s;", (TOKEN_LIFETIME,))
+    print(f"Purged {cur.rowcount} token revocations")
+    conn.commit()
+    conn.close()
+
+@app.cli.command('purge-idempotency-keys')
+def purge_idempotency_keys():
+    """Deletes idempotency keys older than IDEMPOTENCY_TTL_HOURS."""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("DELETE FROM idempotency_keys WHERE created_at < CURRENT_TIMESTAMP - make_interval(hours => %s);", (IDEMPOTENCY_TTL_HOURS,))
+    print(f"Purged {cur.rowcount} idempotency keys")
+    conn.commit()
+    conn.close()
+
+@app.cli.command('work-jobs')
+def work_jobs():
+    """Runs the background jobs until SIGTERM/SIGINT: JOB_CONCURRENCY threads per queue (default 1)."""
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    stop = threading.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda *_: stop.set())
+
+    queues = sorted({queue for _, queue in _job_handlers.values()})
+    threads = [threading.Thread(target=work_queue, args=(queue, worker_id, stop), name=f"jobs-{queue}-{i}", daemon=True)
+               for queue in queues for i in range(JOB_CONCURRENCY.get(queue, 1))]
+    for thread in threads:
+        thread.start()
+    print(f"Job worker {worker_id}: " + ", ".join(f"{q} x{JOB_CONCURRENCY.get(q, 1)}" for q in queues))
+
+    while not stop.wait(JOB_LEASE_SECONDS / 5):
+        try:
+            if requeue_stale_jobs():
+                print("Re-queued jobs whose worker stopped")
+        except Exception as e:
+            print(f"Job lease check failed: {e}")
+    for thread in threads:
+        thread.join()  # each finishes the job it is running
+
+@app.cli.command('purge-jobs')
+def purge_jobs():
+    """Deletes finished (done or failed) jobs older than JOB_RETENTION_DAYS."""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < CURRENT_TIMESTAMP - make_interval(days => %s);", (JOB_RETENTION_DAYS,))
+    print(f"Purged {cur.rowcount} jobs")
+    conn.commit()
+    conn.close()
+
+# Every loan ever made, live or archived, for rebuilding the statistics rollups
+ALL_LOANS_SQL = """
+    SELECT product_id, request_date, returned_date, status, approved_at FROM borrow_requests
+    UNION ALL
+    SELECT product_id, request_date, returned_date, status, approved_at FROM borrow_requests_archive
+"""
+
+@app.cli.command('backfill-stats')
+@statement_timeout(0)  # scans the whole loan history
+def backfill_stats():
+    """Rebuilds the statistics rollups from the full borrow history."""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    # TRUNCATE holds an exclusive lock on the rollups until the commit below: borrow transitions running
+    # meanwhile wait for it and add their increment on top of the rebuilt totals, instead of being both
+    # counted from the history and lost (or counted twice) by the rebuild.
+    cur.execute("TRUNCATE stats_daily_loans, stats_product_utilization;")
+    # Loans approved before approved_at existed count as approved on their request day, without a latency sample.
+    # Their actual return day is unknown, so the planned returned_date is used.
+    cur.execute(f"""
+        WITH loans AS ({ALL_LOANS_SQL}),
+        events AS (
+            SELECT request_date::date AS day, product_id, 'requested' AS kind, NULL::bigint AS latency FROM loans
+            UNION ALL
+            SELECT COALESCE(approved_at, request_date)::date, product_id, 'approved', EXTRACT(EPOCH FROM approved_at - request_date)::bigint
+            FROM loans WHERE status IN ('approved', 'returned') OR approved_at IS NOT NULL
+            UNION ALL
+            SELECT request_date::date, product_id, 'rejected', NULL FROM loans WHERE status = 'rejected'
+            UNION ALL
+            SELECT COALESCE(returned_date, request_date::date), product_id, 'returned', NULL FROM loans WHERE status = 'returned'
+        )
+        INSERT INTO stats_daily_loans (day, category, requested, approved, rejected, returned, approval_latency_seconds, approval_latency_samples)
+        SELECT e.day, p.category,
+               COUNT(*) FILTER (WHERE e.kind = 'requested'),
+               COUNT(*) FILTER (WHERE e.kind = 'approved'),
+               COUNT(*) FILTER (WHERE e.kind = 'rejected'),
+               COUNT(*) FILTER (WHERE e.kind = 'returned'),
+               COALESCE(SUM(GREATEST(e.latency, 0)) FILTER (WHERE e.kind = 'approved'), 0),
+               COUNT(e.latency) FILTER (WHERE e.kind = 'approved')
+        FROM events e JOIN products p ON e.product_id = p.id
+        GROUP BY e.day, p.category;
+    """)
+    cur.execute(f"""
+        WITH loans AS ({ALL_LOANS_SQL})
+        INSERT INTO stats_product_utilization (product_id, loans, borrowed_days, last_borrowed_at)
+        SELECT product_id, COUNT(*),
+               COALESCE(SUM(GREATEST(returned_date - COALESCE(approved_at, request_date)::date, 0)) FILTER (WHERE status = 'returned'), 0),
+               MAX(COALESCE(approved_at, request_date))
+        FROM loans WHERE status IN ('approved', 'returned') OR approved_at IS NOT NULL
+        GROUP BY product_id;
+    """)
+    conn.commit()
+    conn.close()
+    print("Statistics rollups rebuilt")
+
+if __name__ == '__main__':
+    # Reads the string "True" or "False" from .env and converts to boolean
+    debug_mode = os.getenv("FLASK_DEBUG", "False").lower() in ('true', '1', 't')
+
+
+    app.run(debug=debug_mode, port=DEV_SERVER_PORT, host='0.0.0.0')
+
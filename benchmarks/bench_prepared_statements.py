@@ -0,0 +1,116 @@
+"""
+Planning time saved by the named prepared statements in app.PREPARED_STATEMENTS.
+
+Each query is run N times as plain SQL and N times through PREPARE/EXECUTE, under
+EXPLAIN (ANALYZE, FORMAT JSON), and the "Planning Time" Postgres reports is compared.
+The multi-join employee queries are the interesting ones; the others are included for scale.
+
+Usage:
+    DATABASE_URL=postgres://... python benchmarks/bench_prepared_statements.py [--runs 200]
+
+Point it at a database filled with realistic volumes, otherwise every plan is trivially cheap.
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+
+import psycopg2
+from dotenv import load_dotenv
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+load_dotenv()
+from app import PREPARED_STATEMENTS, numbered_placeholders  # noqa: E402
+
+def sample_user(cur):
+    cur.execute("SELECT user_id FROM borrow_requests GROUP BY user_id ORDER BY COUNT(*) DESC LIMIT 1")
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def sample_branch(cur):
+    """The busiest branch (by products), so the branch-scoped queries have rows to plan for."""
+    cur.execute("SELECT branch_id FROM products GROUP BY branch_id ORDER BY COUNT(*) DESC LIMIT 1")
+    row = cur.fetchone()
+    return row[0] if row else 1
+
+
+def quota_params(cur):
+    cur.execute("SELECT user_id, branch_id FROM borrow_requests GROUP BY user_id, branch_id ORDER BY COUNT(*) DESC LIMIT 1")
+    return cur.fetchone()
+
+
+def sample_product(cur):
+    cur.execute("SELECT id FROM products ORDER BY id LIMIT 1")
+    return cur.fetchone()
+
+
+def first_page(cur):
+    user_id = sample_user(cur)
+    return None if user_id is None else (user_id, 'infinity', 0, 21)
+
+
+# Builds the parameters of each statement (None skips it); keep in step with app.PREPARED_STATEMENTS
+SAMPLE_PARAMS = {
+    'system_settings': lambda cur: (sample_branch(cur),),
+    'borrow_quota_count': quota_params,
+    'product_status': sample_product,
+    'my_requests_active': first_page,
+    'my_requests_history': lambda cur: first_page(cur) and first_page(cur) * 2 + (21,),
+    'my_requests_all': lambda cur: first_page(cur) and first_page(cur) * 2 + (21,),
+    'pending_borrow_requests': lambda cur: (sample_branch(cur),),
+    'pending_extension_requests': lambda cur: (sample_branch(cur),),
+}
+
+
+def explain(cur, sql, params=()):
+    """Returns (planning_ms, execution_ms, wall_ms) for one run of sql."""
+    start = time.perf_counter()
+    cur.execute(f"EXPLAIN (ANALYZE, FORMAT JSON) {sql}", params)
+    wall = (time.perf_counter() - start) * 1000
+    plan = cur.fetchone()[0][0]
+    return plan['Planning Time'], plan['Execution Time'], wall
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=200)
+    parser.add_argument('--only', nargs='*', help="statement names to benchmark (default: all)")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(os.getenv("DATABASE_URL"), sslmode=os.getenv("PGSSLMODE", "require"))
+    conn.autocommit = True
+    cur = conn.cursor()
+
+    print(f"{'statement':<28}{'plain plan ms':>15}{'prepared plan ms':>18}{'saved/call ms':>15}{'plain wall ms':>15}{'prepared wall ms':>18}")
+    for name, sql in PREPARED_STATEMENTS.items():
+        if args.only and name not in args.only:
+            continue
+        params = ()
+        if '%s' in sql:
+            if name not in SAMPLE_PARAMS:
+                print(f"{name:<28}skipped (no SAMPLE_PARAMS entry)")
+                continue
+            params = SAMPLE_PARAMS[name](cur)
+            if not params:
+                print(f"{name:<28}skipped (no sample row)")
+                continue
+
+        plain = [explain(cur, sql, params) for _ in range(args.runs)]
+
+        cur.execute(f"PREPARE bench_{name} AS {numbered_placeholders(sql)}")
+        placeholders = f" ({', '.join(['%s'] * len(params))})" if params else ""
+        prepared = [explain(cur, f"EXECUTE bench_{name}{placeholders}", params) for _ in range(args.runs)]
+        cur.execute(f"DEALLOCATE bench_{name}")
+
+        plain_plan = statistics.median(r[0] for r in plain)
+        prepared_plan = statistics.median(r[0] for r in prepared)
+        print(f"{name:<28}{plain_plan:>15.3f}{prepared_plan:>18.3f}{plain_plan - prepared_plan:>15.3f}"
+              f"{statistics.median(r[2] for r in plain):>15.3f}{statistics.median(r[2] for r in prepared):>18.3f}")
+
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
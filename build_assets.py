@@ -0,0 +1,170 @@
+"""
+Builds the frontend for serving from Flask (see serve_frontend in app.py).
+
+- Every file under images/ (and any non-HTML file next to the pages) is copied under a
+  content-hashed name, e.g. images/logo.png -> images/logo.3f9c1e2a7b.png, so it can be cached forever.
+- The HTML pages keep their names (they are the entry points, revalidated on every visit) and their
+  references to those files are rewritten. Paths built in JavaScript go through assetUrl(), which reads
+  the ASSET_MANIFEST object this script fills in.
+- Pictures also get resized WebP/AVIF + PNG/JPEG variants (image_variants.py) under images/v/, cached
+  in .image-cache/ between builds. Pages read them from ASSET_VARIANTS for srcset, and <img> tags that
+  declare a `sizes` attribute get a srcset added.
+- HTML/JS/CSS/SVG/JSON outputs are pre-compressed to .gz (and .br when the brotli package is installed).
+- asset-manifest.json lists the served files, whether they are immutable and which encodings exist.
+
+Usage:
+    python build_assets.py [--out static_build] [--image-cache .image-cache]
+"""
+import os
+import re
+import gzip
+import json
+import shutil
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+from image_variants import ensure_variants, IMAGE_EXTENSIONS
+
+try:
+    import brotli
+except ImportError:  # optional, gzip only without it
+    brotli = None
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+ENTRY_PAGES = ['index.html', 'pages']
+ASSET_DIRS = ['images', 'pages']
+COMPRESSIBLE = ('.html', '.js', '.css', '.svg', '.json', '.txt')
+MANIFEST_PLACEHOLDER = 'const ASSET_MANIFEST = {};'
+VARIANTS_PLACEHOLDER = 'const ASSET_VARIANTS = {};'
+IMG_TAG = re.compile(r'<img\b[^>]*>')
+
+
+def walk(*paths):
+    """Yields repo-relative paths (with forward slashes) of the files under the given files/dirs."""
+    for path in paths:
+        full = os.path.join(ROOT, path)
+        if os.path.isfile(full):
+            yield path
+            continue
+        for dirpath, _, filenames in os.walk(full):
+            for name in sorted(filenames):
+                yield os.path.relpath(os.path.join(dirpath, name), ROOT).replace(os.sep, '/')
+
+
+def fingerprinted_name(path, content):
+    """images/transparent logo.png -> images/transparent-logo.<hash>.png (no spaces in URLs)."""
+    directory, filename = os.path.split(path)
+    stem, ext = os.path.splitext(filename)
+    digest = hashlib.sha256(content).hexdigest()[:10]
+    return f"{directory}/{re.sub(r'[^A-Za-z0-9_-]+', '-', stem)}.{digest}{ext}"
+
+
+def add_srcsets(html, page_dir, variants):
+    """Adds the fallback-format variants as srcset to <img> tags that have a sizes attribute."""
+    def add(match):
+        tag = match.group(0)
+        src = re.search(r'src="([^"]+)"', tag)
+        if 'sizes=' not in tag or 'srcset=' in tag or not src:
+            return tag
+        source = os.path.normpath(os.path.join(page_dir, src.group(1))).replace(os.sep, '/')
+        if source not in variants:
+            return tag
+        fallback = variants[source].get('jpeg') or variants[source]['png']
+        srcset = ', '.join(f"{os.path.relpath(url, page_dir or '.')} {w}w" for w, url in fallback)
+        return tag.replace(' src=', f' srcset="{srcset}" src=', 1)
+    return IMG_TAG.sub(add, html)
+
+
+def rewrite_references(html, page_path, assets, variants):
+    """Points the page's quoted references to the assets at their fingerprinted names."""
+    page_dir = os.path.dirname(page_path)
+    html = add_srcsets(html, page_dir, variants)
+    for source, target in assets.items():
+        ref = os.path.relpath(source, page_dir or '.').replace(os.sep, '/')
+        new_ref = os.path.relpath(target, page_dir or '.').replace(os.sep, '/')
+        html = re.sub(r'(["\'(])' + re.escape(ref) + r'(["\')])', lambda m: m.group(1) + new_ref + m.group(2), html)
+    manifest = json.dumps(assets, ensure_ascii=False, sort_keys=True)
+    html = html.replace(VARIANTS_PLACEHOLDER, f'const ASSET_VARIANTS = {json.dumps(variants, ensure_ascii=False, sort_keys=True)};')
+    return html.replace(MANIFEST_PLACEHOLDER, f'const ASSET_MANIFEST = {manifest};')
+
+
+def write_output(out_dir, path, content, immutable, files):
+    full = os.path.join(out_dir, path)
+    os.makedirs(os.path.dirname(full), exist_ok=True)
+    with open(full, 'wb') as f:
+        f.write(content)
+
+    encodings = []
+    if path.endswith(COMPRESSIBLE):
+        if brotli is not None:
+            with open(full + '.br', 'wb') as f:
+                f.write(brotli.compress(content, quality=11))
+            encodings.append('br')
+        with open(full + '.gz', 'wb') as f:
+            f.write(gzip.compress(content, compresslevel=9, mtime=0))
+        encodings.append('gzip')
+    files[path] = {'immutable': immutable, 'encodings': encodings}
+
+
+def build_variants(assets, out_dir, cache_dir, files):
+    """Renders (or reuses) the image variants and copies them to images/v/. Returns {source: {format: [[width, url]]}}."""
+    sources = [path for path in assets if path.lower().endswith(IMAGE_EXTENSIONS)]
+    with ProcessPoolExecutor() as pool:
+        cached = ensure_variants([os.path.join(ROOT, path) for path in sources], cache_dir, pool=pool)
+    variants = {}
+    for path in sources:
+        variants[path] = {}
+        for fmt, entries in cached[os.path.join(ROOT, path)].items():
+            variants[path][fmt] = []
+            for width, rel_path in entries:
+                url = f"images/v/{rel_path}"
+                os.makedirs(os.path.dirname(os.path.join(out_dir, url)), exist_ok=True)
+                shutil.copyfile(os.path.join(cache_dir, rel_path), os.path.join(out_dir, url))
+                files[url] = {'immutable': True, 'encodings': []}
+                variants[path][fmt].append([width, url])
+    return variants
+
+
+def build(out_dir, cache_dir):
+    shutil.rmtree(out_dir, ignore_errors=True)
+    files = {}
+
+    # 1. Fingerprinted assets
+    assets = {}
+    for path in walk(*ASSET_DIRS):
+        if path.endswith('.html'):
+            continue
+        with open(os.path.join(ROOT, path), 'rb') as f:
+            content = f.read()
+        assets[path] = fingerprinted_name(path, content)
+        write_output(out_dir, assets[path], content, True, files)
+
+    # 2. Resized variants of the pictures
+    variants = build_variants(assets, out_dir, cache_dir, files)
+
+    # 3. Pages, under their own names
+    for path in walk(*ENTRY_PAGES):
+        if not path.endswith('.html'):
+            continue
+        with open(os.path.join(ROOT, path), encoding='utf-8') as f:
+            html = rewrite_references(f.read(), path, assets, variants)
+        write_output(out_dir, path, html.encode('utf-8'), False, files)
+
+    with open(os.path.join(out_dir, 'asset-manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump({'files': files, 'assets': assets, 'variants': variants}, f, ensure_ascii=False, indent=1, sort_keys=True)
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--out', default=os.path.join(ROOT, 'static_build'))
+    parser.add_argument('--image-cache', default=os.path.join(ROOT, '.image-cache'))
+    args = parser.parse_args()
+
+    files = build(args.out, args.image_cache)
+    print(f"Built {len(files)} files into {args.out}" + ("" if brotli else " (install brotli for .br variants)"))
+
+
+if __name__ == '__main__':
+    main()
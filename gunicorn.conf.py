@@ -0,0 +1,54 @@
+"""
+gunicorn settings, picked up automatically from the working directory (the App Service startup command
+stays `gunicorn app:app`). The background job worker (`flask --app app work-jobs`) is started next to the
+web workers, restarted if it exits and stopped with them; set JOB_WORKER=false where it runs as its own
+process instead.
+"""
+import os
+import sys
+import time
+import threading
+import subprocess
+
+JOB_WORKER_RESTART_SECONDS = 5
+
+job_worker = None
+stopping = threading.Event()
+
+
+def post_worker_init(worker):
+    """Warms each worker up (DB pool, prepared statements, catalog, token revocations) once the app is
+    loaded in it and before it accepts requests, so a rolling restart never hands traffic to a cold worker."""
+    from app import warm_up
+    warm_up()
+
+
+def watch_job_worker(log):
+    """Keeps one job worker running (in a thread of the gunicorn master)."""
+    global job_worker
+    while not stopping.is_set():
+        started = time.monotonic()
+        job_worker = subprocess.Popen([sys.executable, '-m', 'flask', '--app', 'app', 'work-jobs'])
+        log.info("Started job worker (pid %s)", job_worker.pid)
+        code = job_worker.wait()
+        if stopping.is_set():
+            return
+        log.warning("Job worker exited with %s, restarting", code)
+        # A worker that dies at startup (bad configuration) is not restarted in a tight loop
+        stopping.wait(max(0, JOB_WORKER_RESTART_SECONDS - (time.monotonic() - started)))
+
+
+def when_ready(server):
+    if os.getenv("JOB_WORKER", "true").lower() != "false":
+        threading.Thread(target=watch_job_worker, args=(server.log,), name="job-worker-watch", daemon=True).start()
+
+
+def on_exit(server):
+    """SIGTERM lets the job worker finish the jobs it is running."""
+    stopping.set()
+    if job_worker is not None and job_worker.poll() is None:
+        job_worker.terminate()
+        try:
+            job_worker.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            job_worker.kill()
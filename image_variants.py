@@ -0,0 +1,82 @@
+"""
+Resized WebP (and AVIF, when this Pillow build supports it) variants of an image, plus a PNG/JPEG
+fallback, for srcset. Variants are cached on disk under the hash of the source file:
+
+    <cache_dir>/<source hash>/<width>.<ext>
+
+so a changed picture gets new URLs and an unchanged one is never re-encoded. Rendering is CPU bound
+and meant to run in a process pool. Used by build_assets.py (category pictures, logo) and by app.py for
+uploaded product photos.
+"""
+import os
+import hashlib
+
+from PIL import Image, ImageOps, features
+
+VARIANT_WIDTHS = (64, 128, 256, 512, 1024)
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+EXTENSIONS = {'avif': 'avif', 'webp': 'webp', 'png': 'png', 'jpeg': 'jpg'}
+SAVE_OPTIONS = {
+    'avif': {'quality': 60},
+    'webp': {'quality': 80, 'method': 6},
+    'png': {'optimize': True},
+    'jpeg': {'quality': 82, 'optimize': True, 'progressive': True},
+}
+
+
+def source_key(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()[:16]
+
+
+def plan_variants(path, widths=VARIANT_WIDTHS):
+    """Returns (formats, widths) to produce for the image: modern formats first, then the fallback.
+    Widths above the original are dropped (no upscaling)."""
+    with Image.open(path) as im:
+        has_alpha = im.mode in ('RGBA', 'LA', 'PA') or (im.mode == 'P' and 'transparency' in im.info)
+        original_width = ImageOps.exif_transpose(im).width
+    formats = [f for f in ('avif', 'webp') if features.check(f)]
+    formats.append('png' if has_alpha else 'jpeg')
+    return formats, [w for w in widths if w < original_width] or [original_width]
+
+
+def render_variant(source_path, target_path, width, fmt):
+    """Writes one variant (write then rename, so a concurrent reader never sees half a file)."""
+    with Image.open(source_path) as im:
+        im = ImageOps.exif_transpose(im)
+        if fmt == 'jpeg':
+            im = im.convert('RGB')
+        elif im.mode not in ('RGB', 'RGBA'):
+            im = im.convert('RGBA')
+        height = max(1, round(im.height * width / im.width))
+        im = im.resize((width, height), Image.LANCZOS)
+        tmp_path = f"{target_path}.{os.getpid()}.tmp"
+        im.save(tmp_path, format=fmt.upper(), **SAVE_OPTIONS[fmt])
+    os.replace(tmp_path, target_path)
+    return target_path
+
+
+def ensure_variants(sources, cache_dir, widths=VARIANT_WIDTHS, pool=None):
+    """Makes sure every variant of every source exists in cache_dir, rendering the missing ones in pool
+    (a ProcessPoolExecutor) or, without one, in this process (e.g. when already running in a pool worker).
+    Returns {source: {format: [[width, path relative to cache_dir], ...]}}."""
+    variants, missing = {}, []
+    for source in sources:
+        key = source_key(source)
+        os.makedirs(os.path.join(cache_dir, key), exist_ok=True)
+        formats, source_widths = plan_variants(source, widths)
+        variants[source] = {}
+        for fmt in formats:
+            variants[source][fmt] = []
+            for width in source_widths:
+                rel_path = f"{key}/{width}.{EXTENSIONS[fmt]}"
+                variants[source][fmt].append([width, rel_path])
+                if not os.path.exists(os.path.join(cache_dir, rel_path)):
+                    missing.append((source, os.path.join(cache_dir, rel_path), width, fmt))
+
+    if missing:
+        list((pool.map if pool is not None else map)(render_variant, *zip(*missing)))
+    return variants